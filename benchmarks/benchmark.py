@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmarks rolling update strategies against simulated clusters, reporting the simulated duration of each
+rollout along with the number of API calls and the peak number of instances it needed.
+
+    python -m benchmarks.benchmark --nodes 10 100 --output results.json
+    python -m benchmarks.benchmark --baseline results.json --tolerance 0.2
+"""
+import sys
+import json
+import argparse
+from .simulator import simulate, SimulationProfile
+
+# settings of each scenario, applied on top of the defaults of app_config
+SCENARIOS = {
+    'run-mode-1': {'RUN_MODE': 1},
+    'run-mode-2': {'RUN_MODE': 2},
+    'run-mode-3': {'RUN_MODE': 3},
+    'run-mode-4': {'RUN_MODE': 4},
+    'batch-size-5': {'BATCH_SIZE': 5},
+    'max-surge-5': {'MAX_SURGE': 5},
+    'drain-concurrency-5': {'DRAIN_CONCURRENCY': 5},
+    'asg-concurrency-3': {'ASG_CONCURRENCY': 3, 'DRAIN_CONCURRENCY': 5},
+    'async-engine': {'ASYNC_ENGINE': True, 'ASG_CONCURRENCY': 3, 'DRAIN_CONCURRENCY': 5},
+    'warm-pool': {'WARM_POOL': True},
+    'instance-refresh': {'INSTANCE_REFRESH': True, 'INSTANCE_REFRESH_WARMUP': 60, 'ASG_CONCURRENCY': 3, 'DRAIN_CONCURRENCY': 5},
+}
+
+
+def get_asg_sizes(nodes, asg_count):
+    """
+    Splits the nodes of a cluster as evenly as possible across asg_count ASGs
+    """
+    return [nodes // asg_count + (1 if i < nodes % asg_count else 0) for i in range(asg_count)]
+
+
+def run_benchmarks(node_counts, scenarios, asg_count, profile, time_scale):
+    results = []
+    for nodes in node_counts:
+        for scenario in scenarios:
+            # keep the wall clock time of larger clusters in check
+            scale = time_scale or min(0.002, 0.2 / nodes)
+            result = simulate(get_asg_sizes(nodes, asg_count), profile, scale, **SCENARIOS[scenario]).as_dict()
+            result.update(nodes=nodes, scenario=scenario)
+            results.append(result)
+            print('{nodes:>6} nodes  {scenario:<22} {simulated_seconds:>9.0f}s simulated  {wall_seconds:>8.2f}s wall  '
+                  '{aws_api_calls:>6} AWS calls  {k8s_api_calls:>6} k8s calls  {throttled_calls:>5} throttled  '
+                  'peak {peak_instances} instances'.format(**result), flush=True)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Returns the results whose simulated duration or API calls exceed those of the baseline by more than tolerance
+    """
+    baseline_results = {(result['nodes'], result['scenario']): result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get((result['nodes'], result['scenario']))
+        if not previous:
+            continue
+        for key in ['simulated_seconds', 'aws_api_calls', 'k8s_api_calls']:
+            if result[key] > previous[key] * (1 + tolerance):
+                regressions.append(f'{result["nodes"]} nodes {result["scenario"]}: {key} went from {previous[key]} to {result[key]}')
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark rolling updates against simulated clusters')
+    parser.add_argument('--nodes', type=int, nargs='+', default=[10, 100], help='cluster sizes to simulate')
+    parser.add_argument('--scenarios', nargs='+', choices=sorted(SCENARIOS), default=list(SCENARIOS),
+                        help='scenarios to run')
+    parser.add_argument('--asgs', type=int, default=3, help='number of ASGs to spread the nodes across')
+    parser.add_argument('--time-scale', type=float, default=0,
+                        help='wall clock seconds per simulated second. Scaled to the cluster size by default')
+    parser.add_argument('--boot-seconds', type=float, default=60, help='time for a new instance to be running')
+    parser.add_argument('--join-seconds', type=float, default=30, help='time for a running instance to be a Ready node')
+    parser.add_argument('--warm-start-seconds', type=float, default=15,
+                        help='time for an instance of a warm pool to be running once taken into service')
+    parser.add_argument('--drain-seconds', type=float, default=30, help='time to drain a node')
+    parser.add_argument('--pdb-block-probability', type=float, default=0.1,
+                        help='probability of a drain being blocked by a PodDisruptionBudget')
+    parser.add_argument('--pdb-block-seconds', type=float, default=60, help='time a blocked drain is held up for')
+    parser.add_argument('--api-rate-limit', type=float, default=0,
+                        help='AWS API calls per second per service before calls are throttled. 0 is unlimited')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a result may exceed the baseline before failing')
+    args = parser.parse_args(args)
+
+    profile = SimulationProfile(
+        boot_seconds=args.boot_seconds,
+        join_seconds=args.join_seconds,
+        warm_start_seconds=args.warm_start_seconds,
+        drain_seconds=args.drain_seconds,
+        pdb_block_probability=args.pdb_block_probability,
+        pdb_block_seconds=args.pdb_block_seconds,
+        api_rate_limit=args.api_rate_limit,
+    )
+    results = run_benchmarks(args.nodes, args.scenarios, args.asgs, profile, args.time_scale)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,601 @@
+import json
+import math
+import time
+import random
+import asyncio
+import datetime
+import logging
+import threading
+from collections import Counter
+from contextlib import contextmanager, ExitStack
+from types import SimpleNamespace
+from unittest.mock import patch
+from botocore import xform_name
+from botocore.awsrequest import AWSResponse
+from eksrollup.config import app_config
+from eksrollup.lib import aws, aws_api
+from eksrollup.lib.logger import logger
+from eksrollup.lib.aws import InstanceTerminationTracker, get_asgs
+from eksrollup.lib.aws_api import create_client
+from eksrollup.lib.k8s import InstrumentedApi
+
+CURRENT_LAUNCH_CONFIGURATION = 'simulated-lc-new'
+OUTDATED_LAUNCH_CONFIGURATION = 'simulated-lc-old'
+AVAILABILITY_ZONES = ['us-east-1a', 'us-east-1b', 'us-east-1c']
+# settings of the tool which are durations in seconds, so they are scaled like the simulated latencies
+DURATION_SETTINGS = ['CLUSTER_HEALTH_WAIT', 'GLOBAL_HEALTH_WAIT', 'BETWEEN_NODES_WAIT', 'INSTANCE_REFRESH_POLL_WAIT']
+
+
+class SimulationProfile:
+    """
+    Behaviour of the simulated cluster. Latencies are in simulated seconds
+    """
+
+    def __init__(self, boot_seconds=60, join_seconds=30, drain_seconds=30, pods_per_node=10,
+                 pdb_block_probability=0.0, pdb_block_seconds=30, terminate_seconds=30, api_rate_limit=0,
+                 warm_start_seconds=15):
+        # time for a launched instance to be running and then to join the cluster as a Ready node
+        self.boot_seconds = boot_seconds
+        self.join_seconds = join_seconds
+        # time for an instance initialized in a warm pool to be running once it is taken into service
+        self.warm_start_seconds = warm_start_seconds
+        # time to evict the pods of a node, plus pdb_block_seconds for the drains blocked by a PodDisruptionBudget
+        self.drain_seconds = drain_seconds
+        self.pods_per_node = pods_per_node
+        self.pdb_block_probability = pdb_block_probability
+        self.pdb_block_seconds = pdb_block_seconds
+        # time for a terminated instance to go from shutting-down to terminated
+        self.terminate_seconds = terminate_seconds
+        # AWS API calls allowed per simulated second for each service before calls are throttled. 0 is unlimited
+        self.api_rate_limit = api_rate_limit
+
+
+class SimulationResult:
+
+    def __init__(self, simulated_seconds, wall_seconds, api_calls, throttled_calls, peak_instances, outdated_instances):
+        self.simulated_seconds = simulated_seconds
+        self.wall_seconds = wall_seconds
+        self.api_calls = api_calls
+        self.throttled_calls = throttled_calls
+        self.peak_instances = peak_instances
+        self.outdated_instances = outdated_instances
+
+    def as_dict(self):
+        return {
+            'simulated_seconds': round(self.simulated_seconds, 1),
+            'wall_seconds': round(self.wall_seconds, 3),
+            'aws_api_calls': sum(count for operation, count in self.api_calls.items() if not operation.startswith('k8s.')),
+            'k8s_api_calls': sum(count for operation, count in self.api_calls.items() if operation.startswith('k8s.')),
+            'throttled_calls': sum(self.throttled_calls.values()),
+            'peak_instances': self.peak_instances,
+            'outdated_instances': self.outdated_instances,
+        }
+
+
+class FakeCoreV1Api:
+    """
+    Stands in for kubernetes.client.CoreV1Api with the calls the rolling update makes on nodes
+    """
+
+    def __init__(self, cluster):
+        self.cluster = cluster
+
+    def list_node(self, _preload_content=True, **kwargs):
+        node_list = self.cluster.k8s_call('list_node', self.cluster.list_nodes)
+        if _preload_content:
+            return node_list
+        # the raw response read by projected node listings
+        return SimpleNamespace(data=json.dumps({
+            'metadata': {'resourceVersion': node_list.metadata.resource_version},
+            'items': [{
+                'metadata': {'name': node.metadata.name, 'labels': node.metadata.labels},
+                'spec': {'providerID': node.spec.provider_id, 'unschedulable': node.spec.unschedulable},
+                'status': {'conditions': [{'type': condition.type, 'status': condition.status}
+                                          for condition in node.status.conditions]},
+            } for node in node_list.items],
+        }))
+
+    def patch_node(self, name, body, **kwargs):
+        return self.cluster.k8s_call('patch_node', self.cluster.patch_node, name, body)
+
+    def delete_node(self, name, **kwargs):
+        return self.cluster.k8s_call('delete_node', self.cluster.delete_node, name)
+
+
+class SimulatedCluster:
+    """
+    Fake autoscaling, EC2 and Kubernetes backends for a cluster whose ASGs all run outdated instances. The
+    autoscaling backend also runs instance refreshes, holds terminating instances for lifecycle hooks and keeps
+    warm pools of stopped instances.
+    Simulated time runs time_scale times faster than the wall clock
+    """
+
+    def __init__(self, cluster_name, asg_sizes, profile=None, time_scale=0.01, seed=0):
+        self.cluster_name = cluster_name
+        self.profile = profile or SimulationProfile()
+        self.time_scale = time_scale
+        self.api_calls = Counter()
+        self.throttled_calls = Counter()
+        self.peak_instances = 0
+        # instances terminated because the heartbeat of a lifecycle hook holding them timed out
+        self.hook_timeouts = 0
+        self._random = random.Random(seed)
+        self._lock = threading.RLock()
+        self._started_at = time.monotonic()
+        self._next_api_call_at = {}
+        self._instance_count = 0
+        self.asgs = {}
+        self.instances = {}
+        self.nodes = {}
+        outdated_launch_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30)
+        for i, size in enumerate(asg_sizes):
+            asg_name = f'{cluster_name}-asg-{i}'
+            self.asgs[asg_name] = {
+                'DesiredCapacity': size,
+                'MinSize': 0,
+                'MaxSize': size,
+                'Tags': {f'kubernetes.io/cluster/{cluster_name}': 'owned'},
+                'SuspendedProcesses': set(),
+                # termination lifecycle hooks by name, with their heartbeat timeout
+                'LifecycleHooks': {},
+                # most recent first
+                'InstanceRefreshes': [],
+                # settings of the warm pool, if any
+                'WarmPool': None,
+            }
+            for _ in range(size):
+                self._launch_instance(asg_name, OUTDATED_LAUNCH_CONFIGURATION, outdated_launch_time, booted=True)
+
+    def add_warm_pool(self, asg_name, warm_pool):
+        """
+        Gives an ASG an existing warm pool, whose stopped instances were launched with the outdated launch configuration
+        """
+        asg = self.asgs[asg_name]
+        asg['WarmPool'] = dict(warm_pool)
+        outdated_launch_time = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=30)
+        for _ in range(self._warm_pool_size(asg)):
+            self._launch_instance(asg_name, OUTDATED_LAUNCH_CONFIGURATION, outdated_launch_time, booted=True, warm=True)
+
+    def now(self):
+        """
+        Returns the simulated time in seconds since the simulation started
+        """
+        return (time.monotonic() - self._started_at) / self.time_scale
+
+    def sleep(self, simulated_seconds):
+        time.sleep(simulated_seconds * self.time_scale)
+
+    # EC2 and autoscaling state
+
+    def _launch_instance(self, asg_name, launch_configuration, launch_time, booted=False, warm=False):
+        self._instance_count += 1
+        instance_id = f'i-{self._instance_count:017x}'
+        ready_at = -1 if booted else self.now() + self.profile.boot_seconds
+        # an instance launched into a warm pool only becomes a node once it is taken into service
+        node_name = f'ip-{self._instance_count}.ec2.internal'
+        self.instances[instance_id] = {
+            'asg': asg_name,
+            'az': AVAILABILITY_ZONES[self._instance_count % len(AVAILABILITY_ZONES)],
+            'launch_configuration': launch_configuration,
+            'launch_time': launch_time,
+            'running_at': ready_at,
+            'joined_at': ready_at if booted else ready_at + self.profile.join_seconds,
+            'launched_at': self.now(),
+            # when a termination lifecycle hook started holding the instance in Terminating:Wait
+            'held_at': None,
+            'terminating_at': None,
+            'node_name': node_name,
+            # whether the instance is initialized or stopped in the warm pool of the ASG
+            'warm': warm,
+            'launched_warm': warm,
+        }
+        if not warm:
+            self.nodes[node_name] = {'instance_id': instance_id, 'unschedulable': False}
+
+    def _start_warm_instance(self, instance_id):
+        """
+        Takes an instance of the warm pool into service. An instance still initializing just carries on booting
+        """
+        instance = self.instances[instance_id]
+        instance['warm'] = False
+        instance['running_at'] = max(self.now() + self.profile.warm_start_seconds, instance['running_at'])
+        instance['joined_at'] = instance['running_at'] + self.profile.join_seconds
+        self.nodes[instance['node_name']] = {'instance_id': instance_id, 'unschedulable': False}
+
+    def _warm_instances(self, asg_name):
+        # initialized instances first
+        return sorted((instance_id for instance_id, instance in self.instances.items()
+                       if instance['asg'] == asg_name and instance['warm'] and instance['terminating_at'] is None),
+                      key=lambda instance_id: self.instances[instance_id]['running_at'])
+
+    def _warm_pool_size(self, asg):
+        """
+        Returns the number of instances the warm pool of an ASG should hold, like the ASG service would
+        """
+        warm_pool = asg['WarmPool']
+        max_prepared = warm_pool.get('MaxGroupPreparedCapacity', -1)
+        if max_prepared is None or max_prepared < 0:
+            max_prepared = asg['MaxSize']
+        return max(warm_pool.get('MinSize', 0), max_prepared - asg['DesiredCapacity'])
+
+    def _instance_state(self, instance):
+        now = self.now()
+        if instance['terminating_at'] is not None:
+            return 'terminated' if now >= instance['terminating_at'] + self.profile.terminate_seconds else 'shutting-down'
+        if now < instance['running_at']:
+            return 'pending'
+        return 'stopped' if instance['warm'] else 'running'
+
+    def _terminate_instance(self, instance_id):
+        instance = self.instances[instance_id]
+        if instance['terminating_at'] is not None or instance['held_at'] is not None:
+            return
+        if self.asgs[instance['asg']]['LifecycleHooks']:
+            instance['held_at'] = self.now()
+        else:
+            instance['terminating_at'] = self.now()
+
+    def _release_instance(self, instance_id):
+        instance = self.instances[instance_id]
+        if instance['held_at'] is not None:
+            instance['held_at'] = None
+            instance['terminating_at'] = self.now()
+
+    def _is_active(self, instance):
+        return instance['terminating_at'] is None and instance['held_at'] is None and not instance['warm']
+
+    def _refresh_instances(self, asg_name, asg):
+        """
+        Replaces the instances of an ASG a batch at a time while an instance refresh is in progress, keeping
+        MinHealthyPercentage of its desired capacity warmed up, like the ASG service would
+        """
+        refresh = asg['InstanceRefreshes'][0] if asg['InstanceRefreshes'] else None
+        if refresh is None or refresh['Status'] != 'InProgress':
+            return
+        now = self.now()
+        active = {instance_id: instance for instance_id, instance in self.instances.items()
+                  if instance['asg'] == asg_name and self._is_active(instance)}
+        to_replace = sorted(instance_id for instance_id, instance in active.items() if self._refresh_replaces(refresh, instance))
+        healthy = sum(1 for instance in active.values() if now >= instance['running_at'] + refresh['InstanceWarmup'])
+        batch = max(1, asg['DesiredCapacity'] - math.ceil(asg['DesiredCapacity'] * refresh['MinHealthyPercentage'] / 100))
+        while to_replace and healthy > asg['DesiredCapacity'] - batch:
+            self._terminate_instance(to_replace.pop(0))
+            healthy -= 1
+        held = [instance for instance in self.instances.values() if instance['asg'] == asg_name and instance['held_at'] is not None]
+        refresh['PercentageComplete'] = int(100 * (1 - (len(to_replace) + len(held)) / refresh['total'])) if refresh['total'] else 100
+        if not to_replace and not held and healthy >= asg['DesiredCapacity']:
+            refresh['Status'] = 'Successful'
+            refresh['PercentageComplete'] = 100
+
+    def _refresh_replaces(self, refresh, instance):
+        if instance['launched_at'] >= refresh['started_at']:
+            return False
+        return not refresh['SkipMatching'] or instance['launch_configuration'] != CURRENT_LAUNCH_CONFIGURATION
+
+    def _reconcile(self):
+        """
+        Launches or terminates instances so each ASG matches its desired capacity, like the ASG service would
+        """
+        for instance_id, instance in self.instances.items():
+            hooks = self.asgs[instance['asg']]['LifecycleHooks']
+            # the default result of a hook whose heartbeat timed out lets the instance terminate
+            if instance['held_at'] is not None and self.now() >= instance['held_at'] + min(hooks.values(), default=0):
+                self.hook_timeouts += 1 if hooks else 0
+                self._release_instance(instance_id)
+        for asg_name, asg in self.asgs.items():
+            self._refresh_instances(asg_name, asg)
+            active = [instance_id for instance_id, instance in self.instances.items()
+                      if instance['asg'] == asg_name and self._is_active(instance)]
+            if len(active) < asg['DesiredCapacity'] and 'Launch' not in asg['SuspendedProcesses']:
+                warm_instances = self._warm_instances(asg_name)
+                for _ in range(asg['DesiredCapacity'] - len(active)):
+                    if warm_instances:
+                        self._start_warm_instance(warm_instances.pop(0))
+                    else:
+                        self._launch_instance(asg_name, CURRENT_LAUNCH_CONFIGURATION, datetime.datetime.now(datetime.timezone.utc))
+            elif len(active) > asg['DesiredCapacity']:
+                # terminate instances with an outdated launch configuration first, then the oldest ones
+                active.sort(key=lambda instance_id: self.instances[instance_id]['launch_configuration'] == CURRENT_LAUNCH_CONFIGURATION)
+                for instance_id in active[:len(active) - asg['DesiredCapacity']]:
+                    self._terminate_instance(instance_id)
+            if asg['WarmPool'] is not None and asg['WarmPool'].get('Status') == 'PendingDelete':
+                # a deleted pool is gone once its instances are terminated
+                if all(self._instance_state(instance) == 'terminated' for instance in self.instances.values()
+                       if instance['asg'] == asg_name and instance['warm']):
+                    asg['WarmPool'] = None
+            elif asg['WarmPool'] is not None and 'Launch' not in asg['SuspendedProcesses']:
+                for _ in range(self._warm_pool_size(asg) - len(self._warm_instances(asg_name))):
+                    self._launch_instance(asg_name, CURRENT_LAUNCH_CONFIGURATION, datetime.datetime.now(datetime.timezone.utc),
+                                          warm=True)
+        # stopped instances of the warm pools are not counted
+        self.peak_instances = max(self.peak_instances, sum(
+            1 for instance in self.instances.values() if self._instance_state(instance) != 'terminated' and not instance['warm']))
+
+    def _asg_instances(self, asg_name):
+        return [(instance_id, instance) for instance_id, instance in self.instances.items()
+                if instance['asg'] == asg_name and self._instance_state(instance) != 'terminated' and not instance['warm']]
+
+    def outdated_instance_count(self):
+        with self._lock:
+            return sum(1 for asg_name in self.asgs for _, instance in self._asg_instances(asg_name)
+                       if instance['launch_configuration'] != CURRENT_LAUNCH_CONFIGURATION and instance['terminating_at'] is None)
+
+    # AWS API
+
+    def _throttle(self, service_name):
+        """
+        Delays calls beyond api_rate_limit per simulated second, like retries of throttled calls would
+        """
+        if not self.profile.api_rate_limit:
+            return
+        with self._lock:
+            now = self.now()
+            call_at = max(now, self._next_api_call_at.get(service_name, now))
+            self._next_api_call_at[service_name] = call_at + 1 / self.profile.api_rate_limit
+        if call_at > now:
+            self.throttled_calls[service_name] += 1
+            self.sleep(call_at - now)
+
+    def _capture_params(self, params, context, **kwargs):
+        context['simulator_params'] = dict(params)
+
+    def _handle_aws_call(self, model, context, **kwargs):
+        service_name = model.service_model.service_name
+        self._throttle(service_name)
+        handler = getattr(self, f'_{service_name}_{xform_name(model.name)}', None)
+        if handler is None:
+            raise NotImplementedError(f'{service_name}.{model.name} is not simulated')
+        with self._lock:
+            self.api_calls[f'{service_name}.{model.name}'] += 1
+            parsed = handler(**context.get('simulator_params', {}))
+            self._reconcile()
+        parsed['ResponseMetadata'] = {'HTTPStatusCode': 200}
+        return AWSResponse('https://simulated.amazonaws.com', 200, {}, None), parsed
+
+    def create_client(self, service_name):
+        """
+        Creates a real client through the same factory as the tool, whose calls are answered by the fake backend
+        instead of being sent, so the rate limiter, instrumentation and paginators run as usual
+        """
+        aws_client = create_client(service_name, region_name='us-east-1',
+                                   aws_access_key_id='simulated', aws_secret_access_key='simulated')
+        aws_client.meta.events.register('before-parameter-build', self._capture_params)
+        aws_client.meta.events.register_last('before-call', self._handle_aws_call)
+        return aws_client
+
+    def _describe_asg(self, asg_name):
+        asg = self.asgs[asg_name]
+        instances = []
+        for instance_id, instance in self._asg_instances(asg_name):
+            instances.append({
+                'InstanceId': instance_id,
+                'AvailabilityZone': instance['az'],
+                'LifecycleState': self._lifecycle_state(instance),
+                'HealthStatus': 'Healthy',
+                'LaunchConfigurationName': instance['launch_configuration'],
+            })
+        described_asg = {
+            'AutoScalingGroupName': asg_name,
+            'LaunchConfigurationName': CURRENT_LAUNCH_CONFIGURATION,
+            'DesiredCapacity': asg['DesiredCapacity'],
+            'MinSize': asg['MinSize'],
+            'MaxSize': asg['MaxSize'],
+            'Instances': instances,
+            'Tags': [{'ResourceId': asg_name, 'ResourceType': 'auto-scaling-group', 'Key': key, 'Value': value,
+                      'PropagateAtLaunch': False} for key, value in asg['Tags'].items()],
+        }
+        if asg['WarmPool'] is not None:
+            described_asg['WarmPoolConfiguration'] = dict(asg['WarmPool'])
+            described_asg['WarmPoolSize'] = len(self._warm_instances(asg_name))
+        return described_asg
+
+    def _lifecycle_state(self, instance):
+        if instance['held_at'] is not None:
+            return 'Terminating:Wait'
+        return 'Terminating' if instance['terminating_at'] is not None else 'InService'
+
+    def _autoscaling_describe_auto_scaling_groups(self, AutoScalingGroupNames=None, **kwargs):
+        return {'AutoScalingGroups': [self._describe_asg(asg_name) for asg_name in AutoScalingGroupNames or self.asgs]}
+
+    def _autoscaling_update_auto_scaling_group(self, AutoScalingGroupName, DesiredCapacity=None, MaxSize=None, **kwargs):
+        asg = self.asgs[AutoScalingGroupName]
+        if MaxSize is not None:
+            asg['MaxSize'] = MaxSize
+        if DesiredCapacity is not None:
+            asg['DesiredCapacity'] = DesiredCapacity
+        return {}
+
+    def _autoscaling_suspend_processes(self, AutoScalingGroupName, ScalingProcesses, **kwargs):
+        self.asgs[AutoScalingGroupName]['SuspendedProcesses'].update(ScalingProcesses)
+        return {}
+
+    def _autoscaling_resume_processes(self, AutoScalingGroupName, ScalingProcesses, **kwargs):
+        self.asgs[AutoScalingGroupName]['SuspendedProcesses'].difference_update(ScalingProcesses)
+        return {}
+
+    def _autoscaling_create_or_update_tags(self, Tags, **kwargs):
+        for tag in Tags:
+            self.asgs[tag['ResourceId']]['Tags'][tag['Key']] = tag['Value']
+        return {}
+
+    def _autoscaling_delete_tags(self, Tags, **kwargs):
+        for tag in Tags:
+            self.asgs[tag['ResourceId']]['Tags'].pop(tag['Key'], None)
+        return {}
+
+    def _autoscaling_terminate_instance_in_auto_scaling_group(self, InstanceId, ShouldDecrementDesiredCapacity, **kwargs):
+        instance = self.instances[InstanceId]
+        self._terminate_instance(InstanceId)
+        if ShouldDecrementDesiredCapacity:
+            self.asgs[instance['asg']]['DesiredCapacity'] -= 1
+        return {'Activity': {'ActivityId': f'terminate-{InstanceId}', 'StatusCode': 'InProgress'}}
+
+    def _autoscaling_put_warm_pool(self, AutoScalingGroupName, **kwargs):
+        self.asgs[AutoScalingGroupName]['WarmPool'] = dict(kwargs)
+        return {}
+
+    def _autoscaling_delete_warm_pool(self, AutoScalingGroupName, **kwargs):
+        self.asgs[AutoScalingGroupName]['WarmPool'] = dict(self.asgs[AutoScalingGroupName]['WarmPool'], Status='PendingDelete')
+        for instance_id in self._warm_instances(AutoScalingGroupName):
+            self.instances[instance_id]['terminating_at'] = self.now()
+        return {}
+
+    def _autoscaling_put_lifecycle_hook(self, AutoScalingGroupName, LifecycleHookName, HeartbeatTimeout=3600, **kwargs):
+        # the heartbeat timeout is in wall clock seconds, as the tool times its heartbeats against it
+        self.asgs[AutoScalingGroupName]['LifecycleHooks'][LifecycleHookName] = HeartbeatTimeout / self.time_scale
+        return {}
+
+    def _autoscaling_delete_lifecycle_hook(self, AutoScalingGroupName, LifecycleHookName, **kwargs):
+        self.asgs[AutoScalingGroupName]['LifecycleHooks'].pop(LifecycleHookName, None)
+        return {}
+
+    def _autoscaling_record_lifecycle_action_heartbeat(self, AutoScalingGroupName, LifecycleHookName, InstanceId, **kwargs):
+        instance = self.instances[InstanceId]
+        if instance['held_at'] is not None:
+            instance['held_at'] = self.now()
+        return {}
+
+    def _autoscaling_complete_lifecycle_action(self, AutoScalingGroupName, LifecycleHookName, InstanceId, **kwargs):
+        self._release_instance(InstanceId)
+        return {}
+
+    def _autoscaling_start_instance_refresh(self, AutoScalingGroupName, Preferences=None, **kwargs):
+        asg = self.asgs[AutoScalingGroupName]
+        preferences = Preferences or {}
+        refresh = {
+            'InstanceRefreshId': f'refresh-{AutoScalingGroupName}-{len(asg["InstanceRefreshes"])}',
+            'AutoScalingGroupName': AutoScalingGroupName,
+            'Status': 'InProgress',
+            'PercentageComplete': 0,
+            'MinHealthyPercentage': preferences.get('MinHealthyPercentage', 90),
+            'InstanceWarmup': preferences.get('InstanceWarmup', 0),
+            'SkipMatching': preferences.get('SkipMatching', False),
+            'started_at': self.now(),
+        }
+        refresh['total'] = sum(1 for instance in self.instances.values()
+                               if instance['asg'] == AutoScalingGroupName and self._is_active(instance)
+                               and self._refresh_replaces(refresh, instance))
+        asg['InstanceRefreshes'].insert(0, refresh)
+        return {'InstanceRefreshId': refresh['InstanceRefreshId']}
+
+    def _autoscaling_describe_instance_refreshes(self, AutoScalingGroupName, InstanceRefreshIds=None, **kwargs):
+        refreshes = [refresh for refresh in self.asgs[AutoScalingGroupName]['InstanceRefreshes']
+                     if not InstanceRefreshIds or refresh['InstanceRefreshId'] in InstanceRefreshIds]
+        return {'InstanceRefreshes': [{key: value for key, value in refresh.items()
+                                       if key in ['InstanceRefreshId', 'AutoScalingGroupName', 'Status', 'PercentageComplete']}
+                                      for refresh in refreshes]}
+
+    def _autoscaling_cancel_instance_refresh(self, AutoScalingGroupName, **kwargs):
+        for refresh in self.asgs[AutoScalingGroupName]['InstanceRefreshes']:
+            if refresh['Status'] == 'InProgress':
+                refresh['Status'] = 'Cancelled'
+        return {}
+
+    def _ec2_describe_instances(self, InstanceIds=None, **kwargs):
+        instances = []
+        for instance_id in InstanceIds or self.instances:
+            instance = self.instances[instance_id]
+            instances.append({
+                'InstanceId': instance_id,
+                'LaunchTime': instance['launch_time'],
+                'State': {'Name': self._instance_state(instance)},
+                'Placement': {'AvailabilityZone': instance['az']},
+            })
+        return {'Reservations': [{'Instances': instances}]}
+
+    # Kubernetes API
+
+    def k8s_call(self, operation, func, *args):
+        with self._lock:
+            self.api_calls[f'k8s.{operation}'] += 1
+            self._reconcile()
+            return func(*args)
+
+    def list_nodes(self):
+        now = self.now()
+        items = []
+        for node_name, node in self.nodes.items():
+            instance = self.instances[node['instance_id']]
+            if now < instance['joined_at'] or self._instance_state(instance) == 'terminated':
+                continue
+            items.append(SimpleNamespace(
+                metadata=SimpleNamespace(name=node_name, labels={}, annotations={}),
+                spec=SimpleNamespace(provider_id=f'aws:///{instance["az"]}/{node["instance_id"]}',
+                                     unschedulable=node['unschedulable']),
+                status=SimpleNamespace(conditions=[SimpleNamespace(type='Ready', status='True')]),
+            ))
+        return SimpleNamespace(items=items, metadata=SimpleNamespace(resource_version=str(len(self.api_calls)), _continue=None))
+
+    def patch_node(self, node_name, body):
+        self.nodes[node_name]['unschedulable'] = True
+
+    def delete_node(self, node_name):
+        self.nodes.pop(node_name, None)
+
+    def drain_node(self, node_name):
+        """
+        Evicts the pods of a node, retrying evictions blocked by a PodDisruptionBudget
+        """
+        with self._lock:
+            self.api_calls['k8s.list_pod_for_all_namespaces'] += 1
+            self.api_calls['k8s.create_namespaced_pod_eviction'] += self.profile.pods_per_node
+            drain_seconds = self.profile.drain_seconds
+            if self._random.random() < self.profile.pdb_block_probability:
+                drain_seconds += self.profile.pdb_block_seconds
+                self.api_calls['k8s.create_namespaced_pod_eviction'] += 1
+        self.sleep(drain_seconds)
+
+    @contextmanager
+    def patch(self, **config):
+        """
+        Points the tool at the fake backends for the duration of the with block. config overrides app_config,
+        with durations in simulated seconds
+        """
+        overrides = {'DRY_RUN': False, 'K8S_NODE_WATCH': False, 'ASG_NAMES': [], 'JOURNAL_PATH': '', 'JOURNAL_CONFIGMAP': ''}
+        overrides.update(config)
+        for setting in DURATION_SETTINGS:
+            overrides[setting] = overrides.get(setting, app_config[setting]) * self.time_scale
+        if app_config['AWS_API_RATE_LIMIT'] > 0:
+            overrides['AWS_API_RATE_LIMIT'] = app_config['AWS_API_RATE_LIMIT'] / self.time_scale
+        termination_tracker = InstanceTerminationTracker(
+            overrides.get('GLOBAL_MAX_RETRY', app_config['GLOBAL_MAX_RETRY']), overrides['GLOBAL_HEALTH_WAIT'], False)
+        with ExitStack() as stack:
+            stack.enter_context(patch.dict(app_config, overrides))
+            stack.enter_context(patch.dict(aws_api._buckets, clear=True))
+            stack.enter_context(patch.object(aws, 'client', self.create_client('autoscaling')))
+            stack.enter_context(patch.object(aws, 'ec2_client', self.create_client('ec2')))
+            stack.enter_context(patch('eksrollup.lib.k8s.get_core_v1_api', lambda: InstrumentedApi(FakeCoreV1Api(self))))
+            stack.enter_context(patch('eksrollup.cli.drain_node', self.drain_node))
+            stack.enter_context(patch('eksrollup.cli.termination_tracker', termination_tracker))
+            stack.enter_context(patch('eksrollup.refresh.drain_node', self.drain_node))
+            yield self
+
+
+def simulate(asg_sizes, profile=None, time_scale=0.01, seed=0, quiet=True, **config):
+    """
+    Runs a rolling update of ASGs of the given sizes against a simulated cluster. config overrides app_config,
+    with durations in simulated seconds
+    """
+    from eksrollup.cli import update_asgs
+    from eksrollup.aio import update_asgs_async
+    from eksrollup.refresh import refresh_asgs
+
+    cluster = SimulatedCluster('simulated-cluster', asg_sizes, profile, time_scale, seed)
+    log_level = logger.level
+    if quiet:
+        logger.setLevel(logging.WARNING)
+    try:
+        with cluster.patch(**config):
+            started_at = time.monotonic()
+            asgs = get_asgs(cluster.cluster_name, [])
+            if app_config['INSTANCE_REFRESH']:
+                refresh_asgs(asgs, cluster.cluster_name)
+            elif app_config['ASYNC_ENGINE']:
+                asyncio.run(update_asgs_async(asgs, cluster.cluster_name))
+            else:
+                update_asgs(asgs, cluster.cluster_name)
+            wall_seconds = time.monotonic() - started_at
+    finally:
+        logger.setLevel(log_level)
+    return SimulationResult(wall_seconds / time_scale, wall_seconds, cluster.api_calls, cluster.throttled_calls,
+                            cluster.peak_instances, cluster.outdated_instance_count())
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmarks the cold start latency of the tool, each run being a fresh interpreter. The help command only parses
+its arguments, and the plan command plans a rolling update of a small simulated cluster.
+
+    python -m benchmarks.startup --runs 10 --output startup.json
+    python -m benchmarks.startup --baseline startup.json --tolerance 0.2
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# the arguments of the interpreter run by each command
+COMMANDS = {
+    'help': ['-m', 'eksrollup', '--help'],
+    'plan': ['-m', 'benchmarks.startup', '--plan-child'],
+}
+PLAN_ASG_SIZES = [3, 3]
+
+
+def run_plan_child():
+    """
+    Plans the rolling update of a simulated cluster through the command line entry point, standing in for
+    python -m eksrollup --plan against a real cluster
+    """
+    from eksrollup.cli import main
+    from .simulator import SimulatedCluster
+
+    cluster = SimulatedCluster('simulated-cluster', PLAN_ASG_SIZES)
+    with cluster.patch(K8S_NATIVE_DRAIN=True):
+        main(['--plan', '--cluster_name', cluster.cluster_name])
+
+
+def time_command(command, runs):
+    """
+    Returns the wall clock seconds of each run of a command in a fresh interpreter, without a default AWS
+    region so commands which create AWS clients before they need them fail
+    """
+    env = {key: value for key, value in os.environ.items() if key not in ['AWS_DEFAULT_REGION', 'AWS_REGION']}
+    timings = []
+    for _ in range(runs):
+        started_at = time.perf_counter()
+        subprocess.run([sys.executable] + COMMANDS[command], env=env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - started_at)
+    return timings
+
+
+def run_benchmarks(commands, runs):
+    results = []
+    for command in commands:
+        timings = time_command(command, runs)
+        result = {
+            'command': command,
+            'runs': runs,
+            'min_seconds': round(min(timings), 3),
+            'median_seconds': round(statistics.median(timings), 3),
+        }
+        results.append(result)
+        print('{command:<8} {median_seconds:>7.3f}s median  {min_seconds:>7.3f}s min  over {runs} runs'.format(**result),
+              flush=True)
+    return results
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Returns the commands whose median cold start exceeds that of the baseline by more than tolerance
+    """
+    baseline_results = {result['command']: result for result in baseline}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result['command'])
+        if previous and result['median_seconds'] > previous['median_seconds'] * (1 + tolerance):
+            regressions.append(f'{result["command"]}: median_seconds went from {previous["median_seconds"]} '
+                               f'to {result["median_seconds"]}')
+    return regressions
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark the cold start latency of the command line')
+    parser.add_argument('--commands', nargs='+', choices=sorted(COMMANDS), default=list(COMMANDS),
+                        help='commands to time')
+    parser.add_argument('--runs', type=int, default=5, help='number of times each command is run')
+    parser.add_argument('--output', help='file to write the results to as JSON')
+    parser.add_argument('--baseline', help='JSON results of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction by which a result may exceed the baseline before failing')
+    parser.add_argument('--plan-child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args(args)
+
+    if args.plan_child:
+        run_plan_child()
+        return
+    results = run_benchmarks(args.commands, args.runs)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,150 @@
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from .config import app_config
+from .lib.logger import logger
+from .lib.journal import journal
+from .lib.budget import rollout_budget
+from .lib.metrics import REMAINING_INSTANCES
+from .lib.exceptions import RollingUpdateException
+from .cli import validate_cluster_health_steps, roll_outdated_instance_steps, order_by_availability_zone, \
+    log_drain_timings, get_budgeted_surge, update_asg_steps, plan_rollout, prepare_asgs_steps
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking AWS or k8s call in the executor of the running loop, against the cluster target of the task
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+
+def advance_steps(steps):
+    """
+    Runs a generator of steps up to its next yield. StopIteration can't be raised into a future,
+    so returns whether the generator is done along with the yielded or returned value
+    """
+    try:
+        return False, steps.send(None)
+    except StopIteration as stop:
+        return True, stop.value
+
+
+async def run_steps_async(steps):
+    """
+    Async version of run_steps. The generator is advanced in the executor, as its steps make blocking AWS and
+    k8s calls, while the cluster health waits and sleeps it yields are awaited on the loop
+    """
+    done, value = await run_blocking(advance_steps, steps)
+    while not done:
+        step, args = value
+        if step == 'validate':
+            await run_steps_async(validate_cluster_health_steps(**args))
+        elif step == 'drain':
+            await drain_outdated_instances_async(**args)
+        else:
+            await asyncio.sleep(args)
+        done, value = await run_blocking(advance_steps, steps)
+    return value
+
+
+async def drain_outdated_instances_async(asg_name, outdated_instances, k8s_node_index, decrement_desired_capacity):
+    """
+    Async version of drain_outdated_instances. Up to DRAIN_CONCURRENCY instances are rolled at once,
+    limited to DRAIN_CONCURRENCY_PER_AZ per availability zone when set
+    """
+    drain_semaphore = asyncio.Semaphore(max(app_config['DRAIN_CONCURRENCY'], 1))
+    drain_concurrency_per_az = app_config['DRAIN_CONCURRENCY_PER_AZ']
+    az_semaphores = {}
+    if drain_concurrency_per_az > 0:
+        for outdated in outdated_instances:
+            az_semaphores[outdated.get('AvailabilityZone')] = asyncio.Semaphore(drain_concurrency_per_az)
+    failed = asyncio.Event()
+    timings = {}
+
+    async def roll(outdated):
+        az_semaphore = az_semaphores.get(outdated.get('AvailabilityZone'))
+        if az_semaphore:
+            await az_semaphore.acquire()
+        try:
+            async with drain_semaphore:
+                # stop picking up new instances once one of them has failed
+                if failed.is_set():
+                    return
+                timings[outdated['InstanceId']] = await run_steps_async(
+                    roll_outdated_instance_steps(outdated, k8s_node_index, decrement_desired_capacity))
+                REMAINING_INSTANCES.dec(asg=asg_name)
+        except Exception as drain_exception:
+            logger.info(drain_exception)
+            failed.set()
+        finally:
+            if az_semaphore:
+                az_semaphore.release()
+
+    await asyncio.gather(*(roll(outdated) for outdated in order_by_availability_zone(outdated_instances)))
+    if failed.is_set():
+        raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+    log_drain_timings(asg_name, timings)
+    return timings
+
+
+async def update_asg_async(asg_name, asg_tuple, asg_state, cluster_name, k8s_node_index):
+    """
+    Async version of update_asg
+    """
+    surge_instances = get_budgeted_surge(app_config['RUN_MODE'], len(asg_tuple[0]))
+    await run_blocking(rollout_budget.acquire_surge, surge_instances)
+    try:
+        await run_steps_async(update_asg_steps(asg_name, asg_tuple, asg_state, cluster_name, k8s_node_index))
+    finally:
+        rollout_budget.release_surge(surge_instances)
+
+
+async def update_asgs_async(asgs, cluster_name):
+    """
+    Async version of update_asgs. Blocking AWS and k8s calls run in a thread pool sized to the number of
+    instances which can be rolled at once, while health check waits only sleep on the event loop
+    """
+    run_mode = app_config['RUN_MODE']
+    asg_concurrency = max(app_config['ASG_CONCURRENCY'], 1)
+    loop = asyncio.get_running_loop()
+    # every rolled instance blocks a thread while draining, plus one for each ASG being scaled or validated
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=asg_concurrency * (max(app_config['DRAIN_CONCURRENCY'], 1) + 1)))
+
+    asg_outdated_instance_dict = await run_blocking(plan_rollout, asgs, cluster_name)
+    planned_instance_count = sum(len(outdated_instances) for outdated_instances, _ in asg_outdated_instance_dict.values())
+    # the ASGs of RUN_MODE 2 are all surged up front and stay surged until the last one is rolled
+    surge_instances = planned_instance_count if run_mode == 2 else 0
+    await run_blocking(rollout_budget.acquire_surge, surge_instances)
+    try:
+        asg_outdated_instance_dict, asg_state_dict, k8s_node_index = await run_steps_async(
+            prepare_asgs_steps(asg_outdated_instance_dict, cluster_name))
+
+        # Drain, Delete and Terminate the outdated nodes and return the ASGs back to their original state
+        if asg_concurrency <= 1:
+            for asg_name, asg_tuple in asg_outdated_instance_dict.items():
+                await update_asg_async(asg_name, asg_tuple, asg_state_dict.get(asg_name), cluster_name, k8s_node_index)
+        else:
+            # A failure in one ASG is logged and does not stop the others from completing
+            logger.info(f'Rolling up to {asg_concurrency} ASGs concurrently...')
+            asg_semaphore = asyncio.Semaphore(asg_concurrency)
+            failed_asgs = []
+
+            async def update(asg_name, asg_tuple):
+                async with asg_semaphore:
+                    try:
+                        await update_asg_async(asg_name, asg_tuple, asg_state_dict.get(asg_name), cluster_name, k8s_node_index)
+                    except (Exception, SystemExit) as asg_exception:
+                        logger.error(f'Rolling update of asg {asg_name} failed: {asg_exception}')
+                        failed_asgs.append(asg_name)
+
+            await asyncio.gather(*(update(asg_name, asg_tuple) for asg_name, asg_tuple in asg_outdated_instance_dict.items()))
+            if failed_asgs:
+                raise RollingUpdateException("Rolling update on ASGs failed", ', '.join(sorted(failed_asgs)))
+    finally:
+        rollout_budget.release_surge(surge_instances)
+    await run_blocking(journal.finish)
+    logger.info('All asgs processed')
+    return planned_instance_count
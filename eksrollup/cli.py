@@ -1,17 +1,103 @@
 import sys
+import json
+import math
+import heapq
 import argparse
 import time
 import shutil
+import threading
+from collections import defaultdict
+from itertools import zip_longest
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from .config import app_config
 from .lib.logger import logger
-from .lib.aws import is_asg_scaled, is_asg_healthy, instance_terminated, get_asg_tag, modify_aws_autoscaling, \
-    count_all_cluster_instances, save_asg_tags, get_asgs, scale_asg, plan_asgs, terminate_instance_in_asg, delete_asg_tags, plan_asgs_older_nodes
+from .lib.aws import termination_tracker, get_asg_tag, save_asg_tags, modify_aws_autoscaling, save_asg_tags_batch, get_asgs, \
+    scale_asg, plan_asgs, terminate_instance_in_asg, delete_asg_tags_batch, plan_asgs_older_nodes, get_asg, asg_scaled, \
+    asg_instances_healthy, count_cluster_instances, get_cluster_snapshot, DesiredCapacityTagWriter, put_warm_pool, \
+    delete_warm_pool, is_warm_pool_deleted, WARM_POOL_SETTINGS
 from .lib.k8s import k8s_nodes_count, k8s_nodes_ready, get_k8s_nodes, modify_k8s_autoscaler, get_node_by_instance_id, \
-    drain_node, delete_node, cordon_node, taint_node
+    drain_node, delete_node, cordon_node, taint_node, get_k8s_node_index, k8s_nodes_healthy, get_node_drain_costs
+from .lib.aws_api import log_api_stats
+from .lib.journal import journal
+from .lib.budget import rollout_budget
+from .lib.target import submit
+from .lib.metrics import NODE_CORDON_SECONDS, NODE_DRAIN_SECONDS, NODE_DELETE_SECONDS, INSTANCE_TERMINATE_SECONDS, \
+    HEALTH_WAIT_SECONDS, OUTDATED_INSTANCES, REMAINING_INSTANCES, start_metrics_server, write_metrics_file, \
+    read_histogram_totals
 from .lib.exceptions import RollingUpdateException
 
+# estimated seconds to drain a node when there are no timings of a previous run
+DEFAULT_DRAIN_SECONDS = 60
+
+
+def check_cluster_snapshot(asg_name, new_desired_asg_capacity, cluster_name, predictive, asgs, k8s_nodes):
+    """
+    Evaluates the ASG and cluster health checks against a snapshot of the cluster ASGs and nodes.
+    Returns None if the ASG has not scaled, otherwise whether the cluster is healthy
+    """
+    asg = next((asg for asg in asgs if asg['AutoScalingGroupName'] == asg_name), None) or get_asg(asg_name)
+
+    # check if asg has enough nodes first before checking instance health
+    if not asg_scaled(asg, new_desired_asg_capacity):
+        logger.info(f'Validation failed for asg {asg_name}. Not enough instances online.')
+        return None
+
+    # check for instances in ASG to become healthy
+    if not asg_instances_healthy(asg):
+        logger.info(f'Validation failed for asg {asg_name}. Some instances not yet healthy.')
+        return False
+
+    # check for desired amount of k8s nodes to come online within the cluster
+    desired_k8s_node_count = count_cluster_instances(asgs, get_k8s_node_index(k8s_nodes), predictive=predictive)
+    if app_config['K8S_NODE_WATCH']:
+        # wait on the node watch rather than the snapshot, for no longer than one attempt of the caller's retries
+        deadline = time.time() + app_config['GLOBAL_HEALTH_WAIT']
+        return k8s_nodes_count(desired_k8s_node_count, 1, app_config['GLOBAL_HEALTH_WAIT']) and \
+            k8s_nodes_ready(1, max(deadline - time.time(), 0))
+    if len(k8s_nodes) != desired_k8s_node_count:
+        logger.info(f'Validation failed for cluster {cluster_name}. Didn\'t reach expected node count {desired_k8s_node_count}.')
+        return False
+
+    # check for nodes to become ready
+    if not k8s_nodes_healthy(k8s_nodes):
+        logger.info('Validation failed for cluster. Expected node count reached but nodes are not ready.')
+        return False
+    return True
+
+
+def cluster_snapshot_healthy(asg_name, new_desired_asg_capacity, cluster_name, predictive):
+    return run_steps(cluster_snapshot_healthy_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive))
+
+
+def cluster_snapshot_healthy_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive):
+    """
+    Evaluates the ASG and cluster health checks against one snapshot of the cluster ASGs and nodes per attempt,
+    retrying up to GLOBAL_MAX_RETRY times while instances or nodes are still coming up.
+    Yields ('sleep', seconds) steps between attempts
+    """
+    max_retry = app_config['GLOBAL_MAX_RETRY']
+    wait = app_config['GLOBAL_HEALTH_WAIT']
+    retry_count = 1
+    while retry_count < max_retry:
+        retry_count += 1
+        asgs, k8s_nodes = get_cluster_snapshot(cluster_name)
+        healthy = check_cluster_snapshot(asg_name, new_desired_asg_capacity, cluster_name, predictive, asgs, k8s_nodes)
+        if healthy is not False:
+            return bool(healthy)
+        yield 'sleep', wait
+    return False
+
 
 def validate_cluster_health(asg_name, new_desired_asg_capacity, cluster_name, predictive, health_check_type="regular",):
+    run_steps(validate_cluster_health_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive, health_check_type))
+
+
+def validate_cluster_health_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive, health_check_type="regular"):
+    with HEALTH_WAIT_SECONDS.time(asg=asg_name):
+        yield from wait_for_cluster_health_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive, health_check_type)
+
+
+def wait_for_cluster_health_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive, health_check_type):
     cluster_health_retry = app_config['CLUSTER_HEALTH_RETRY']
     cluster_health_wait = app_config['CLUSTER_HEALTH_WAIT']
     retry_count = 0
@@ -23,27 +109,9 @@ def validate_cluster_health(asg_name, new_desired_asg_capacity, cluster_name, pr
         else:
             logger.info(f'Waiting for {cluster_health_wait} seconds before validating cluster health...')
 
-        time.sleep(cluster_health_wait)
-
-        # check if asg has enough nodes first before checking instance health
-        if not is_asg_scaled(asg_name, new_desired_asg_capacity):
-            logger.info(f'Validation failed for asg {asg_name}. Not enough instances online.')
-            continue
-
-        # wait and check for instances in ASG to become healthy
-        if not is_asg_healthy(asg_name):
-            logger.info(f'Validation failed for asg {asg_name}. Some instances not yet healthy.')
-            continue
-
-        # wait and check for desired amount of k8s nodes to come online within the cluster
-        desired_k8s_node_count = count_all_cluster_instances(cluster_name, predictive=predictive)
-        if not k8s_nodes_count(desired_k8s_node_count):
-            logger.info(f'Validation failed for cluster {cluster_name}. Didn\'t reach expected node count {desired_k8s_node_count}.')
-            continue
+        yield 'sleep', cluster_health_wait
 
-        # Wait and check for nodes to become ready
-        if not k8s_nodes_ready():
-            logger.info('Validation failed for cluster. Expected node count reached but nodes are not ready.')
+        if not (yield from cluster_snapshot_healthy_steps(asg_name, new_desired_asg_capacity, cluster_name, predictive)):
             continue
 
         logger.info('Cluster validation passed. Proceeding with node draining and termination...')
@@ -53,7 +121,36 @@ def validate_cluster_health(asg_name, new_desired_asg_capacity, cluster_name, pr
     raise Exception('ASG healthcheck failed')
 
 
+def run_steps(steps):
+    """
+    Runs a generator of rollout steps on the calling thread: ('validate', validate_cluster_health arguments),
+    ('drain', drain_outdated_instances arguments) and ('sleep', seconds). The rollout logic is written as such
+    generators so the async engine can run the same steps, awaiting the waits instead.
+    Returns the value the generator returns
+    """
+    try:
+        step, args = next(steps)
+        while True:
+            if step == 'validate':
+                validate_cluster_health(**args)
+            elif step == 'drain':
+                drain_outdated_instances(**args)
+            else:
+                time.sleep(args)
+            step, args = steps.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+
 def scale_up_asg(cluster_name, asg, count):
+    return run_steps(scale_up_asg_steps(cluster_name, asg, count))
+
+
+def scale_up_asg_steps(cluster_name, asg, count):
+    """
+    Scales up an ASG by count instances, yielding ('validate', validate_cluster_health arguments) whenever the
+    cluster health needs validating before going on. Returns the desired, original and original max capacity of the ASG
+    """
     asg_old_max_size = asg['MaxSize']
     asg_old_desired_capacity = asg['DesiredCapacity']
     desired_capacity = asg_old_desired_capacity + count
@@ -79,9 +176,11 @@ def scale_up_asg(cluster_name, asg, count):
             return int(asg_tag_desired_capacity.get('Value')), int(asg_tag_orig_capacity.get(
                 'Value')), int(asg_tag_orig_max_capacity.get('Value'))
         else:
-            save_asg_tags(asg_name, app_config["ASG_ORIG_CAPACITY_TAG"], asg_old_desired_capacity)
-            save_asg_tags(asg_name, app_config["ASG_DESIRED_STATE_TAG"], asg_old_desired_capacity)
-            save_asg_tags(asg_name, app_config["ASG_ORIG_MAX_CAPACITY_TAG"], asg_old_max_size)
+            save_asg_tags_batch(asg_name, {
+                app_config["ASG_ORIG_CAPACITY_TAG"]: asg_old_desired_capacity,
+                app_config["ASG_DESIRED_STATE_TAG"]: asg_old_desired_capacity,
+                app_config["ASG_ORIG_MAX_CAPACITY_TAG"]: asg_old_max_size,
+            })
             return asg_old_desired_capacity, asg_old_desired_capacity, asg_old_max_size
 
     # True: use ASG's 'DesiredCapacity' to count the instances
@@ -93,21 +192,27 @@ def scale_up_asg(cluster_name, asg, count):
         logger.info('Found previous desired capacity value tag set on asg from a previous run.')
         logger.info(f'Maintaining previous capacity of {asg_old_desired_capacity} to not overscale.')
 
-        # check cluster health before doing anything
-        validate_cluster_health(
-            asg_name,
-            int(asg_tag_desired_capacity.get('Value')),
-            cluster_name,
-            predictive
-        )
+        if journal.asg_state(asg_name) == 'scaled':
+            logger.info(f'Cluster health was validated for asg {asg_name} by the previous run. Skipping validation.')
+        else:
+            # check cluster health before doing anything
+            yield 'validate', dict(
+                asg_name=asg_name,
+                new_desired_asg_capacity=int(asg_tag_desired_capacity.get('Value')),
+                cluster_name=cluster_name,
+                predictive=predictive
+            )
+            journal.record_asg(asg_name, 'scaled')
 
         return int(asg_tag_desired_capacity.get('Value')), int(asg_tag_orig_capacity.get(
             'Value')), int(asg_tag_orig_max_capacity.get('Value'))
     else:
         logger.info('No previous capacity value tags set on ASG; setting tags.')
-        save_asg_tags(asg_name, app_config["ASG_ORIG_CAPACITY_TAG"], asg_old_desired_capacity)
-        save_asg_tags(asg_name, app_config["ASG_DESIRED_STATE_TAG"], desired_capacity)
-        save_asg_tags(asg_name, app_config["ASG_ORIG_MAX_CAPACITY_TAG"], asg_old_max_size)
+        save_asg_tags_batch(asg_name, {
+            app_config["ASG_ORIG_CAPACITY_TAG"]: asg_old_desired_capacity,
+            app_config["ASG_DESIRED_STATE_TAG"]: desired_capacity,
+            app_config["ASG_ORIG_MAX_CAPACITY_TAG"]: asg_old_max_size,
+        })
 
         old_desired_capacity = asg_old_desired_capacity
 
@@ -130,29 +235,476 @@ def scale_up_asg(cluster_name, asg, count):
                 scale_asg(asg_name, old_desired_capacity, current_capacity, asg_old_max_size)
 
             # check cluster health before doing anything
-            validate_cluster_health(
-                asg_name,
-                current_capacity,
-                cluster_name,
-                predictive,
+            yield 'validate', dict(
+                asg_name=asg_name,
+                new_desired_asg_capacity=current_capacity,
+                cluster_name=cluster_name,
+                predictive=predictive,
                 health_check_type="asg"
             )
             if current_capacity == desired_capacity:
                 break
+        journal.record_asg(asg_name, 'scaled')
     logger.info('Proceeding with node draining and termination...')
     return desired_capacity, asg_old_desired_capacity, asg_old_max_size
 
 
-def update_asgs(asgs, cluster_name):
+def prepare_warm_pool(asg, count):
+    """
+    Makes sure the warm pool of an ASG holds at least count pre-initialized instances, creating a pool of stopped
+    instances if it has none, so the instances it is scaled up by start from the pool instead of booting cold.
+    An existing pool is replaced, as its instances may predate the launch template or configuration being rolled
+    out and would be taken into service without being rolled. The original warm pool settings are saved in a tag,
+    for restore_warm_pool
+    """
+    asg_name = asg['AutoScalingGroupName']
+    if not count:
+        return
+    if asg.get('MixedInstancesPolicy'):
+        logger.info(f'Asg {asg_name} has a mixed instances policy, which warm pools do not support. Skipping warm pool.')
+        return
+    warm_pool = asg.get('WarmPoolConfiguration')
+    pending_delete = bool(warm_pool) and warm_pool.get('Status') == 'PendingDelete'
+    asg_tag_warm_pool = get_asg_tag(asg['Tags'], app_config['ASG_ORIG_WARM_POOL_TAG'])
+    if asg_tag_warm_pool.get('Value'):
+        if warm_pool and not pending_delete:
+            logger.info(f'Found original warm pool tag on asg {asg_name} from a previous run. Leaving warm pool alone.')
+            return
+        # the previous run was stopped while replacing the pool
+        logger.info(f'Found original warm pool tag on asg {asg_name} from a previous run, but not its warm pool.')
+        original_warm_pool = json.loads(asg_tag_warm_pool['Value'])
+    else:
+        original_warm_pool = {key: value for key, value in warm_pool.items() if key in WARM_POOL_SETTINGS} if warm_pool else None
+        save_asg_tags(asg_name, app_config['ASG_ORIG_WARM_POOL_TAG'], json.dumps(original_warm_pool, sort_keys=True))
+    new_warm_pool = dict(original_warm_pool or {'PoolState': 'Stopped'})
+    new_warm_pool['MinSize'] = max(new_warm_pool.get('MinSize', 0), count)
+    # a cap on the instances prepared by the ASG and its pool must leave room for the surge
+    if new_warm_pool.get('MaxGroupPreparedCapacity', -1) >= 0:
+        new_warm_pool['MaxGroupPreparedCapacity'] = max(new_warm_pool['MaxGroupPreparedCapacity'], asg['DesiredCapacity'] + count)
+    if warm_pool:
+        logger.info(f'Replacing the warm pool of asg {asg_name}, whose instances may predate the rolling update...')
+        if not pending_delete:
+            delete_warm_pool(asg_name)
+        # a pool being deleted can't be put again
+        if not is_warm_pool_deleted(asg_name, app_config['GLOBAL_MAX_RETRY'], app_config['GLOBAL_HEALTH_WAIT']):
+            raise RollingUpdateException("Warm pool of asg was not deleted in time", asg_name)
+    put_warm_pool(asg_name, new_warm_pool)
+
+
+def prepare_warm_pools(asg_outdated_instance_dict, run_mode):
+    """
+    Prepares the warm pools of all ASGs with outdated instances before the first one is scaled up, so the pools
+    of the ASGs rolled later are warmed up by the time they are
+    """
+    for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items():
+        prepare_warm_pool(asg, get_surge_capacity(run_mode, len(outdated_instances)))
+
+
+def restore_warm_pool(asg_name):
+    """
+    Restores the warm pool settings saved by prepare_warm_pool, deleting the pool if the ASG had none
+    """
+    asg_tag_warm_pool = get_asg_tag(get_asg(asg_name)['Tags'], app_config['ASG_ORIG_WARM_POOL_TAG'])
+    if not asg_tag_warm_pool.get('Value'):
+        return
+    original_warm_pool = json.loads(asg_tag_warm_pool['Value'])
+    if original_warm_pool:
+        put_warm_pool(asg_name, original_warm_pool)
+    else:
+        delete_warm_pool(asg_name)
+
+
+def get_asg_state_tags():
+    """
+    Returns the keys of the tags which hold the state of an ASG being rolled
+    """
+    # the warm pool tag is cleaned up even without WARM_POOL, in case a run with it was resumed without it
+    return [
+        app_config["ASG_DESIRED_STATE_TAG"],
+        app_config["ASG_ORIG_CAPACITY_TAG"],
+        app_config["ASG_ORIG_MAX_CAPACITY_TAG"],
+        app_config['ASG_ORIG_WARM_POOL_TAG'],
+    ]
+
+
+def cordons_up_front(run_mode):
+    """
+    Returns True if the outdated nodes of all ASGs are cordoned before any of them is drained, so evicted pods
+    are only rescheduled onto new nodes. RUN_MODE 1 and 4 otherwise cordon the nodes of each ASG once it is scaled up
+    """
+    return run_mode in (2, 3) or app_config['PRIORITY_DRAIN']
+
+
+def prioritize_outdated_instances(asg_outdated_instance_dict, k8s_node_index):
+    """
+    Orders the outdated instances of each ASG by the cost of draining their node, from a single listing of the
+    pods of the cluster: nodes whose pods are held by PodDisruptionBudgets with no disruptions left go last so
+    they don't hold up drain slots while other nodes can go, and lighter nodes go first so instances are freed
+    sooner. Instances are then interleaved across availability zones
+    """
+    node_names = [k8s_node_index[outdated['InstanceId']] for outdated_instances, _ in asg_outdated_instance_dict.values()
+                  for outdated in outdated_instances if outdated['InstanceId'] in k8s_node_index]
+    drain_costs = get_node_drain_costs(node_names)
+    prioritized = {}
+    for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items():
+        ordered = sorted(outdated_instances, key=lambda outdated: drain_costs.get(k8s_node_index.get(outdated['InstanceId']), (0, 0)))
+        ordered = order_by_availability_zone(ordered)
+        for outdated in ordered:
+            node_name = k8s_node_index.get(outdated['InstanceId'])
+            blocked_pods, pod_count = drain_costs.get(node_name, (0, 0))
+            logger.info(f'Instance {outdated["InstanceId"]} (node {node_name}) of asg {asg_name}: {pod_count} pods to evict, '
+                        f'{blocked_pods} held by PodDisruptionBudgets')
+        prioritized[asg_name] = ordered, asg
+    return prioritized
+
+
+def cordon_outdated_nodes(outdated_instances, k8s_node_index):
+    """
+    Cordons or taints the k8s nodes backing a list of outdated instances
+    """
+    for outdated in outdated_instances:
+        node_name = ""
+        if journal.reached(outdated['InstanceId'], 'cordoned'):
+            continue
+        try:
+            # get the k8s node name instead of instance id
+            node_name = get_node_by_instance_id(k8s_node_index, outdated['InstanceId'])
+            with NODE_CORDON_SECONDS.time():
+                if not app_config["TAINT_NODES"]:
+                    cordon_node(node_name)
+                else:
+                    taint_node(node_name)
+            journal.record(outdated['InstanceId'], 'cordoned')
+        except Exception as exception:
+            logger.error(f"Encountered an error when adding taint/cordoning node {node_name}")
+            logger.error(exception)
+            exit(1)
+
+
+def roll_outdated_instance(outdated, k8s_node_index, decrement_desired_capacity):
+    return run_steps(roll_outdated_instance_steps(outdated, k8s_node_index, decrement_desired_capacity))
+
+
+def roll_outdated_instance_steps(outdated, k8s_node_index, decrement_desired_capacity):
+    """
+    Drains, deletes and terminates a single outdated instance, yielding a ('sleep', seconds) step for
+    BETWEEN_NODES_WAIT. Returns the time spent draining and in total
+    """
+    use_asg_termination_policy = app_config['ASG_USE_TERMINATION_POLICY']
+    instance_id = outdated['InstanceId']
+    start_time = time.time()
+    node_name = None
+    # skip the steps a previous run already went through for this instance
+    if not journal.reached(instance_id, 'deleted'):
+        # get the k8s node name instead of instance id
+        node_name = get_node_by_instance_id(k8s_node_index, instance_id)
+        if not journal.reached(instance_id, 'drained'):
+            with rollout_budget.drain():
+                drain_node(node_name)
+            NODE_DRAIN_SECONDS.observe(time.time() - start_time)
+            journal.record(instance_id, 'drained')
+    drain_duration = time.time() - start_time
+    if node_name:
+        with NODE_DELETE_SECONDS.time():
+            delete_node(node_name)
+        # recorded ahead of the decrement so a resumed run never decrements twice. An interruption in between
+        # leaves the asg one instance above its original capacity, rather than one below
+        journal.record(instance_id, 'deleted')
+        decrement_desired_capacity()
+    # terminate/detach outdated instances only if ASG termination policy is ignored
+    if not use_asg_termination_policy:
+        with INSTANCE_TERMINATE_SECONDS.time():
+            terminate_instance_in_asg(instance_id)
+            terminated = termination_tracker.wait_for(instance_id)
+        if not terminated:
+            raise Exception('Instance is failing to terminate. Cancelling out.')
+        journal.record(instance_id, 'terminated')
+
+        between_nodes_wait = app_config['BETWEEN_NODES_WAIT']
+        if between_nodes_wait != 0:
+            logger.info(f'Waiting for {between_nodes_wait} seconds before continuing...')
+            yield 'sleep', between_nodes_wait
+    total_duration = time.time() - start_time
+    logger.info(f'Instance {instance_id} (node {node_name}) drained in {drain_duration:.1f}s, rolled in {total_duration:.1f}s')
+    return drain_duration, total_duration
+
+
+def order_by_availability_zone(outdated_instances):
+    """
+    Interleaves outdated instances across availability zones so parallel drains are spread evenly
+    """
+    instances_by_az = defaultdict(list)
+    for outdated in outdated_instances:
+        instances_by_az[outdated.get('AvailabilityZone')].append(outdated)
+    ordered = []
+    for instances in zip_longest(*instances_by_az.values()):
+        ordered.extend(instance for instance in instances if instance is not None)
+    return ordered
+
+
+def drain_outdated_instances(asg_name, outdated_instances, k8s_node_index, decrement_desired_capacity):
+    """
+    Drains and terminates the outdated instances of an ASG. Up to DRAIN_CONCURRENCY instances are rolled in
+    parallel, limited to DRAIN_CONCURRENCY_PER_AZ per availability zone when set
+    """
+    drain_concurrency = app_config['DRAIN_CONCURRENCY']
+    drain_concurrency_per_az = app_config['DRAIN_CONCURRENCY_PER_AZ']
+    timings = {}
+
+    if drain_concurrency <= 1:
+        for outdated in outdated_instances:
+            # catch any failures so we can resume aws autoscaling
+            try:
+                timings[outdated['InstanceId']] = roll_outdated_instance(outdated, k8s_node_index, decrement_desired_capacity)
+                REMAINING_INSTANCES.dec(asg=asg_name)
+            except Exception as drain_exception:
+                logger.info(drain_exception)
+                raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+        return timings
+
+    az_semaphores = {}
+    if drain_concurrency_per_az > 0:
+        for outdated in outdated_instances:
+            az_semaphores[outdated.get('AvailabilityZone')] = threading.BoundedSemaphore(drain_concurrency_per_az)
+    failed = threading.Event()
+
+    def roll(outdated):
+        semaphore = az_semaphores.get(outdated.get('AvailabilityZone'))
+        if semaphore:
+            semaphore.acquire()
+        try:
+            # stop picking up new instances once one of them has failed
+            if failed.is_set():
+                return None
+            timing = roll_outdated_instance(outdated, k8s_node_index, decrement_desired_capacity)
+            REMAINING_INSTANCES.dec(asg=asg_name)
+            return timing
+        except Exception:
+            failed.set()
+            raise
+        finally:
+            if semaphore:
+                semaphore.release()
+
+    logger.info(f'Rolling up to {drain_concurrency} instances of asg {asg_name} concurrently...')
+    with ThreadPoolExecutor(max_workers=drain_concurrency) as executor:
+        futures = {submit(executor, roll, outdated): outdated['InstanceId'] for outdated in order_by_availability_zone(outdated_instances)}
+        for future in as_completed(futures):
+            try:
+                timing = future.result()
+                if timing:
+                    timings[futures[future]] = timing
+            except Exception as drain_exception:
+                logger.info(drain_exception)
+    if failed.is_set():
+        raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+    log_drain_timings(asg_name, timings)
+    return timings
+
+
+def log_drain_timings(asg_name, timings):
+    if timings:
+        drain_durations = [drain_duration for drain_duration, _ in timings.values()]
+        logger.info(f'Drained {len(timings)} nodes of asg {asg_name}: '
+                    f'min {min(drain_durations):.1f}s, max {max(drain_durations):.1f}s, '
+                    f'mean {sum(drain_durations) / len(drain_durations):.1f}s')
+
+
+def surge_enabled(run_mode):
+    """
+    Returns True if the outdated instances of each ASG are rolled in MAX_SURGE batches
+    """
+    if app_config['MAX_SURGE'] <= 0 or run_mode == 2:
+        return False
+    if app_config['ASG_USE_TERMINATION_POLICY']:
+        logger.info('MAX_SURGE is ignored as instances are terminated by the ASG termination policy')
+        return False
+    return True
+
+
+def get_surge_capacity(run_mode, outdated_instance_count):
+    """
+    Returns the number of instances an ASG is scaled up by at most to roll its outdated instances
+    """
+    if surge_enabled(run_mode):
+        return min(app_config['MAX_SURGE'], outdated_instance_count)
+    return outdated_instance_count
+
+
+def surge_outdated_instances_steps(cluster_name, asg, outdated_instances, k8s_node_index):
+    """
+    Rolls the outdated instances of an ASG in batches of up to MAX_SURGE instances. The ASG is scaled up by one
+    batch at a time and the outdated instances of the batch are drained and terminated as soon as the new nodes
+    are ready, so the ASG never runs more than MAX_SURGE instances above its original capacity.
+    Yields ('validate', validate_cluster_health arguments) and ('drain', drain_outdated_instances arguments)
+    steps. Returns the desired, original and original max capacity of the ASG
+    """
+    run_mode = app_config['RUN_MODE']
+    max_surge = app_config['MAX_SURGE']
+    asg_name = asg['AutoScalingGroupName']
+    asg_tags = asg['Tags']
+    asg_tag_desired_capacity = get_asg_tag(asg_tags, app_config["ASG_DESIRED_STATE_TAG"])
+    asg_tag_orig_capacity = get_asg_tag(asg_tags, app_config["ASG_ORIG_CAPACITY_TAG"])
+    asg_tag_orig_max_capacity = get_asg_tag(asg_tags, app_config["ASG_ORIG_MAX_CAPACITY_TAG"])
+
+    if asg_tag_desired_capacity.get('Value'):
+        logger.info('Found previous capacity value tags set on asg from a previous run.')
+        asg_orig_desired_capacity = int(asg_tag_orig_capacity.get('Value'))
+        asg_orig_max_capacity = int(asg_tag_orig_max_capacity.get('Value'))
+    else:
+        logger.info('No previous capacity value tags set on ASG; setting tags.')
+        asg_orig_desired_capacity = asg['DesiredCapacity']
+        asg_orig_max_capacity = asg['MaxSize']
+        save_asg_tags_batch(asg_name, {
+            app_config["ASG_ORIG_CAPACITY_TAG"]: asg_orig_desired_capacity,
+            app_config["ASG_DESIRED_STATE_TAG"]: asg_orig_desired_capacity,
+            app_config["ASG_ORIG_MAX_CAPACITY_TAG"]: asg_orig_max_capacity,
+        })
+
+    current_capacity = asg['DesiredCapacity']
+    remaining_instances = list(outdated_instances)
+    while remaining_instances:
+        batch, remaining_instances = remaining_instances[:max_surge], remaining_instances[max_surge:]
+        # capacity surged by an interrupted run is still in flight, so only add what the batch is missing
+        new_capacity = max(current_capacity, asg_orig_desired_capacity + len(batch))
+        logger.info(f'Surging asg {asg_name} to {new_capacity} instances to roll {len(batch)} outdated instances, '
+                    f'{len(remaining_instances)} left after this batch.')
+        modify_aws_autoscaling(asg_name, "resume")
+        if new_capacity > current_capacity:
+            save_asg_tags(asg_name, app_config["ASG_DESIRED_STATE_TAG"], new_capacity)
+            scale_asg(asg_name, current_capacity, new_capacity, max(new_capacity, asg_orig_max_capacity))
+            current_capacity = new_capacity
+
+        # drain the batch as soon as its replacements are ready
+        yield 'validate', dict(
+            asg_name=asg_name,
+            new_desired_asg_capacity=current_capacity,
+            cluster_name=cluster_name,
+            predictive=False,
+            health_check_type="asg"
+        )
+        if not cordons_up_front(run_mode):
+            cordon_outdated_nodes(batch, k8s_node_index)
+        # suspend 'Launch' and 'ReplaceUnhealthy' to avoid instances being spawned during terminate phase
+        modify_aws_autoscaling(asg_name, "suspend")
+        desired_capacity_tag = DesiredCapacityTagWriter(asg_name, current_capacity)
+        yield 'drain', dict(
+            asg_name=asg_name,
+            outdated_instances=batch,
+            k8s_node_index=k8s_node_index,
+            decrement_desired_capacity=desired_capacity_tag.decrement
+        )
+        # each termination decremented the desired capacity of the asg
+        current_capacity -= len(batch)
+
+    return current_capacity, asg_orig_desired_capacity, asg_orig_max_capacity
+
+
+def surge_outdated_instances(cluster_name, asg, outdated_instances, k8s_node_index):
+    return run_steps(surge_outdated_instances_steps(cluster_name, asg, outdated_instances, k8s_node_index))
+
+
+def get_budgeted_surge(run_mode, outdated_instance_count):
+    """
+    Returns the surge instances an ASG takes from the rollout budget while it is rolled. The ASGs of RUN_MODE 2
+    are all surged together up front, so their surge is taken for the whole rollout instead
+    """
+    return 0 if run_mode == 2 else get_surge_capacity(run_mode, outdated_instance_count)
+
+
+def update_asg(asg_name, asg_tuple, asg_state, cluster_name, k8s_node_index):
+    """
+    Runs the scale up, drain, terminate and scale down sequence for a single ASG
+    """
+    with rollout_budget.surge(get_budgeted_surge(app_config['RUN_MODE'], len(asg_tuple[0]))):
+        run_steps(update_asg_steps(asg_name, asg_tuple, asg_state, cluster_name, k8s_node_index))
+
+
+def update_asg_steps(asg_name, asg_tuple, asg_state, cluster_name, k8s_node_index):
+    """
+    Runs the scale up, drain, terminate and scale down sequence for a single ASG, yielding its steps to run_steps
+    """
     run_mode = app_config['RUN_MODE']
     use_asg_termination_policy = app_config['ASG_USE_TERMINATION_POLICY']
 
+    outdated_instances, asg = asg_tuple
+    outdated_instance_count = len(outdated_instances)
+
+    if surge_enabled(run_mode):
+        # scale up, drain and terminate one batch of outdated instances at a time
+        asg_state = yield from surge_outdated_instances_steps(cluster_name, asg, outdated_instances, k8s_node_index)
+    else:
+        if (run_mode == 1) or (run_mode == 3) or (run_mode == 4):
+            logger.info(
+                f'Setting the scale of ASG {asg_name} based on {outdated_instance_count} outdated instances.')
+            asg_state = yield from scale_up_asg_steps(cluster_name, asg, outdated_instance_count)
+
+        if not cordons_up_front(run_mode):
+            cordon_outdated_nodes(outdated_instances, k8s_node_index)
+
+        if len(outdated_instances) != 0:
+            # if ASG termination is ignored then suspend 'Launch' and 'ReplaceUnhealthy'
+            # for this ASG to avoid instances being spawned during terminate/detach phase
+            if not use_asg_termination_policy:
+                modify_aws_autoscaling(asg_name, "suspend")
+
+        # start draining and terminating
+        desired_capacity_tag = DesiredCapacityTagWriter(asg_name, asg_state[0])
+        yield 'drain', dict(
+            asg_name=asg_name,
+            outdated_instances=outdated_instances,
+            k8s_node_index=k8s_node_index,
+            decrement_desired_capacity=desired_capacity_tag.decrement
+        )
+
+    # scaling cluster back down
+    logger.info("Scaling asg back down to original state")
+    asg_desired_capacity, asg_orig_desired_capacity, asg_orig_max_capacity = asg_state
+    scale_asg(asg_name, asg_desired_capacity, asg_orig_desired_capacity, asg_orig_max_capacity)
+    # resume aws autoscaling only if ASG termination policy is ignored
+    if not use_asg_termination_policy:
+        modify_aws_autoscaling(asg_name, "resume")
+    # a pool prepared by a previous run is restored even when it was resumed without WARM_POOL
+    if app_config['WARM_POOL'] or get_asg_tag(asg['Tags'], app_config['ASG_ORIG_WARM_POOL_TAG']).get('Value'):
+        restore_warm_pool(asg_name)
+    # remove aws tag
+    delete_asg_tags_batch(asg_name, get_asg_state_tags())
+    journal.finish_asg(asg_name)
+    write_metrics_file()
+    logger.info(f'*** Rolling update of asg {asg_name} is complete! ***')
+
+
+def plan_rollout(asgs, cluster_name):
+    """
+    Plans the rolling update of the ASGs and records the plan in the journal and metrics, preparing the warm
+    pools of the ASGs when WARM_POOL is set. Returns the outdated instances and ASG of each ASG name
+    """
+    run_mode = app_config['RUN_MODE']
     if run_mode == 4:
         asg_outdated_instance_dict = plan_asgs_older_nodes(asgs)
 
     else:
         asg_outdated_instance_dict = plan_asgs(asgs)
 
+    journal.start(cluster_name)
+    for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items():
+        journal.plan(asg_name, [outdated['InstanceId'] for outdated in outdated_instances])
+        OUTDATED_INSTANCES.set(len(outdated_instances), asg=asg_name)
+        REMAINING_INSTANCES.set(len(outdated_instances), asg=asg_name)
+
+    if app_config['WARM_POOL']:
+        prepare_warm_pools(asg_outdated_instance_dict, run_mode)
+    return asg_outdated_instance_dict
+
+
+def prepare_asgs_steps(asg_outdated_instance_dict, cluster_name):
+    """
+    Readies the ASGs before any of them is rolled: scales them all up in RUN_MODE 2, indexes the nodes by
+    instance id, orders the outdated instances when PRIORITY_DRAIN is set and cordons them when they are cordoned
+    up front. Yields its steps to run_steps. Returns the outdated instances of each ASG in the order they are
+    rolled, the state of the ASGs scaled up and the node index
+    """
+    run_mode = app_config['RUN_MODE']
     asg_state_dict = {}
 
     if run_mode == 2:
@@ -162,130 +714,238 @@ def update_asgs(asgs, cluster_name):
             outdated_instance_count = len(outdated_instances)
             logger.info(
                 f'Setting the scale of ASG {asg_name} based on {outdated_instance_count} outdated instances.')
-            asg_state_dict[asg_name] = scale_up_asg(cluster_name, asg, outdated_instance_count)
+            asg_state_dict[asg_name] = yield from scale_up_asg_steps(cluster_name, asg, outdated_instance_count)
 
-    k8s_nodes = get_k8s_nodes()
-    if (run_mode == 2) or (run_mode == 3):
+    # index the nodes by instance id once for all lookups below
+    k8s_node_index = get_k8s_node_index(get_k8s_nodes(projected=True))
+    if app_config['PRIORITY_DRAIN']:
+        asg_outdated_instance_dict = prioritize_outdated_instances(asg_outdated_instance_dict, k8s_node_index)
+    if cordons_up_front(run_mode):
         for asg_name, asg_tuple in asg_outdated_instance_dict.items():
             outdated_instances, asg = asg_tuple
-            for outdated in outdated_instances:
-                node_name = ""
-                try:
-                    # get the k8s node name instead of instance id
-                    node_name = get_node_by_instance_id(k8s_nodes, outdated['InstanceId'])
-                    if not app_config["TAINT_NODES"]:
-                        cordon_node(node_name)
-                    else:
-                        taint_node(node_name)
-                except Exception as exception:
-                    logger.error(f"Encountered an error when adding taint/cordoning node {node_name}")
-                    logger.error(exception)
-                    exit(1)
-
-    # Drain, Delete and Terminate the outdated nodes and return the ASGs back to their original state
-    for asg_name, asg_tuple in asg_outdated_instance_dict.items():
-        outdated_instances, asg = asg_tuple
-        outdated_instance_count = len(outdated_instances)
+            cordon_outdated_nodes(outdated_instances, k8s_node_index)
+    return asg_outdated_instance_dict, asg_state_dict, k8s_node_index
 
-        if (run_mode == 1) or (run_mode == 3) or (run_mode == 4):
-            logger.info(
-                f'Setting the scale of ASG {asg_name} based on {outdated_instance_count} outdated instances.')
-            asg_state_dict[asg_name] = scale_up_asg(cluster_name, asg, outdated_instance_count)
-
-        if (run_mode == 1) or (run_mode == 4):
-            for outdated in outdated_instances:
-                node_name = ""
-                try:
-                    # get the k8s node name instead of instance id
-                    node_name = get_node_by_instance_id(k8s_nodes, outdated['InstanceId'])
-                    if not app_config["TAINT_NODES"]:
-                        cordon_node(node_name)
-                    else:
-                        taint_node(node_name)
-                except Exception as exception:
-                    logger.error(f"Encountered an error when adding taint/cordoning node {node_name}")
-                    logger.error(exception)
-                    exit(1)
 
-        if len(outdated_instances) != 0:
-            # if ASG termination is ignored then suspend 'Launch' and 'ReplaceUnhealthy'
-            # for this ASG to avoid instances being spawned during terminate/detach phase
-            if not use_asg_termination_policy:
-                modify_aws_autoscaling(asg_name, "suspend")
+def update_asgs(asgs, cluster_name):
+    run_mode = app_config['RUN_MODE']
+    asg_concurrency = app_config['ASG_CONCURRENCY']
+
+    asg_outdated_instance_dict = plan_rollout(asgs, cluster_name)
+    planned_instance_count = sum(len(outdated_instances) for outdated_instances, _ in asg_outdated_instance_dict.values())
+    # the ASGs of RUN_MODE 2 are all surged up front and stay surged until the last one is rolled
+    with rollout_budget.surge(planned_instance_count if run_mode == 2 else 0):
+        asg_outdated_instance_dict, asg_state_dict, k8s_node_index = run_steps(
+            prepare_asgs_steps(asg_outdated_instance_dict, cluster_name))
+
+        # Drain, Delete and Terminate the outdated nodes and return the ASGs back to their original state
+        if asg_concurrency <= 1:
+            for asg_name, asg_tuple in asg_outdated_instance_dict.items():
+                update_asg(asg_name, asg_tuple, asg_state_dict.get(asg_name), cluster_name, k8s_node_index)
+        else:
+            # roll up to ASG_CONCURRENCY ASGs at once. A failure in one ASG is logged and does not stop the
+            # others from completing, so their autoscaling processes are resumed and their tags removed
+            logger.info(f'Rolling up to {asg_concurrency} ASGs concurrently...')
+            failed_asgs = []
+            with ThreadPoolExecutor(max_workers=asg_concurrency) as executor:
+                futures = {
+                    submit(executor, update_asg, asg_name, asg_tuple, asg_state_dict.get(asg_name), cluster_name, k8s_node_index): asg_name
+                    for asg_name, asg_tuple in asg_outdated_instance_dict.items()
+                }
+                for future in as_completed(futures):
+                    asg_name = futures[future]
+                    try:
+                        future.result()
+                    except (Exception, SystemExit) as asg_exception:
+                        logger.error(f'Rolling update of asg {asg_name} failed: {asg_exception}')
+                        failed_asgs.append(asg_name)
+            if failed_asgs:
+                raise RollingUpdateException("Rolling update on ASGs failed", ', '.join(sorted(failed_asgs)))
+    journal.finish()
+    logger.info('All asgs processed')
+    return planned_instance_count
+
+
+def get_phase_estimates():
+    """
+    Returns the estimated seconds of each rollout phase. The mean timings of a previous run are used when its
+    METRICS_FILE exists, otherwise the configured waits
+    """
+    estimates = {
+        'health_wait': app_config['CLUSTER_HEALTH_WAIT'],
+        'drain': DEFAULT_DRAIN_SECONDS,
+        'delete': 0,
+        'terminate': app_config['GLOBAL_HEALTH_WAIT'],
+    }
+    histograms = {
+        'health_wait': HEALTH_WAIT_SECONDS,
+        'drain': NODE_DRAIN_SECONDS,
+        'delete': NODE_DELETE_SECONDS,
+        'terminate': INSTANCE_TERMINATE_SECONDS,
+    }
+    totals = read_histogram_totals()
+    for phase, histogram in histograms.items():
+        total, count = totals.get(histogram.name, (0, 0))
+        if count:
+            estimates[phase] = total / count
+    return estimates
+
+
+def plan_asg_rollout(outdated_instance_count, run_mode, estimates):
+    """
+    Returns the surge capacity an ASG needs to roll its outdated instances and the estimated seconds it takes
+    """
+    if not outdated_instance_count:
+        return 0, 0
+    drain_rounds = math.ceil(outdated_instance_count / max(app_config['DRAIN_CONCURRENCY'], 1))
+    surge_capacity = get_surge_capacity(run_mode, outdated_instance_count)
+    if surge_capacity < outdated_instance_count:
+        health_validations = math.ceil(outdated_instance_count / surge_capacity)
+        drain_rounds = health_validations * math.ceil(surge_capacity / max(app_config['DRAIN_CONCURRENCY'], 1))
+    elif app_config['BATCH_SIZE'] and run_mode != 2:
+        health_validations = math.ceil(outdated_instance_count / app_config['BATCH_SIZE'])
+    else:
+        health_validations = 1
+    node_seconds = estimates['drain'] + estimates['delete'] + estimates['terminate'] + app_config['BETWEEN_NODES_WAIT']
+    return surge_capacity, health_validations * estimates['health_wait'] + drain_rounds * node_seconds
 
-        # start draining and terminating
-        desired_asg_capacity = asg_state_dict[asg_name][0]
-        for outdated in outdated_instances:
-            # catch any failures so we can resume aws autoscaling
-            try:
-                # get the k8s node name instead of instance id
-                node_name = get_node_by_instance_id(k8s_nodes, outdated['InstanceId'])
-                desired_asg_capacity -= 1
-                drain_node(node_name)
-                delete_node(node_name)
-                save_asg_tags(asg_name, app_config["ASG_DESIRED_STATE_TAG"], desired_asg_capacity)
-                # terminate/detach outdated instances only if ASG termination policy is ignored
-                if not use_asg_termination_policy:
-                    terminate_instance_in_asg(outdated['InstanceId'])
-                    if not instance_terminated(outdated['InstanceId']):
-                        raise Exception('Instance is failing to terminate. Cancelling out.')
-
-                    between_nodes_wait = app_config['BETWEEN_NODES_WAIT']
-                    if between_nodes_wait != 0:
-                        logger.info(f'Waiting for {between_nodes_wait} seconds before continuing...')
-                        time.sleep(between_nodes_wait)
-            except Exception as drain_exception:
-                logger.info(drain_exception)
-                raise RollingUpdateException("Rolling update on ASG failed", asg_name)
 
-        # scaling cluster back down
-        logger.info("Scaling asg back down to original state")
-        asg_desired_capacity, asg_orig_desired_capacity, asg_orig_max_capacity = asg_state_dict[asg_name]
-        scale_asg(asg_name, asg_desired_capacity, asg_orig_desired_capacity, asg_orig_max_capacity)
-        # resume aws autoscaling only if ASG termination policy is ignored
-        if not use_asg_termination_policy:
-            modify_aws_autoscaling(asg_name, "resume")
-        # remove aws tag
-        delete_asg_tags(asg_name, app_config["ASG_DESIRED_STATE_TAG"])
-        delete_asg_tags(asg_name, app_config["ASG_ORIG_CAPACITY_TAG"])
-        delete_asg_tags(asg_name, app_config["ASG_ORIG_MAX_CAPACITY_TAG"])
-        logger.info(f'*** Rolling update of asg {asg_name} is complete! ***')
-    logger.info('All asgs processed')
+def build_plan(asgs, cluster_name):
+    """
+    Builds the plan of a rolling update: the outdated instances of each ASG along with the reason each is outdated,
+    the surge capacity each ASG needs and the estimated duration of the rollout
+    """
+    run_mode = app_config['RUN_MODE']
+    reasons = {}
+    if run_mode == 4:
+        asg_outdated_instance_dict = plan_asgs_older_nodes(asgs, reasons)
+    else:
+        asg_outdated_instance_dict = plan_asgs(asgs, reasons)
+
+    estimates = get_phase_estimates()
+    asg_plans = []
+    for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items():
+        surge_capacity, estimated_seconds = plan_asg_rollout(len(outdated_instances), run_mode, estimates)
+        asg_plans.append({
+            'name': asg_name,
+            'desired_capacity': asg['DesiredCapacity'],
+            'max_size': asg['MaxSize'],
+            'outdated_instances': [{
+                'instance_id': outdated['InstanceId'],
+                'availability_zone': outdated.get('AvailabilityZone'),
+                'reason': reasons.get(outdated['InstanceId']),
+            } for outdated in outdated_instances],
+            'surge_capacity': surge_capacity,
+            'estimated_duration_seconds': round(estimated_seconds),
+        })
+
+    # ASGs are rolled ASG_CONCURRENCY at a time, each one as soon as a previous one is done
+    asg_concurrency = max(app_config['ASG_CONCURRENCY'], 1)
+    workers = [0] * min(asg_concurrency, len(asg_plans))
+    for asg_plan in asg_plans:
+        heapq.heapreplace(workers, workers[0] + asg_plan['estimated_duration_seconds'])
+    surge_capacities = sorted((asg_plan['surge_capacity'] for asg_plan in asg_plans), reverse=True)
+    if run_mode == 2:
+        # all ASGs are scaled up before any instance is rolled
+        peak_surge_capacity = sum(surge_capacities)
+    else:
+        peak_surge_capacity = sum(surge_capacities[:asg_concurrency])
+
+    return {
+        'cluster_name': cluster_name,
+        'run_mode': run_mode,
+        'asgs': asg_plans,
+        'outdated_instance_count': sum(len(asg_plan['outdated_instances']) for asg_plan in asg_plans),
+        'peak_surge_capacity': peak_surge_capacity,
+        'estimated_duration_seconds': max(workers, default=0),
+        'phase_estimates_seconds': {phase: round(seconds, 1) for phase, seconds in estimates.items()},
+    }
+
+
+def write_plan(plan, path=None):
+    """
+    Writes a plan as JSON to PLAN_OUTPUT, which is either a file or - for stdout
+    """
+    path = path or app_config['PLAN_OUTPUT']
+    if path == '-':
+        json.dump(plan, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as plan_file:
+            json.dump(plan, plan_file, indent=2)
+        logger.info(f'Wrote the plan to {path}')
+
+
+def run_update(asgs, cluster_name):
+    """
+    Runs the rolling update of the ASGs of a cluster, with the k8s autoscaler paused when enabled.
+    Returns the number of outdated instances which were rolled
+    """
+    if app_config['K8S_AUTOSCALER_ENABLED']:
+        # pause k8s autoscaler
+        modify_k8s_autoscaler("pause")
+    if app_config['INSTANCE_REFRESH']:
+        # imported here as the instance refresh engine is only needed when it is enabled
+        from .refresh import refresh_asgs
+        rolled_instance_count = refresh_asgs(asgs, cluster_name)
+    elif app_config['ASYNC_ENGINE']:
+        # imported here as the async engine builds on the functions of this module, and asyncio is only
+        # worth importing when it is used
+        import asyncio
+        from .aio import update_asgs_async
+        rolled_instance_count = asyncio.run(update_asgs_async(asgs, cluster_name))
+    else:
+        rolled_instance_count = update_asgs(asgs, cluster_name)
+    if app_config['K8S_AUTOSCALER_ENABLED']:
+        # resume autoscaler after asg updated
+        modify_k8s_autoscaler("resume")
+    return rolled_instance_count
 
 
 def main(args=None):
     parser = argparse.ArgumentParser(description='Rolling update on cluster')
-    parser.add_argument('--cluster_name', '-c', required=True,
-                        help='the cluster name to perform rolling update on')
+    target_group = parser.add_mutually_exclusive_group(required=True)
+    target_group.add_argument('--cluster_name', '-c',
+                              help='the cluster name to perform rolling update on')
+    target_group.add_argument('--fleet', '-f',
+                              help='JSON file listing the clusters to perform rolling update on, see Fleet Mode')
     parser.add_argument('--plan', '-p', action='store_const', const=True,
                         help='perform a dry run to see which instances are out of date')
     args = parser.parse_args(args)
-    # check kubectl is installed
+    # check kubectl is installed unless nodes are drained through the api
     kctl = shutil.which('kubectl')
-    if not kctl:
+    if not kctl and not app_config['K8S_NATIVE_DRAIN']:
         logger.info('kubectl is required to be installed before proceeding')
         quit(1)
+    if args.fleet:
+        # imported here as fleet mode builds on the functions of this module
+        from .fleet import load_fleet_targets, run_fleet
+        if not run_fleet(load_fleet_targets(args.fleet), args.plan or app_config['DRY_RUN']):
+            sys.exit(1)
+        return
     filtered_asgs = get_asgs(args.cluster_name)
     run_mode = app_config['RUN_MODE']
+    # write out a structured plan of the dry run
+    if (args.plan or app_config['DRY_RUN']) and app_config['PLAN_OUTPUT']:
+        write_plan(build_plan(filtered_asgs, args.cluster_name))
     # perform a dry run on mode 4 for older nodes
-    if (args.plan or app_config['DRY_RUN']) and (run_mode == 4):
+    elif (args.plan or app_config['DRY_RUN']) and (run_mode == 4):
         plan_asgs_older_nodes(filtered_asgs)
     # perform a dry run on main mode
     elif args.plan or app_config['DRY_RUN']:
         plan_asgs(filtered_asgs)
     else:
         # perform real update
-        if app_config['K8S_AUTOSCALER_ENABLED']:
-            # pause k8s autoscaler
-            modify_k8s_autoscaler("pause")
+        start_metrics_server()
         try:
-            update_asgs(filtered_asgs, args.cluster_name)
-            if app_config['K8S_AUTOSCALER_ENABLED']:
-                # resume autoscaler after asg updated
-                modify_k8s_autoscaler("resume")
+            run_update(filtered_asgs, args.cluster_name)
+            log_api_stats()
+            write_metrics_file()
             logger.info('*** Rolling update of all asg is complete! ***')
         except Exception as e:
             logger.error(e)
+            log_api_stats()
+            write_metrics_file()
             logger.error('*** Rolling update of ASG has failed. Exiting ***')
             logger.error('AWS Auto Scaling Group processes will need resuming manually')
             if app_config['K8S_AUTOSCALER_ENABLED']:
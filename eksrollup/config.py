@@ -1,11 +1,17 @@
 from dotenv import load_dotenv
-from distutils.util import strtobool
 import os
 load_dotenv('{}/.env'.format(os.getcwd()))
 
 
 def str_to_bool(val):
-    return val if type(val) is bool else bool(strtobool(val))
+    # the same truth values as distutils.util.strtobool, without importing distutils on startup
+    if type(val) is bool:
+        return val
+    if val.lower() in ('y', 'yes', 't', 'true', 'on', '1'):
+        return True
+    if val.lower() in ('n', 'no', 'f', 'false', 'off', '0'):
+        return False
+    raise ValueError('invalid truth value {!r}'.format(val))
 
 
 app_config = {
@@ -15,9 +21,14 @@ app_config = {
     'K8S_AUTOSCALER_REPLICAS': int(os.getenv('K8S_AUTOSCALER_REPLICAS', 2)),
     'K8S_CONTEXT': os.getenv('K8S_CONTEXT', None),
     'K8S_PROXY_BYPASS': str_to_bool(os.getenv('K8S_PROXY_BYPASS', False)),
+    'K8S_CONNECTION_POOL_MAXSIZE': int(os.getenv('K8S_CONNECTION_POOL_MAXSIZE', 20)),
+    'K8S_CLIENT_REFRESH_INTERVAL': int(os.getenv('K8S_CLIENT_REFRESH_INTERVAL', 600)),
+    'K8S_NODE_WATCH': str_to_bool(os.getenv('K8S_NODE_WATCH', False)),
+    'K8S_LIST_PAGE_SIZE': int(os.getenv('K8S_LIST_PAGE_SIZE', 500)),
     'ASG_DESIRED_STATE_TAG': os.getenv('ASG_DESIRED_STATE_TAG', 'eks-rolling-update:desired_capacity'),
     'ASG_ORIG_CAPACITY_TAG': os.getenv('ASG_ORIG_CAPACITY_TAG', 'eks-rolling-update:original_capacity'),
     'ASG_ORIG_MAX_CAPACITY_TAG': os.getenv('ASG_ORIG_MAX_CAPACITY_TAG', 'eks-rolling-update:original_max_capacity'),
+    'ASG_ORIG_WARM_POOL_TAG': os.getenv('ASG_ORIG_WARM_POOL_TAG', 'eks-rolling-update:original_warm_pool'),
     'ASG_USE_TERMINATION_POLICY': str_to_bool(os.getenv('ASG_USE_TERMINATION_POLICY', False)),
     'INSTANCE_WAIT_FOR_STOPPING': str_to_bool(os.getenv('INSTANCE_WAIT_FOR_STOPPING', False)),
     'CLUSTER_HEALTH_WAIT': int(os.getenv('CLUSTER_HEALTH_WAIT', 90)),
@@ -27,11 +38,36 @@ app_config = {
     'BETWEEN_NODES_WAIT': int(os.getenv('BETWEEN_NODES_WAIT', 0)),
     'RUN_MODE': int(os.getenv('RUN_MODE', 1)),
     'DRY_RUN': str_to_bool(os.getenv('DRY_RUN', False)),
+    'PLAN_OUTPUT': os.getenv('PLAN_OUTPUT', ''),
     'EXCLUDE_NODE_LABEL_KEYS': os.getenv('EXCLUDE_NODE_LABEL_KEYS', 'spotinst.io/node-lifecycle').split(),
     'EXTRA_DRAIN_ARGS': os.getenv('EXTRA_DRAIN_ARGS', '').split(),
     'MAX_ALLOWABLE_NODE_AGE': int(os.getenv('MAX_ALLOWABLE_NODE_AGE', 6)),
     'TAINT_NODES': str_to_bool(os.getenv('TAINT_NODES', False)),
     'BATCH_SIZE': int(os.getenv('BATCH_SIZE', 0)),
+    'MAX_SURGE': int(os.getenv('MAX_SURGE', 0)),
+    'WARM_POOL': str_to_bool(os.getenv('WARM_POOL', False)),
+    'ASG_CONCURRENCY': int(os.getenv('ASG_CONCURRENCY', 1)),
+    'DRAIN_CONCURRENCY': int(os.getenv('DRAIN_CONCURRENCY', 1)),
+    'DRAIN_CONCURRENCY_PER_AZ': int(os.getenv('DRAIN_CONCURRENCY_PER_AZ', 0)),
+    'PRIORITY_DRAIN': str_to_bool(os.getenv('PRIORITY_DRAIN', False)),
+    'ASYNC_ENGINE': str_to_bool(os.getenv('ASYNC_ENGINE', False)),
+    'INSTANCE_REFRESH': str_to_bool(os.getenv('INSTANCE_REFRESH', False)),
+    'INSTANCE_REFRESH_MIN_HEALTHY': int(os.getenv('INSTANCE_REFRESH_MIN_HEALTHY', 90)),
+    'INSTANCE_REFRESH_WARMUP': int(os.getenv('INSTANCE_REFRESH_WARMUP', 300)),
+    'INSTANCE_REFRESH_HOOK_TIMEOUT': int(os.getenv('INSTANCE_REFRESH_HOOK_TIMEOUT', 900)),
+    'INSTANCE_REFRESH_POLL_WAIT': int(os.getenv('INSTANCE_REFRESH_POLL_WAIT', 10)),
+    'FLEET_CONCURRENCY': int(os.getenv('FLEET_CONCURRENCY', 4)),
+    'FLEET_MAX_DRAINS': int(os.getenv('FLEET_MAX_DRAINS', 0)),
+    'FLEET_MAX_SURGE': int(os.getenv('FLEET_MAX_SURGE', 0)),
     'ENFORCED_DRAINING': str_to_bool(os.getenv('ENFORCED_DRAINING', False)),
-    'ASG_NAMES': os.getenv('ASG_NAMES', '').split()
+    'K8S_NATIVE_DRAIN': str_to_bool(os.getenv('K8S_NATIVE_DRAIN', False)),
+    'K8S_DRAIN_TIMEOUT': int(os.getenv('K8S_DRAIN_TIMEOUT', 600)),
+    'ASG_NAMES': os.getenv('ASG_NAMES', '').split(),
+    'JOURNAL_PATH': os.getenv('JOURNAL_PATH', ''),
+    'JOURNAL_CONFIGMAP': os.getenv('JOURNAL_CONFIGMAP', ''),
+    'METRICS_FILE': os.getenv('METRICS_FILE', ''),
+    'METRICS_PORT': int(os.getenv('METRICS_PORT', 0)),
+    'AWS_RETRY_MODE': os.getenv('AWS_RETRY_MODE', 'adaptive'),
+    'AWS_MAX_ATTEMPTS': int(os.getenv('AWS_MAX_ATTEMPTS', 10)),
+    'AWS_API_RATE_LIMIT': float(os.getenv('AWS_API_RATE_LIMIT', 10))
 }
@@ -0,0 +1,104 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .config import app_config
+from .lib.logger import logger
+from .lib.aws import get_asgs
+from .lib.aws_api import log_api_stats
+from .lib.budget import rollout_budget
+from .lib.metrics import start_metrics_server, write_metrics_file
+from .lib.target import ClusterTarget, TargetLogFilter, use_target, submit
+from .cli import run_update, build_plan, write_plan
+
+_log_filter = TargetLogFilter()
+
+
+def load_fleet_targets(path):
+    """
+    Reads the clusters of a fleet from a JSON list of objects with a cluster_name, and optionally the region
+    and k8s_context to reach the cluster through. The default region and kube context are used when not set
+    """
+    with open(path) as fleet_file:
+        entries = json.load(fleet_file)
+    targets = []
+    for entry in entries:
+        if not entry.get('cluster_name'):
+            raise ValueError(f'Fleet target {entry} has no cluster_name')
+        targets.append(ClusterTarget(entry['cluster_name'], entry.get('region'), entry.get('k8s_context')))
+    return targets
+
+
+def roll_target(target, plan):
+    """
+    Runs the rolling update, or builds the plan, of a single cluster of the fleet. Failures are recorded
+    in the returned result rather than raised, so the other clusters carry on
+    """
+    result = {
+        'cluster_name': target.cluster_name,
+        'region': target.region,
+        'k8s_context': target.k8s_context,
+        'status': 'succeeded',
+        'outdated_instances': None,
+        'duration_seconds': None,
+        'error': None,
+    }
+    start_time = time.time()
+    with use_target(target):
+        try:
+            asgs = get_asgs(target.cluster_name)
+            if plan:
+                result['plan'] = build_plan(asgs, target.cluster_name)
+                result['outdated_instances'] = result['plan']['outdated_instance_count']
+            else:
+                result['outdated_instances'] = run_update(asgs, target.cluster_name)
+                logger.info('*** Rolling update of all asg is complete! ***')
+        except (Exception, SystemExit) as e:
+            logger.error(f'*** Rolling update of cluster {target.cluster_name} has failed: {e} ***')
+            result['status'] = 'failed'
+            result['error'] = getattr(e, 'message', None) or str(e)
+    result['duration_seconds'] = round(time.time() - start_time, 1)
+    return result
+
+
+def log_fleet_report(results):
+    logger.info('Fleet rollout report:')
+    logger.info(f'{"CLUSTER":<32} {"REGION":<16} {"STATUS":<10} {"OUTDATED":>8} {"DURATION":>10}  ERROR')
+    for result in results:
+        outdated_instances = '-' if result['outdated_instances'] is None else result['outdated_instances']
+        logger.info(f'{result["cluster_name"]:<32} {result["region"] or "default":<16} {result["status"]:<10} '
+                    f'{outdated_instances:>8} {result["duration_seconds"]:>9.0f}s  {result["error"] or ""}')
+    failed = [result['cluster_name'] for result in results if result['status'] == 'failed']
+    logger.info(f'{len(results) - len(failed)} of {len(results)} clusters succeeded')
+    if failed:
+        logger.error(f'Rolling update failed on clusters {", ".join(failed)}')
+        logger.error('AWS Auto Scaling Group processes will need resuming manually on the failed clusters')
+        if app_config['K8S_AUTOSCALER_ENABLED']:
+            logger.error('Kubernetes Cluster Autoscaler will need resuming manually on the failed clusters')
+
+
+def run_fleet(targets, plan=False):
+    """
+    Rolls up to FLEET_CONCURRENCY clusters at once, with at most FLEET_MAX_DRAINS nodes draining and
+    FLEET_MAX_SURGE surge instances in flight across all of them. The clusters of a region share their AWS
+    clients. Logs a report of all clusters at the end and returns whether all of them succeeded
+    """
+    fleet_concurrency = max(app_config['FLEET_CONCURRENCY'], 1)
+    rollout_budget.configure(app_config['FLEET_MAX_DRAINS'], app_config['FLEET_MAX_SURGE'])
+    if _log_filter not in logger.filters:
+        logger.addFilter(_log_filter)
+    if not plan:
+        start_metrics_server()
+
+    logger.info(f'Rolling {len(targets)} clusters, up to {fleet_concurrency} at once...')
+    results = [None] * len(targets)
+    with ThreadPoolExecutor(max_workers=fleet_concurrency) as executor:
+        futures = {submit(executor, roll_target, target, plan): i for i, target in enumerate(targets)}
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    if plan and app_config['PLAN_OUTPUT']:
+        write_plan({'clusters': [result['plan'] for result in results if result.get('plan')]})
+    log_api_stats()
+    write_metrics_file()
+    log_fleet_report(results)
+    return all(result['status'] == 'succeeded' for result in results)
@@ -1,13 +1,22 @@
-import boto3
 import time
+import threading
 import datetime
-import requests
+from http import HTTPStatus
 from .logger import logger
+from collections import defaultdict
+from .aws_api import RegionalClient
+from .target import get_target, use_target
 from eksrollup.config import app_config
-from .k8s import get_k8s_nodes, get_node_by_instance_id
+from .k8s import get_k8s_nodes, get_k8s_node_index
 
-client = boto3.client('autoscaling')
-ec2_client = boto3.client('ec2')
+client = RegionalClient('autoscaling')
+ec2_client = RegionalClient('ec2')
+
+DESCRIBE_INSTANCES_BATCH_SIZE = 1000
+# DescribeAutoScalingGroups accepts up to 100 ASG names per call
+DESCRIBE_ASGS_BATCH_SIZE = 100
+# settings of a warm pool configuration which can be passed back to PutWarmPool
+WARM_POOL_SETTINGS = ['MinSize', 'MaxGroupPreparedCapacity', 'PoolState', 'InstanceReusePolicy']
 
 
 def get_all_asgs(cluster_tag):
@@ -20,24 +29,26 @@ def get_all_asgs(cluster_tag):
 def get_asgs(cluster_tag, asg_names=app_config['ASG_NAMES']):
     """
     Queries AWS and find ASG's matching kubernetes.io/cluster/<cluster_tag> = owned
-    If asg_names is not empty, returns only asgs that are inside that list, else return all above asgs
+    If asg_names is not empty, returns only asgs that are inside that list, else return all above asgs.
+    The ASGs are looked up by name, or else filtered by the cluster tag by AWS, rather than describing every ASG
+    of the region
     """
     logger.info('Describing autoscaling groups...')
     paginator = client.get_paginator('describe_auto_scaling_groups')
-    page_iterator = paginator.paginate(
-        PaginationConfig={'PageSize': 100}
-    )
-    asg_query = "AutoScalingGroups[] | [?contains(Tags[?Key==`kubernetes.io/cluster/{}`].Value, `owned`)]".format(cluster_tag)
-    # filter for only asgs with kube cluster tags
-    filtered_asgs = page_iterator.search(asg_query)
     if asg_names:
         # select only asgs provided in asg_names
-        specific_asgs = []
-        for asg in filtered_asgs:
-            if asg['AutoScalingGroupName'] in asg_names:
-                specific_asgs.append(asg)
-        filtered_asgs = specific_asgs
-    return filtered_asgs
+        page_iterators = [paginator.paginate(
+            AutoScalingGroupNames=asg_names[i:i + DESCRIBE_ASGS_BATCH_SIZE],
+            PaginationConfig={'PageSize': 100}
+        ) for i in range(0, len(asg_names), DESCRIBE_ASGS_BATCH_SIZE)]
+    else:
+        page_iterators = [paginator.paginate(
+            Filters=[{'Name': 'tag:kubernetes.io/cluster/{}'.format(cluster_tag), 'Values': ['owned']}],
+            PaginationConfig={'PageSize': 100}
+        )]
+    asg_query = "AutoScalingGroups[] | [?contains(Tags[?Key==`kubernetes.io/cluster/{}`].Value, `owned`)]".format(cluster_tag)
+    # filter for only asgs with kube cluster tags
+    return [asg for page_iterator in page_iterators for asg in page_iterator.search(asg_query)]
 
 
 def get_launch_template(lt_name):
@@ -49,6 +60,56 @@ def get_launch_template(lt_name):
     return response['LaunchTemplates'][0]
 
 
+def get_launch_templates(lt_names):
+    """
+    Queries AWS and returns the details of the given Launch Templates keyed by name
+    """
+    launch_templates = {}
+    if not lt_names:
+        return launch_templates
+    logger.info(f'Describing launch templates {", ".join(lt_names)}...')
+    paginator = ec2_client.get_paginator('describe_launch_templates')
+    try:
+        for launch_template in paginator.paginate(LaunchTemplateNames=lt_names).search('LaunchTemplates[]'):
+            launch_templates[launch_template['LaunchTemplateName']] = launch_template
+    except ec2_client.exceptions.ClientError as e:
+        # a single missing template fails the whole request, so leave them to be described one by one
+        logger.info(f'Could not describe launch templates in bulk: {e}')
+    return launch_templates
+
+
+def resolve_launch_template(lt_name, launch_templates=None):
+    """
+    Returns a Launch Template from the launch_templates cache, describing and caching it when missing
+    """
+    if launch_templates is None:
+        return get_launch_template(lt_name)
+    if lt_name not in launch_templates:
+        launch_templates[lt_name] = get_launch_template(lt_name)
+    return launch_templates[lt_name]
+
+
+def get_asg_launch_template_versions(asg):
+    """
+    Returns the launch template versions of an ASG keyed by launch template name, including the
+    launch templates overridden per instance type in a MixedInstancesPolicy
+    """
+    if 'LaunchTemplate' in asg:
+        lt_spec = asg['LaunchTemplate']
+        return {lt_spec['LaunchTemplateName']: lt_spec['Version']}
+    elif 'MixedInstancesPolicy' in asg:
+        lt_versions = {}
+        mixed_lt = asg['MixedInstancesPolicy']['LaunchTemplate']
+        for override in mixed_lt.get('Overrides', []):
+            override_spec = override.get('LaunchTemplateSpecification', {})
+            if 'LaunchTemplateName' in override_spec:
+                lt_versions[override_spec['LaunchTemplateName']] = override_spec.get('Version', '$Default')
+        lt_spec = mixed_lt['LaunchTemplateSpecification']
+        lt_versions[lt_spec['LaunchTemplateName']] = lt_spec['Version']
+        return lt_versions
+    return {}
+
+
 def terminate_instance_in_asg(instance_id):
     """
     Terminates EC2 instance given an instance ID
@@ -60,7 +121,7 @@ def terminate_instance_in_asg(instance_id):
                 InstanceId=instance_id,
                 ShouldDecrementDesiredCapacity=True
             )
-            if response['ResponseMetadata']['HTTPStatusCode'] == requests.codes.ok:
+            if response['ResponseMetadata']['HTTPStatusCode'] == HTTPStatus.OK:
                 logger.info('Termination signal for instance is successfully sent.')
             else:
                 logger.info('Termination signal for instance has failed. Response code was {}. Exiting.'.format(response['ResponseMetadata']['HTTPStatusCode']))
@@ -71,6 +132,31 @@ def terminate_instance_in_asg(instance_id):
                 raise
 
 
+def get_asg(asg_name):
+    """
+    Queries AWS and returns a single ASG
+    """
+    response = client.describe_auto_scaling_groups(
+        AutoScalingGroupNames=[asg_name], MaxRecords=1
+    )
+    return response['AutoScalingGroups'][0]
+
+
+def asg_instances_healthy(asg):
+    """
+    Checks that all instances of a described ASG have a HealthStatus of healthy
+    """
+    asg_healthy = True
+    for instance in asg['Instances']:
+        logger.info('Instance {} - {}'.format(
+            instance['InstanceId'],
+            instance['HealthStatus']
+        ))
+        if instance['HealthStatus'] != 'Healthy':
+            asg_healthy = False
+    return asg_healthy
+
+
 def is_asg_healthy(asg_name, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_config['GLOBAL_HEALTH_WAIT']):
     """
     Checks that all instances in an ASG have a HealthStatus of healthy. Returns False if not
@@ -78,20 +164,9 @@ def is_asg_healthy(asg_name, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_
     retry_count = 1
     asg_healthy = False
     while retry_count < max_retry:
-        asg_healthy = True
         retry_count += 1
         logger.info('Checking asg {} instance health...'.format(asg_name))
-        response = client.describe_auto_scaling_groups(
-            AutoScalingGroupNames=[asg_name], MaxRecords=1
-        )
-        instances = response['AutoScalingGroups'][0]['Instances']
-        for instance in instances:
-            logger.info('Instance {} - {}'.format(
-                instance['InstanceId'],
-                instance['HealthStatus']
-            ))
-            if instance['HealthStatus'] != 'Healthy':
-                asg_healthy = False
+        asg_healthy = asg_instances_healthy(get_asg(asg_name))
         if asg_healthy:
             break
         time.sleep(wait)
@@ -100,15 +175,12 @@ def is_asg_healthy(asg_name, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_
     return asg_healthy
 
 
-def is_asg_scaled(asg_name, desired_capacity):
+def asg_scaled(asg, desired_capacity):
     """
-    Checks that the number of EC2 instances in an ASG matches desired capacity
+    Checks that the number of EC2 instances in a described ASG matches desired capacity
     """
-    logger.info('Checking asg {} instance count...'.format(asg_name))
-    response = client.describe_auto_scaling_groups(
-        AutoScalingGroupNames=[asg_name], MaxRecords=1
-    )
-    actual_instances = response['AutoScalingGroups'][0]['Instances']
+    asg_name = asg['AutoScalingGroupName']
+    actual_instances = asg['Instances']
     if len(actual_instances) != desired_capacity:
         logger.info('Asg {} does not have enough running instances to proceed'.format(asg_name))
         logger.info('Actual instances: {} Desired instances: {}'.format(
@@ -126,6 +198,14 @@ def is_asg_scaled(asg_name, desired_capacity):
     return is_scaled
 
 
+def is_asg_scaled(asg_name, desired_capacity):
+    """
+    Checks that the number of EC2 instances in an ASG matches desired capacity
+    """
+    logger.info('Checking asg {} instance count...'.format(asg_name))
+    return asg_scaled(get_asg(asg_name), desired_capacity)
+
+
 def modify_aws_autoscaling(asg_name, action):
     """
     Suspends or resumes ASG autoscaling
@@ -148,7 +228,7 @@ def modify_aws_autoscaling(asg_name, action):
             logger.info('Invalid scaling option')
             raise Exception('Invalid scaling option')
 
-        if response['ResponseMetadata']['HTTPStatusCode'] != requests.codes.ok:
+        if response['ResponseMetadata']['HTTPStatusCode'] != HTTPStatus.OK:
             logger.info('AWS asg modification operation did not succeed. Exiting.')
             raise Exception('AWS asg modification operation did not succeed. Exiting.')
     else:
@@ -168,7 +248,7 @@ def scale_asg(asg_name, current_desired_capacity, new_desired_capacity, new_max_
             AutoScalingGroupName=asg_name,
             DesiredCapacity=new_desired_capacity,
             MaxSize=new_max_size)
-        if response['ResponseMetadata']['HTTPStatusCode'] != requests.codes.ok:
+        if response['ResponseMetadata']['HTTPStatusCode'] != HTTPStatus.OK:
             logger.info('AWS scale up operation did not succeed. Exiting.')
             raise Exception('AWS scale up operation did not succeed. Exiting.')
     else:
@@ -179,7 +259,15 @@ def save_asg_tags(asg_name, key, value):
     """
     Adds a tag to asg for later retrieval
     """
-    logger.info('Saving tag to asg key: {}, value : {}...'.format(key, value))
+    return save_asg_tags_batch(asg_name, {key: value})
+
+
+def save_asg_tags_batch(asg_name, tags):
+    """
+    Adds or updates several tags on an asg in a single call
+    """
+    for key, value in tags.items():
+        logger.info('Saving tag to asg key: {}, value : {}...'.format(key, value))
     if not app_config['DRY_RUN']:
         response = client.create_or_update_tags(
             Tags=[
@@ -189,10 +277,10 @@ def save_asg_tags(asg_name, key, value):
                     'ResourceId': asg_name,
                     'ResourceType': 'auto-scaling-group',
                     'PropagateAtLaunch': False
-                },
+                } for key, value in tags.items()
             ]
         )
-        if response['ResponseMetadata']['HTTPStatusCode'] != requests.codes.ok:
+        if response['ResponseMetadata']['HTTPStatusCode'] != HTTPStatus.OK:
             logger.info('AWS asg tag modification operation did not succeed. Exiting.')
             raise Exception('AWS asg tag modification operation did not succeed. Exiting.')
     else:
@@ -205,7 +293,15 @@ def delete_asg_tags(asg_name, key):
     """
     Deletes a tag from asg
     """
-    logger.info('Deleting tag from asg key: {}...'.format(key))
+    return delete_asg_tags_batch(asg_name, [key])
+
+
+def delete_asg_tags_batch(asg_name, keys):
+    """
+    Deletes several tags from an asg in a single call
+    """
+    for key in keys:
+        logger.info('Deleting tag from asg key: {}...'.format(key))
     if not app_config['DRY_RUN']:
         response = client.delete_tags(
             Tags=[
@@ -213,10 +309,10 @@ def delete_asg_tags(asg_name, key):
                     'Key': key,
                     'ResourceId': asg_name,
                     'ResourceType': 'auto-scaling-group'
-                },
+                } for key in keys
             ]
         )
-        if response['ResponseMetadata']['HTTPStatusCode'] != requests.codes.ok:
+        if response['ResponseMetadata']['HTTPStatusCode'] != HTTPStatus.OK:
             logger.info('AWS asg tag modification operation did not succeed. Exiting.')
             raise Exception('AWS asg tag modification operation did not succeed. Exiting.')
     else:
@@ -225,71 +321,283 @@ def delete_asg_tags(asg_name, key):
     return response
 
 
+def put_warm_pool(asg_name, warm_pool):
+    """
+    Creates or updates the warm pool of an asg with the settings of a warm pool configuration
+    """
+    settings = {key: value for key, value in warm_pool.items() if key in WARM_POOL_SETTINGS and value is not None}
+    logger.info('Setting warm pool of asg {} to {}...'.format(asg_name, settings))
+    if not app_config['DRY_RUN']:
+        client.put_warm_pool(AutoScalingGroupName=asg_name, **settings)
+    else:
+        logger.info('Skipping warm pool modification due to dry run flag set')
+
+
+def delete_warm_pool(asg_name):
+    """
+    Deletes the warm pool of an asg along with the instances still in it
+    """
+    logger.info('Deleting warm pool of asg {}...'.format(asg_name))
+    if not app_config['DRY_RUN']:
+        client.delete_warm_pool(AutoScalingGroupName=asg_name, ForceDelete=True)
+    else:
+        logger.info('Skipping warm pool modification due to dry run flag set')
+
+
+def is_warm_pool_deleted(asg_name, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_config['GLOBAL_HEALTH_WAIT']):
+    """
+    Checks that the warm pool of an asg is gone, which takes until the instances in it are terminated.
+    Returns False if it is still there after max_retry checks
+    """
+    retry_count = 1
+    while retry_count < max_retry:
+        retry_count += 1
+        logger.info('Checking warm pool of asg {} is deleted...'.format(asg_name))
+        if 'WarmPoolConfiguration' not in get_asg(asg_name):
+            return True
+        time.sleep(wait)
+    logger.info('Warm pool of asg {} is still being deleted'.format(asg_name))
+    return False
+
+
+def put_termination_lifecycle_hook(asg_name, hook_name, heartbeat_timeout):
+    """
+    Adds a lifecycle hook which holds the terminating instances of an asg in Terminating:Wait until the hook is
+    completed for them, or for heartbeat_timeout seconds after which they are terminated anyway
+    """
+    logger.info('Adding termination lifecycle hook {} to asg {}...'.format(hook_name, asg_name))
+    if not app_config['DRY_RUN']:
+        client.put_lifecycle_hook(
+            LifecycleHookName=hook_name,
+            AutoScalingGroupName=asg_name,
+            LifecycleTransition='autoscaling:EC2_INSTANCE_TERMINATING',
+            HeartbeatTimeout=heartbeat_timeout,
+            DefaultResult='CONTINUE'
+        )
+    else:
+        logger.info('Skipping lifecycle hook modification due to dry run flag set')
+
+
+def delete_lifecycle_hook(asg_name, hook_name):
+    logger.info('Deleting lifecycle hook {} of asg {}...'.format(hook_name, asg_name))
+    if not app_config['DRY_RUN']:
+        client.delete_lifecycle_hook(LifecycleHookName=hook_name, AutoScalingGroupName=asg_name)
+    else:
+        logger.info('Skipping lifecycle hook modification due to dry run flag set')
+
+
+def complete_lifecycle_action(asg_name, hook_name, instance_id):
+    """
+    Lets an instance held in Terminating:Wait by a lifecycle hook go on to be terminated
+    """
+    logger.info('Completing lifecycle hook {} of instance {}...'.format(hook_name, instance_id))
+    if not app_config['DRY_RUN']:
+        client.complete_lifecycle_action(
+            LifecycleHookName=hook_name,
+            AutoScalingGroupName=asg_name,
+            LifecycleActionResult='CONTINUE',
+            InstanceId=instance_id
+        )
+    else:
+        logger.info('Skipping lifecycle action due to dry run flag set')
+
+
+def record_lifecycle_action_heartbeat(asg_name, hook_name, instance_id):
+    """
+    Restarts the heartbeat timeout of a lifecycle hook holding an instance in Terminating:Wait
+    """
+    logger.info('Recording heartbeat of lifecycle hook {} for instance {}...'.format(hook_name, instance_id))
+    if not app_config['DRY_RUN']:
+        client.record_lifecycle_action_heartbeat(
+            LifecycleHookName=hook_name,
+            AutoScalingGroupName=asg_name,
+            InstanceId=instance_id
+        )
+    else:
+        logger.info('Skipping lifecycle action heartbeat due to dry run flag set')
+
+
+def start_instance_refresh(asg_name, preferences):
+    """
+    Starts a rolling instance refresh of an asg and returns its id, or None on a dry run
+    """
+    logger.info('Starting instance refresh of asg {} with preferences {}...'.format(asg_name, preferences))
+    if not app_config['DRY_RUN']:
+        response = client.start_instance_refresh(AutoScalingGroupName=asg_name, Strategy='Rolling', Preferences=preferences)
+        return response['InstanceRefreshId']
+    logger.info('Skipping instance refresh due to dry run flag set')
+    return None
+
+
+def get_instance_refreshes(asg_name, refresh_ids=None):
+    """
+    Returns the instance refreshes of an asg, most recent first
+    """
+    kwargs = {'InstanceRefreshIds': refresh_ids} if refresh_ids else {}
+    return client.describe_instance_refreshes(AutoScalingGroupName=asg_name, **kwargs)['InstanceRefreshes']
+
+
+def get_active_instance_refresh(asg_name):
+    """
+    Returns the instance refresh of an asg which is still replacing instances, e.g. one started by a previous run,
+    or None
+    """
+    for refresh in get_instance_refreshes(asg_name):
+        if refresh['Status'] in ['Pending', 'InProgress']:
+            return refresh
+    return None
+
+
+def cancel_instance_refresh(asg_name):
+    logger.info('Cancelling instance refresh of asg {}...'.format(asg_name))
+    if not app_config['DRY_RUN']:
+        client.cancel_instance_refresh(AutoScalingGroupName=asg_name)
+    else:
+        logger.info('Skipping instance refresh cancellation due to dry run flag set')
+
+
+class DesiredCapacityTagWriter:
+    """
+    Keeps the desired capacity tag of an asg up to date while its instances are rolled, possibly in parallel.
+    Decrements made while a write is in flight are coalesced into the next write, and decrement() only returns
+    once a value at or below its own has been saved, so the tag is always written ahead of a termination.
+    """
+
+    def __init__(self, asg_name, desired_capacity):
+        self.asg_name = asg_name
+        self._desired_capacity = desired_capacity
+        self._saved_capacity = desired_capacity
+        self._writing = False
+        self._condition = threading.Condition()
+
+    def decrement(self):
+        with self._condition:
+            self._desired_capacity -= 1
+            target_capacity = self._desired_capacity
+            while self._saved_capacity > target_capacity:
+                if self._writing:
+                    self._condition.wait()
+                    continue
+                self._writing = True
+                capacity = self._desired_capacity
+                self._condition.release()
+                try:
+                    save_asg_tags(self.asg_name, app_config["ASG_DESIRED_STATE_TAG"], capacity)
+                finally:
+                    self._condition.acquire()
+                    self._writing = False
+                    self._condition.notify_all()
+                self._saved_capacity = capacity
+            return target_capacity
+
+
 def instance_outdated_launchconfiguration(instance_obj, asg_lc_name):
     """
     Checks that the launch configuration on an instance matches a given string
     """
+    return get_launchconfiguration_outdated_reason(instance_obj, asg_lc_name) is not None
+
+
+def get_launchconfiguration_outdated_reason(instance_obj, asg_lc_name):
+    """
+    Returns why the launch configuration on an instance doesn't match a given string, or None if it matches
+    """
     # only one launch config is kept so on some instances it may not actually exist. Making the launch config empty
     lc_name = instance_obj.get('LaunchConfigurationName')
     instance_id = instance_obj['InstanceId']
 
     if lc_name != asg_lc_name:
-        logger.info("Instance id {} launch config of '{}' does not match asg launch config of '{}'".format(instance_id, lc_name, asg_lc_name))
-        return True
+        reason = "launch config of '{}' does not match asg launch config of '{}'".format(lc_name, asg_lc_name)
+        logger.info("Instance id {} {}".format(instance_id, reason))
+        return reason
     else:
         logger.info("Instance id {} : OK ".format(instance_id))
-        return False
+        return None
 
 
-def instance_outdated_launchtemplate(instance_obj, asg_lt_name, asg_lt_version):
+def instance_outdated_launchtemplate(instance_obj, asg_lt_name, asg_lt_version, launch_templates=None):
     """
     Checks that the launch template on an instance matches a given string and version. This is often configured in the
     auto scaling group as $Latest or $Default which we can resolve to an actual version number through the
-    describe_launch_templates boto3 method (wrapped in get_launch_template).
+    describe_launch_templates boto3 method (wrapped in get_launch_template). When a launch_templates cache is
+    given each template is only described once.
+    """
+    return get_launchtemplate_outdated_reason(instance_obj, asg_lt_name, asg_lt_version, launch_templates) is not None
+
+
+def get_launchtemplate_outdated_reason(instance_obj, asg_lt_name, asg_lt_version, launch_templates=None):
+    """
+    Returns why the launch template on an instance doesn't match a given string and version, or None if it matches
     """
     instance_id = instance_obj['InstanceId']
+    reason = None
     try:
         lt_name = instance_obj['LaunchTemplate']['LaunchTemplateName']
         lt_version = int(instance_obj['LaunchTemplate']['Version'])
     except KeyError:
-        logger.info("Instance id {} missing launch template does not match asg launch template of '{}'".format(instance_id, asg_lt_name))
-        return True
+        reason = "missing launch template does not match asg launch template of '{}'".format(asg_lt_name)
+        logger.info("Instance id {} {}".format(instance_id, reason))
+        return reason
 
     if lt_name != asg_lt_name:
-        logger.info("Instance id {} launch template of '{}' does not match asg launch template of '{}'".format(instance_id, lt_name, asg_lt_name))
-        return True
+        reason = "launch template of '{}' does not match asg launch template of '{}'".format(lt_name, asg_lt_name)
     elif asg_lt_version == "$Latest":
-        latest_lt_version = get_launch_template(asg_lt_name)['LatestVersionNumber']
+        latest_lt_version = resolve_launch_template(asg_lt_name, launch_templates)['LatestVersionNumber']
         if lt_version != latest_lt_version:
-            logger.info(
-                "Instance id {} launch template version of '{}' does not match asg launch template version of '{}'".format(instance_id, lt_version, latest_lt_version))
-            return True
+            reason = "launch template version of '{}' does not match asg launch template version of '{}'".format(lt_version, latest_lt_version)
     elif asg_lt_version == "$Default":
-        default_lt_version = get_launch_template(asg_lt_name)['DefaultVersionNumber']
+        default_lt_version = resolve_launch_template(asg_lt_name, launch_templates)['DefaultVersionNumber']
         if lt_version != default_lt_version:
-            logger.info(
-                "Instance id {} launch template version of '{}' does not match asg launch template version of '{}'".format(instance_id, lt_version, default_lt_version))
-            return True
+            reason = "launch template version of '{}' does not match asg launch template version of '{}'".format(lt_version, default_lt_version)
     elif lt_version != int(asg_lt_version):
-        logger.info(f"Instance id {instance_id} has a different launch configuration version to the ASG")
-        return True
+        reason = "launch template version of '{}' does not match asg launch template version of '{}'".format(lt_version, asg_lt_version)
+
+    if reason:
+        logger.info("Instance id {} {}".format(instance_id, reason))
+    else:
+        logger.info("Instance id {} : OK ".format(instance_id))
+    return reason
+
+
+def describe_instances(instance_ids):
+    """
+    Yields the description of each given instance, describing up to 1000 instances per request
+    """
+    paginator = ec2_client.get_paginator('describe_instances')
+    for i in range(0, len(instance_ids), DESCRIBE_INSTANCES_BATCH_SIZE):
+        page_iterator = paginator.paginate(InstanceIds=instance_ids[i:i + DESCRIBE_INSTANCES_BATCH_SIZE])
+        for instance in page_iterator.search('Reservations[].Instances[]'):
+            yield instance
 
-    logger.info("Instance id {} : OK ".format(instance_id))
-    return False
+
+def get_instance_launch_times(instance_ids):
+    """
+    Returns the launch time of each given instance, describing up to 1000 instances per request
+    """
+    return {instance['InstanceId']: instance['LaunchTime'] for instance in describe_instances(instance_ids)}
 
 
-def instance_outdated_age(instance_id, days_fresh):
+def instance_outdated_age(instance_id, days_fresh, instance_launch_time=None):
     """
     Checks the age of an instance against the MAX_ALLOWABLE_NODE_AGE.
+    The launch time is looked up when not given.
     """
+    return get_age_outdated_reason(instance_id, days_fresh, instance_launch_time) is not None
 
-    response = ec2_client.describe_instances(
-        InstanceIds=[
-            instance_id,
-        ]
-    )
 
-    instance_launch_time = response['Reservations'][0]['Instances'][0]['LaunchTime']
+def get_age_outdated_reason(instance_id, days_fresh, instance_launch_time=None):
+    """
+    Returns why an instance is older than days_fresh, or None if it isn't. The launch time is looked up when not given.
+    """
+
+    if instance_launch_time is None:
+        response = ec2_client.describe_instances(
+            InstanceIds=[
+                instance_id,
+            ]
+        )
+
+        instance_launch_time = response['Reservations'][0]['Instances'][0]['LaunchTime']
 
     # gets the age of a node by days only:
     instance_age = ((datetime.datetime.now(instance_launch_time.tzinfo) - instance_launch_time).days)
@@ -298,14 +606,14 @@ def instance_outdated_age(instance_id, days_fresh):
     instance_age_remainder = ((datetime.datetime.now(instance_launch_time.tzinfo) - instance_launch_time).seconds)
 
     if instance_age > days_fresh:
-        logger.info("Instance id {} launch age of '{}' day(s) is older than expected '{}' day(s)".format(instance_id, instance_age, days_fresh))
-        return True
+        reason = "launch age of '{}' day(s) is older than expected '{}' day(s)".format(instance_age, days_fresh)
     elif (instance_age == days_fresh) and (instance_age_remainder > 0):
-        logger.info("Instance id {} is older than expected '{}' day(s) by {} seconds.".format(instance_id, days_fresh, instance_age_remainder))
-        return True
+        reason = "is older than expected '{}' day(s) by {} seconds.".format(days_fresh, instance_age_remainder)
     else:
         logger.info("Instance id {} : OK ".format(instance_id))
-        return False
+        return None
+    logger.info("Instance id {} {}".format(instance_id, reason))
+    return reason
 
 
 def instance_terminated(instance_id, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_config['GLOBAL_HEALTH_WAIT'],
@@ -338,10 +646,137 @@ def instance_terminated(instance_id, max_retry=app_config['GLOBAL_MAX_RETRY'], w
     return is_instance_terminated
 
 
-def plan_asgs(asgs):
-    """
-    Checks to see which asgs are out of date
-    """
+class InstanceTerminationTracker:
+    """
+    Waits for many instances to be terminated or stopped with a single poller, which describes all
+    pending instances in one batched call per region. The poll interval starts short and backs off up to
+    GLOBAL_HEALTH_WAIT while no instance changes state.
+    """
+
+    def __init__(self, max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_config['GLOBAL_HEALTH_WAIT'],
+                 wait_for_stopping=app_config['INSTANCE_WAIT_FOR_STOPPING']):
+        self.max_retry = max_retry
+        self.wait = wait
+        self.wait_for_stopping = wait_for_stopping
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._results = {}
+        self._poller = None
+
+    def track(self, instance_id, callback=None):
+        """
+        Starts tracking an instance. callback(instance_id, state) is called once it is terminated or stopped.
+        Returns an event which is set when the instance is stopped or tracking timed out. An instance which
+        is already tracked keeps its deadline and event, and gets the callback added
+        """
+        with self._lock:
+            if instance_id in self._pending:
+                _, callbacks, event, _ = self._pending[instance_id]
+            else:
+                event = threading.Event()
+                callbacks = []
+                deadline = time.time() + self.get_timeout()
+                self._pending[instance_id] = deadline, callbacks, event, get_target()
+            if callback:
+                callbacks.append(callback)
+            if self._poller is None or not self._poller.is_alive():
+                self._poller = threading.Thread(target=self._poll, daemon=True)
+                self._poller.start()
+        return event
+
+    def wait_for(self, instance_id, callback=None):
+        """
+        Tracks an instance and blocks until it is terminated or stopped. Returns False on timeout
+        """
+        event = self.track(instance_id, callback)
+        # the poller sets the event once the deadline passes, the wait only gives up by itself if the poller died
+        while not event.wait(self.get_timeout() + self.wait):
+            with self._lock:
+                poller_alive = self._poller is not None and self._poller.is_alive()
+            if not poller_alive and not event.is_set():
+                logger.info('Instance {} was not reported terminated in time'.format(instance_id))
+                return False
+        with self._lock:
+            return self._results.get(instance_id, False)
+
+    def get_timeout(self):
+        """
+        Returns the seconds an instance is tracked for before giving up
+        """
+        return max(self.max_retry - 1, 1) * self.wait
+
+    def _poll(self):
+        stop_states = ['terminated', 'stopped']
+        stopping_states = ['shutting-down', 'stopping']
+        min_interval = self.wait / 4
+        interval = min_interval
+        while True:
+            with self._lock:
+                if not self._pending:
+                    self._poller = None
+                    return
+                pending = dict(self._pending)
+                # instances of clusters in other regions are described through the clients of their region
+                targets_by_region = defaultdict(list)
+                for instance_id, (_, _, _, target) in pending.items():
+                    targets_by_region[target.region if target else None].append((instance_id, target))
+            logger.info('Checking {} instances are terminated...'.format(len(pending)))
+            states = {}
+            for region_instances in targets_by_region.values():
+                try:
+                    with use_target(region_instances[0][1]):
+                        region_instance_ids = [instance_id for instance_id, _ in region_instances]
+                        states.update({instance['InstanceId']: instance['State']['Name']
+                                       for instance in describe_instances(region_instance_ids)})
+                except Exception as e:
+                    logger.info('Could not describe instances: {}'.format(e))
+            finished = False
+            for instance_id, (deadline, callbacks, event, _) in pending.items():
+                state = states.get(instance_id)
+                if state in stop_states or (self.wait_for_stopping and state in stopping_states):
+                    logger.info('Instance {} {}!'.format(instance_id, state))
+                    result = True
+                    with self._lock:
+                        callbacks = list(callbacks)
+                    for callback in callbacks:
+                        # a failing callback must not stop the poller, which every other waiter relies on
+                        try:
+                            callback(instance_id, state)
+                        except Exception as e:
+                            logger.info('Callback for instance {} failed: {}'.format(instance_id, e))
+                elif time.time() > deadline:
+                    logger.info('Instance {} is still {}, giving up'.format(instance_id, state))
+                    result = False
+                else:
+                    continue
+                finished = True
+                with self._lock:
+                    del self._pending[instance_id]
+                    self._results[instance_id] = result
+                event.set()
+            # poll again soon after a change, otherwise back off
+            interval = min_interval if finished else min(interval * 2, self.wait)
+            time.sleep(interval)
+
+
+termination_tracker = InstanceTerminationTracker()
+
+
+def plan_asgs(asgs, reasons=None):
+    """
+    Checks to see which asgs are out of date. When a reasons dict is given, it is filled with the reason
+    each outdated instance is out of date, keyed by instance id
+    """
+    # asgs may be a single-use iterator from get_asgs, and is walked twice below
+    asgs = list(asgs)
+    # describe every launch template referenced by a version alias once for all asgs
+    lt_names = set()
+    for asg in asgs:
+        for lt_name, lt_version in get_asg_launch_template_versions(asg).items():
+            if lt_version in ('$Latest', '$Default'):
+                lt_names.add(lt_name)
+    launch_templates = get_launch_templates(sorted(lt_names))
+
     asg_outdated_instance_dict = {}
     for asg in asgs:
         asg_name = asg['AutoScalingGroupName']
@@ -350,6 +785,7 @@ def plan_asgs(asgs):
         asg_lc_name = ""
         asg_lt_name = ""
         asg_lt_version = ""
+        asg_lt_versions = get_asg_launch_template_versions(asg)
         if 'LaunchConfigurationName' in asg:
             launch_type = "LaunchConfiguration"
             asg_lc_name = asg['LaunchConfigurationName']
@@ -370,12 +806,21 @@ def plan_asgs(asgs):
         # return a list of outdated instances
         outdated_instances = []
         for instance in instances:
+            reason = None
             if launch_type == "LaunchConfiguration":
-                if instance_outdated_launchconfiguration(instance, asg_lc_name):
-                    outdated_instances.append(instance)
+                reason = get_launchconfiguration_outdated_reason(instance, asg_lc_name)
             elif launch_type == "LaunchTemplate":
-                if instance_outdated_launchtemplate(instance, asg_lt_name, asg_lt_version):
-                    outdated_instances.append(instance)
+                # instances launched from a MixedInstancesPolicy override are checked against that launch template
+                instance_lt_name = instance.get('LaunchTemplate', {}).get('LaunchTemplateName')
+                if instance_lt_name in asg_lt_versions:
+                    lt_name, lt_version = instance_lt_name, asg_lt_versions[instance_lt_name]
+                else:
+                    lt_name, lt_version = asg_lt_name, asg_lt_version
+                reason = get_launchtemplate_outdated_reason(instance, lt_name, lt_version, launch_templates)
+            if reason:
+                outdated_instances.append(instance)
+                if reasons is not None:
+                    reasons[instance['InstanceId']] = reason
         logger.info('Found {} outdated instances'.format(
             len(outdated_instances))
         )
@@ -384,12 +829,18 @@ def plan_asgs(asgs):
     return asg_outdated_instance_dict
 
 
-def plan_asgs_older_nodes(asgs):
+def plan_asgs_older_nodes(asgs, reasons=None):
     """
-    Checks to see which asgs are out of date
+    Checks to see which asgs are out of date. When a reasons dict is given, it is filled with the reason
+    each outdated instance is out of date, keyed by instance id
     """
     days_fresh = app_config['MAX_ALLOWABLE_NODE_AGE']
 
+    # look up the launch time of every instance across all asgs at once
+    asgs = list(asgs)
+    instance_ids = [instance['InstanceId'] for asg in asgs for instance in asg['Instances']]
+    launch_times = get_instance_launch_times(instance_ids)
+
     asg_outdated_instance_dict = {}
     for asg in asgs:
         asg_name = asg['AutoScalingGroupName']
@@ -399,8 +850,11 @@ def plan_asgs_older_nodes(asgs):
         # return a list of outdated instances
         outdated_instances = []
         for instance in instances:
-            if instance_outdated_age(instance['InstanceId'], days_fresh):
+            reason = get_age_outdated_reason(instance['InstanceId'], days_fresh, launch_times.get(instance['InstanceId']))
+            if reason:
                 outdated_instances.append(instance)
+                if reasons is not None:
+                    reasons[instance['InstanceId']] = reason
         logger.info('Found {} outdated instances'.format(
             len(outdated_instances))
         )
@@ -421,28 +875,41 @@ def get_asg_tag(tags, tag_name):
     return result
 
 
-def count_all_cluster_instances(cluster_name, predictive=False, exclude_node_label_keys=app_config["EXCLUDE_NODE_LABEL_KEYS"]):
+def count_cluster_instances(asgs, k8s_node_index, predictive=False):
     """
-    Returns the total number of ec2 instances in a k8s cluster
+    Returns the total number of ec2 instances in the given ASGs. Unless predictive, only instances which are
+    K8S nodes in k8s_node_index are counted
     """
-
-    # Get the K8s nodes on the cluster, while excluding nodes with certain label keys
-    k8s_nodes = get_k8s_nodes(exclude_node_label_keys)
-
     count = 0
-    asgs = get_all_asgs(cluster_name)
     for asg in asgs:
         instances = asg['Instances']
         if predictive:
             count += asg['DesiredCapacity']
         else:
-            # Use the get_node_by_instance_id() function as it only returns the node if it is not excluded by K8s labels
+            # the node index only contains nodes which are not excluded by K8s labels
             for instance in instances:
                 instance_id = instance['InstanceId']
-                try:
-                    get_node_by_instance_id(k8s_nodes, instance_id)
+                if instance_id in k8s_node_index:
                     count += 1
-                except Exception:
+                else:
                     logger.info("Skipping instance {}".format(instance_id))
     logger.info("{} asg instance count in cluster is: {}. K8s node count should match this number".format("*** Predicted" if predictive else "Current", count))
     return count
+
+
+def count_all_cluster_instances(cluster_name, predictive=False, exclude_node_label_keys=app_config["EXCLUDE_NODE_LABEL_KEYS"]):
+    """
+    Returns the total number of ec2 instances in a k8s cluster
+    """
+
+    # Get the K8s nodes on the cluster, while excluding nodes with certain label keys
+    k8s_node_index = get_k8s_node_index(get_k8s_nodes(exclude_node_label_keys, projected=True))
+    return count_cluster_instances(get_all_asgs(cluster_name), k8s_node_index, predictive)
+
+
+def get_cluster_snapshot(cluster_name):
+    """
+    Describes all ASGs of a cluster and lists its K8S nodes once, so health checks can be evaluated together.
+    Health checks wait for instances to be launched by AWS, so the ASGs are always described afresh
+    """
+    return get_all_asgs(cluster_name), get_k8s_nodes(projected=True)
@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import defaultdict
+from .logger import logger
+from .metrics import API_CALL_SECONDS
+from .target import get_target_region
+from eksrollup.config import app_config
+
+THROTTLING_ERROR_CODES = [
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestThrottledException',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+]
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+_clients = {}
+_clients_lock = threading.Lock()
+_stats_lock = threading.Lock()
+api_stats = defaultdict(lambda: {'calls': 0, 'throttles': 0, 'latency': 0.0})
+
+
+class TokenBucket:
+    """
+    Allows up to rate calls per second on average, with bursts of up to capacity calls
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Takes a token, blocking until one is available
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # reserve the token now and wait for it to be refilled outside of the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+def get_api_family(service_name, operation_name):
+    """
+    Groups API operations which share a rate limit, e.g. autoscaling.describe or ec2.mutate
+    """
+    read_only = operation_name.startswith(('Describe', 'Get', 'List'))
+    return '{}.{}'.format(service_name, 'describe' if read_only else 'mutate')
+
+
+def get_token_bucket(api_family, region_name=None):
+    """
+    Returns the token bucket of an API family. API rate limits apply per region, so each region has its own buckets
+    """
+    with _buckets_lock:
+        if (region_name, api_family) not in _buckets:
+            _buckets[(region_name, api_family)] = TokenBucket(app_config['AWS_API_RATE_LIMIT'])
+        return _buckets[(region_name, api_family)]
+
+
+def _before_call(model, context, request_signer=None, **kwargs):
+    if app_config['AWS_API_RATE_LIMIT'] > 0:
+        region_name = request_signer.region_name if request_signer else None
+        get_token_bucket(get_api_family(model.service_model.service_name, model.name), region_name).acquire()
+    context['eksrollup_started_at'] = time.monotonic()
+
+
+def _after_call(model, context, **kwargs):
+    started_at = context.get('eksrollup_started_at')
+    if started_at is None:
+        return
+    operation = '{}.{}'.format(model.service_model.service_name, model.name)
+    latency = time.monotonic() - started_at
+    with _stats_lock:
+        api_stats[operation]['calls'] += 1
+        api_stats[operation]['latency'] += latency
+    API_CALL_SECONDS.observe(latency, api='aws', operation=operation)
+
+
+def _count_throttle(response, operation, **kwargs):
+    if response is None:
+        return
+    error_code = response[1].get('Error', {}).get('Code')
+    if error_code in THROTTLING_ERROR_CODES:
+        operation_name = '{}.{}'.format(operation.service_model.service_name, operation.name)
+        logger.info('AWS API call {} was throttled'.format(operation_name))
+        with _stats_lock:
+            api_stats[operation_name]['throttles'] += 1
+
+
+def create_client(service_name, **kwargs):
+    """
+    Creates a boto3 client using the AWS_RETRY_MODE retry mode, rate limited to AWS_API_RATE_LIMIT calls per
+    second per API family, which records the number of calls, throttled attempts and latency of each operation
+    """
+    # imported here as boto3 takes a while to import, and commands such as --help never create a client
+    import boto3
+    from botocore.config import Config
+    config = Config(retries={'mode': app_config['AWS_RETRY_MODE'], 'max_attempts': app_config['AWS_MAX_ATTEMPTS']})
+    aws_client = boto3.client(service_name, config=config, **kwargs)
+    aws_client.meta.events.register('before-call', _before_call)
+    aws_client.meta.events.register('after-call', _after_call)
+    # needs-retry is emitted for every attempt, so throttled attempts which are retried are counted too
+    aws_client.meta.events.register('needs-retry', _count_throttle)
+    return aws_client
+
+
+def get_client(service_name, region_name):
+    """
+    Returns the client of a service in a region, created on first use and shared by all the clusters in that region.
+    A region_name of None is the default region of the AWS configuration
+    """
+    with _clients_lock:
+        if (service_name, region_name) not in _clients:
+            kwargs = {'region_name': region_name} if region_name else {}
+            _clients[(service_name, region_name)] = create_client(service_name, **kwargs)
+        return _clients[(service_name, region_name)]
+
+
+class RegionalClient:
+    """
+    Stands in for the client of a service, calling the pooled client of the region of the cluster target
+    being rolled, or the client of the default region outside of fleet mode. Clients are only created on
+    first use, so importing the tool needs neither boto3 nor a configured region
+    """
+
+    def __init__(self, service_name):
+        self.service_name = service_name
+
+    def __getattr__(self, name):
+        return getattr(get_client(self.service_name, get_target_region()), name)
+
+
+def log_api_stats():
+    """
+    Logs the number of calls, throttled attempts and mean latency of each AWS API operation
+    """
+    with _stats_lock:
+        for operation, stats in sorted(api_stats.items()):
+            mean_latency = stats['latency'] / stats['calls'] if stats['calls'] else 0
+            logger.info('AWS API {}: {} calls, {} throttled, mean latency {:.3f}s'.format(
+                operation, stats['calls'], stats['throttles'], mean_latency))
@@ -0,0 +1,71 @@
+import threading
+from contextlib import contextmanager
+
+
+class RolloutBudget:
+    """
+    Caps the number of node drains and surge instances in flight across all the clusters rolled by the process.
+    A limit of 0 is unlimited, which is the default outside of fleet mode
+    """
+
+    def __init__(self, max_drains=0, max_surge=0):
+        self.max_drains = max_drains
+        self.max_surge = max_surge
+        self.drains = 0
+        self.surge_instances = 0
+        self._condition = threading.Condition()
+
+    def configure(self, max_drains, max_surge):
+        with self._condition:
+            self.max_drains = max_drains
+            self.max_surge = max_surge
+            self._condition.notify_all()
+
+    def acquire_drain(self):
+        with self._condition:
+            while self.max_drains and self.drains >= self.max_drains:
+                self._condition.wait()
+            self.drains += 1
+
+    def release_drain(self):
+        with self._condition:
+            self.drains -= 1
+            self._condition.notify_all()
+
+    def acquire_surge(self, instances):
+        """
+        Blocks until the surge instances fit in the budget. A request for more instances than the whole budget
+        waits for all other surges to finish instead of waiting forever
+        """
+        if not instances:
+            return
+        with self._condition:
+            while self.max_surge and self.surge_instances and self.surge_instances + instances > self.max_surge:
+                self._condition.wait()
+            self.surge_instances += instances
+
+    def release_surge(self, instances):
+        if not instances:
+            return
+        with self._condition:
+            self.surge_instances -= instances
+            self._condition.notify_all()
+
+    @contextmanager
+    def drain(self):
+        self.acquire_drain()
+        try:
+            yield
+        finally:
+            self.release_drain()
+
+    @contextmanager
+    def surge(self, instances):
+        self.acquire_surge(instances)
+        try:
+            yield
+        finally:
+            self.release_surge(instances)
+
+
+rollout_budget = RolloutBudget()
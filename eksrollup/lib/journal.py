@@ -0,0 +1,210 @@
+import os
+import json
+import threading
+from .logger import logger
+from .k8s import get_core_v1_api, client, rest
+from .target import get_target
+from eksrollup.config import app_config
+
+# progress of an outdated instance through the rolling update, in order
+INSTANCE_STATES = ['planned', 'cordoned', 'drained', 'deleted', 'terminated']
+JOURNAL_CONFIGMAP_KEY = 'journal'
+
+
+class FileJournalStore:
+    """
+    Keeps the journal in a local JSON file, replaced atomically on every write
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        try:
+            with open(self.path) as journal_file:
+                return json.load(journal_file)
+        except FileNotFoundError:
+            return None
+
+    def save(self, data):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as journal_file:
+            json.dump(data, journal_file)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        os.replace(tmp_path, self.path)
+
+    def delete(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class ConfigMapJournalStore:
+    """
+    Keeps the journal in a ConfigMap of the cluster, so a run resumed from another machine or pod picks it up
+    """
+
+    def __init__(self, namespace, name):
+        self.namespace = namespace
+        self.name = name
+
+    def load(self):
+        try:
+            config_map = get_core_v1_api().read_namespaced_config_map(self.name, self.namespace)
+        except rest.ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+        data = (config_map.data or {}).get(JOURNAL_CONFIGMAP_KEY)
+        return json.loads(data) if data else None
+
+    def save(self, data):
+        k8s_api = get_core_v1_api()
+        body = client.V1ConfigMap(
+            metadata=client.V1ObjectMeta(name=self.name, namespace=self.namespace),
+            data={JOURNAL_CONFIGMAP_KEY: json.dumps(data)}
+        )
+        try:
+            k8s_api.replace_namespaced_config_map(self.name, self.namespace, body)
+        except rest.ApiException as e:
+            if e.status != 404:
+                raise
+            k8s_api.create_namespaced_config_map(self.namespace, body)
+
+    def delete(self):
+        try:
+            get_core_v1_api().delete_namespaced_config_map(self.name, self.namespace)
+        except rest.ApiException as e:
+            if e.status != 404:
+                raise
+
+
+def get_journal_store(cluster_name=None):
+    """
+    Returns the journal store configured by JOURNAL_CONFIGMAP or JOURNAL_PATH, or None if journaling is disabled.
+    Each cluster of a fleet keeps its ConfigMap journal in the cluster itself and its file journal in a file
+    suffixed with the cluster name
+    """
+    if app_config['JOURNAL_CONFIGMAP']:
+        namespace, _, name = app_config['JOURNAL_CONFIGMAP'].rpartition('/')
+        return ConfigMapJournalStore(namespace or 'default', name)
+    if app_config['JOURNAL_PATH']:
+        if cluster_name:
+            return FileJournalStore('{}.{}'.format(app_config['JOURNAL_PATH'], cluster_name))
+        return FileJournalStore(app_config['JOURNAL_PATH'])
+    return None
+
+
+class RolloutJournal:
+    """
+    Records the progress of a rolling update per outdated instance and per ASG, so a restarted run
+    skips instances which were already cordoned, drained or deleted and health checks which already passed.
+    All methods are no-ops when no store is configured
+    """
+
+    def __init__(self, store=None):
+        self.store = store
+        self._data = {'cluster': None, 'asgs': {}, 'instances': {}}
+        self._lock = threading.Lock()
+
+    def start(self, cluster_name):
+        """
+        Loads the journal of a previous run on the same cluster, if any
+        """
+        if not self.store:
+            return
+        with self._lock:
+            data = self.store.load()
+            if data and data.get('cluster') == cluster_name:
+                logger.info(f'Resuming from rollout journal with {len(data["instances"])} instances in progress')
+                self._data = data
+            else:
+                self._data = {'cluster': cluster_name, 'asgs': {}, 'instances': {}}
+
+    def plan(self, asg_name, instance_ids):
+        """
+        Records the outdated instances of an ASG which are not in the journal yet as planned
+        """
+        if not self.store:
+            return
+        with self._lock:
+            for instance_id in instance_ids:
+                self._data['instances'].setdefault(instance_id, {'asg': asg_name, 'state': 'planned'})
+            self.store.save(self._data)
+
+    def record(self, instance_id, state):
+        if not self.store:
+            return
+        with self._lock:
+            entry = self._data['instances'].setdefault(instance_id, {'asg': None, 'state': state})
+            entry['state'] = state
+            self.store.save(self._data)
+
+    def reached(self, instance_id, state):
+        """
+        Returns True if an instance has already gone through the given state
+        """
+        with self._lock:
+            entry = self._data['instances'].get(instance_id)
+        return bool(entry) and INSTANCE_STATES.index(entry['state']) >= INSTANCE_STATES.index(state)
+
+    def record_asg(self, asg_name, state):
+        if not self.store:
+            return
+        with self._lock:
+            self._data['asgs'][asg_name] = state
+            self.store.save(self._data)
+
+    def asg_state(self, asg_name):
+        with self._lock:
+            return self._data['asgs'].get(asg_name)
+
+    def finish_asg(self, asg_name):
+        """
+        Forgets an ASG and its instances once its rolling update is complete
+        """
+        if not self.store:
+            return
+        with self._lock:
+            self._data['asgs'].pop(asg_name, None)
+            self._data['instances'] = {
+                instance_id: entry for instance_id, entry in self._data['instances'].items() if entry['asg'] != asg_name
+            }
+            self.store.save(self._data)
+
+    def finish(self):
+        """
+        Removes the journal once the rolling update of all ASGs is complete
+        """
+        if not self.store:
+            return
+        with self._lock:
+            self._data = {'cluster': None, 'asgs': {}, 'instances': {}}
+            self.store.delete()
+
+
+_target_journals = {}
+_target_journals_lock = threading.Lock()
+
+
+class TargetJournal:
+    """
+    Stands in for the journal of the cluster target being rolled, or the default journal outside of fleet mode
+    """
+
+    def __init__(self, default_journal):
+        self.default_journal = default_journal
+
+    def __getattr__(self, name):
+        target = get_target()
+        if target is None:
+            return getattr(self.default_journal, name)
+        with _target_journals_lock:
+            if target.cluster_name not in _target_journals:
+                _target_journals[target.cluster_name] = RolloutJournal(get_journal_store(target.cluster_name))
+            return getattr(_target_journals[target.cluster_name], name)
+
+
+journal = TargetJournal(RolloutJournal(get_journal_store()))
@@ -1,12 +1,35 @@
-from kubernetes import client, config
-from kubernetes.client.rest import ApiException
 import os
+import json
 import subprocess
 import time
 import sys
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from .logger import logger
+from .lazy import LazyModule
+from .metrics import API_CALL_SECONDS
+from .target import get_target_k8s_context, submit
 from eksrollup.config import app_config
 
+# the kubernetes client takes a while to import, so it is only imported once the cluster is first reached
+client = LazyModule('kubernetes.client')
+config = LazyModule('kubernetes.config')
+watch = LazyModule('kubernetes.watch')
+rest = LazyModule('kubernetes.client.rest')
+
+# kubectl drain waits 5 seconds before retrying an eviction blocked by a PodDisruptionBudget
+EVICTION_RETRY_WAIT = 5
+MAX_CONCURRENT_EVICTIONS = 10
+# phases of pods whose containers all terminated, which kubectl drain deletes whether or not a controller manages them
+FINISHED_POD_PHASES = ('Succeeded', 'Failed')
+
+_api_client = None
+_api_client_created_at = 0
+_api_client_lock = threading.Lock()
+# api clients of the kube contexts of fleet targets, with the time each was created
+_context_api_clients = {}
+
 
 def ensure_config_loaded():
 
@@ -31,39 +54,191 @@ def ensure_config_loaded():
         client.Configuration._default.proxy = proxy_url
 
 
-def get_k8s_nodes(exclude_node_label_keys=app_config["EXCLUDE_NODE_LABEL_KEYS"]):
+def get_k8s_api_client():
+    """
+    Returns a process wide ApiClient with a pooled connection. The kube config is only loaded when
+    the client is first built, and again after K8S_CLIENT_REFRESH_INTERVAL seconds so credentials
+    from exec plugins such as aws-iam-authenticator are refreshed before they expire
+    """
+    global _api_client, _api_client_created_at
+
+    k8s_context = get_target_k8s_context()
+    if k8s_context:
+        return get_context_api_client(k8s_context)
+
+    with _api_client_lock:
+        if _api_client is None or time.time() - _api_client_created_at > app_config['K8S_CLIENT_REFRESH_INTERVAL']:
+            ensure_config_loaded()
+            if hasattr(client.Configuration, 'get_default_copy'):
+                configuration = client.Configuration.get_default_copy()
+            else:
+                configuration = client.Configuration()
+            configuration.connection_pool_maxsize = app_config['K8S_CONNECTION_POOL_MAXSIZE']
+            _api_client = client.ApiClient(configuration)
+            _api_client_created_at = time.time()
+        return _api_client
+
+
+def get_context_api_client(k8s_context):
+    """
+    Returns the ApiClient of a kube context of a fleet target. Its configuration is loaded into its own
+    Configuration object so clusters rolled at the same time don't share credentials
+    """
+    with _api_client_lock:
+        api_client, created_at = _context_api_clients.get(k8s_context, (None, 0))
+        if api_client is None or time.time() - created_at > app_config['K8S_CLIENT_REFRESH_INTERVAL']:
+            configuration = client.Configuration()
+            try:
+                config.load_kube_config(context=k8s_context, client_configuration=configuration)
+            except config.ConfigException:
+                raise Exception("Could not configure kubernetes python client for context {}".format(k8s_context))
+            proxy_url = os.getenv('HTTPS_PROXY', os.getenv('HTTP_PROXY', None))
+            if proxy_url and not app_config['K8S_PROXY_BYPASS']:
+                configuration.proxy = proxy_url
+            configuration.connection_pool_maxsize = app_config['K8S_CONNECTION_POOL_MAXSIZE']
+            api_client = client.ApiClient(configuration)
+            _context_api_clients[k8s_context] = api_client, time.time()
+        return api_client
+
+
+class InstrumentedApi:
+    """
+    Wraps a kubernetes API object to record the latency of each call, e.g. as operation CoreV1Api.patch_node.
+    Watch streams are not recorded as they stay open until the watch ends
+    """
+
+    def __init__(self, api):
+        self._api = api
+        self._api_name = type(api).__name__
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr):
+            return attr
+
+        # keep the docstring, which kubernetes.watch reads to find the type of the listed objects
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            if kwargs.get('watch'):
+                return attr(*args, **kwargs)
+            with API_CALL_SECONDS.time(api='k8s', operation=f'{self._api_name}.{name}'):
+                return attr(*args, **kwargs)
+        return call
+
+
+def get_core_v1_api():
+    return InstrumentedApi(client.CoreV1Api(get_k8s_api_client()))
+
+
+def get_apps_v1_api():
+    return InstrumentedApi(client.AppsV1Api(get_k8s_api_client()))
+
+
+def get_policy_api():
+    # PodDisruptionBudgets are only served by policy/v1beta1 in older clients
+    policy_api = getattr(client, 'PolicyV1Api', None) or client.PolicyV1beta1Api
+    return InstrumentedApi(policy_api(get_k8s_api_client()))
+
+
+def get_exclusion_label_selector(exclude_node_label_keys):
     """
-    Returns a list of kubernetes nodes
+    Returns a label selector matching the nodes without any of the excluded label keys, e.g. !spotinst.io/node-lifecycle
     """
-    ensure_config_loaded()
+    return ','.join('!{}'.format(key) for key in exclude_node_label_keys or [])
+
 
-    k8s_api = client.CoreV1Api()
+def project_node(item):
+    """
+    Builds a node with only the name, labels, provider id, unschedulable flag and Ready condition of a raw node
+    """
+    metadata = item.get('metadata') or {}
+    spec = item.get('spec') or {}
+    status = item.get('status') or {}
+    conditions = [client.V1NodeCondition(type=condition['type'], status=condition['status'])
+                  for condition in status.get('conditions') or [] if condition.get('type') == 'Ready']
+    return client.V1Node(
+        metadata=client.V1ObjectMeta(name=metadata.get('name'), labels=metadata.get('labels'),
+                                     resource_version=metadata.get('resourceVersion')),
+        spec=client.V1NodeSpec(provider_id=spec.get('providerID'), unschedulable=spec.get('unschedulable')),
+        status=client.V1NodeStatus(conditions=conditions)
+    )
+
+
+def list_nodes(k8s_api, label_selector='', projected=False):
+    """
+    Lists nodes K8S_LIST_PAGE_SIZE at a time. The first page is read from the apiserver watch cache with
+    resourceVersion=0, which may serve all nodes at once. If projected is set, the raw response is reduced with
+    project_node rather than deserializing every field of every node.
+    Returns the nodes along with the resource version of the list
+    """
+    kwargs = {'label_selector': label_selector, 'resource_version': '0'}
+    if app_config['K8S_LIST_PAGE_SIZE'] > 0:
+        kwargs['limit'] = app_config['K8S_LIST_PAGE_SIZE']
+    nodes = []
+    while True:
+        if projected:
+            response = json.loads(k8s_api.list_node(_preload_content=False, **kwargs).data)
+            nodes.extend(project_node(item) for item in response.get('items') or [])
+            metadata = response.get('metadata') or {}
+            resource_version, continue_token = metadata.get('resourceVersion'), metadata.get('continue')
+        else:
+            response = k8s_api.list_node(**kwargs)
+            nodes.extend(response.items)
+            resource_version, continue_token = response.metadata.resource_version, response.metadata._continue
+        if not continue_token:
+            return nodes, resource_version
+        # the following pages are read from the snapshot of the first one
+        kwargs.pop('resource_version', None)
+        kwargs['_continue'] = continue_token
+
+
+def get_k8s_nodes(exclude_node_label_keys=app_config["EXCLUDE_NODE_LABEL_KEYS"], projected=False):
+    """
+    Returns a list of kubernetes nodes. Nodes with one of the excluded label keys are filtered out by the apiserver.
+    If projected is set, the nodes only carry their name, labels, provider id, unschedulable flag and Ready condition
+    """
+    k8s_api = get_core_v1_api()
     logger.info("Getting k8s nodes...")
-    response = k8s_api.list_node()
+    nodes, _ = list_nodes(k8s_api, get_exclusion_label_selector(exclude_node_label_keys), projected)
     if exclude_node_label_keys is not None:
-        nodes = []
-        for node in response.items:
-            if all(key not in node.metadata.labels for key in exclude_node_label_keys):
-                nodes.append(node)
-        response.items = nodes
-    logger.info("Current k8s node count is {}".format(len(response.items)))
-    return response.items
+        nodes = [node for node in nodes if not is_node_excluded(node, exclude_node_label_keys)]
+    logger.info("Current k8s node count is {}".format(len(nodes)))
+    return nodes
+
+
+def get_instance_id_from_provider_id(provider_id):
+    """
+    Returns the instance id of a node provider id such as aws:///eu-west-1a/i-0123456789abcdef0
+    """
+    if not provider_id:
+        return None
+    return provider_id.rsplit('/', 1)[-1]
+
+
+def get_k8s_node_index(k8s_nodes):
+    """
+    Returns the names of the given K8S nodes keyed by the instance id in their provider id
+    """
+    node_index = {}
+    for k8s_node in k8s_nodes:
+        instance_id = get_instance_id_from_provider_id(k8s_node.spec.provider_id)
+        if instance_id:
+            node_index[instance_id] = k8s_node.metadata.name
+    return node_index
 
 
 def get_node_by_instance_id(k8s_nodes, instance_id):
     """
     Returns a K8S node name given an instance id. Expects the output of
-    list_nodes as in input
+    list_nodes or an index built from it with get_k8s_node_index as in input
     """
-    node_name = ""
     logger.info('Searching for k8s node name by instance id...')
-    for k8s_node in k8s_nodes:
-        if instance_id in k8s_node.spec.provider_id:
-            logger.info('InstanceId {} is node {} in kubernetes land'.format(instance_id, k8s_node.metadata.name))
-            node_name = k8s_node.metadata.name
+    node_index = k8s_nodes if isinstance(k8s_nodes, dict) else get_k8s_node_index(k8s_nodes)
+    node_name = node_index.get(instance_id)
     if not node_name:
         logger.info("Could not find a k8s node name for that instance id. Exiting")
         raise Exception("Could not find a k8s node name for that instance id. Exiting")
+    logger.info('InstanceId {} is node {} in kubernetes land'.format(instance_id, node_name))
     return node_name
 
 
@@ -72,11 +247,7 @@ def modify_k8s_autoscaler(action):
     Pauses or resumes the Kubernetes autoscaler
     """
 
-    ensure_config_loaded()
-
-    # Configure API key authorization: BearerToken
-    # create an instance of the API class
-    k8s_api = client.AppsV1Api()
+    k8s_api = get_apps_v1_api()
     if action == 'pause':
         logger.info('Pausing k8s autoscaler...')
         body = {'spec': {'replicas': 0}}
@@ -93,7 +264,7 @@ def modify_k8s_autoscaler(action):
             body
         )
         logger.info('K8s autoscaler modified to replicas: {}'.format(body['spec']['replicas']))
-    except ApiException as e:
+    except rest.ApiException as e:
         logger.info('Scaling of k8s autoscaler failed. Error code was {}, {}. Exiting.'.format(e.reason, e.body))
         sys.exit(1)
 
@@ -103,10 +274,7 @@ def delete_node(node_name):
     Deletes a kubernetes node from the cluster
     """
 
-    ensure_config_loaded()
-
-    # create an instance of the API class
-    k8s_api = client.CoreV1Api()
+    k8s_api = get_core_v1_api()
     logger.info("Deleting k8s node {}...".format(node_name))
     try:
         if not app_config['DRY_RUN']:
@@ -114,7 +282,7 @@ def delete_node(node_name):
         else:
             k8s_api.delete_node(node_name, dry_run="true")
         logger.info("Node deleted")
-    except ApiException as e:
+    except rest.ApiException as e:
         logger.info("Exception when calling CoreV1Api->delete_node: {}".format(e))
 
 
@@ -123,10 +291,7 @@ def cordon_node(node_name):
     Cordon a kubernetes node to avoid new pods being scheduled on it
     """
 
-    ensure_config_loaded()
-
-    # create an instance of the API class
-    k8s_api = client.CoreV1Api()
+    k8s_api = get_core_v1_api()
     logger.info("Cordoning k8s node {}...".format(node_name))
     try:
         api_call_body = client.V1Node(spec=client.V1NodeSpec(unschedulable=True))
@@ -135,7 +300,7 @@ def cordon_node(node_name):
         else:
             k8s_api.patch_node(node_name, api_call_body, dry_run=True)
         logger.info("Node cordoned")
-    except ApiException as e:
+    except rest.ApiException as e:
         logger.info("Exception when calling CoreV1Api->patch_node: {}".format(e))
 
 
@@ -144,9 +309,7 @@ def taint_node(node_name):
     Taint a kubernetes node to avoid new pods being scheduled on it
     """
 
-    ensure_config_loaded()
-
-    k8s_api = client.CoreV1Api()
+    k8s_api = get_core_v1_api()
     logger.info("Adding taint to k8s node {}...".format(node_name))
     try:
         taint = client.V1Taint(effect='NoSchedule', key='eks-rolling-update')
@@ -156,16 +319,18 @@ def taint_node(node_name):
         else:
             k8s_api.patch_node(node_name, api_call_body, dry_run=True)
         logger.info("Added taint to the node")
-    except ApiException as e:
+    except rest.ApiException as e:
         logger.info("Exception when calling CoreV1Api->patch_node: {}".format(e))
 
 
 def drain_node(node_name):
     """
-    Executes kubectl commands to drain the node. We are not using the api
-    because the draining functionality is done client side and to
-    replicate the same functionality here would be too time consuming
+    Executes kubectl commands to drain the node, or evicts the pods through the api
+    when K8S_NATIVE_DRAIN is set
     """
+    if app_config['K8S_NATIVE_DRAIN']:
+        return drain_node_native(node_name)
+
     kubectl_args = [
         'kubectl', 'drain', node_name,
         '--ignore-daemonsets',
@@ -173,6 +338,10 @@ def drain_node(node_name):
     ]
     kubectl_args += app_config['EXTRA_DRAIN_ARGS']
 
+    k8s_context = get_target_k8s_context()
+    if k8s_context:
+        kubectl_args += ['--context', k8s_context]
+
     if app_config['DRY_RUN'] is True:
         kubectl_args += ['--dry-run']
 
@@ -194,30 +363,312 @@ def drain_node(node_name):
             raise Exception("Node not drained properly. Exiting")
 
 
+def get_pods_to_evict(k8s_api, node_name, force=False):
+    """
+    Returns the pods running on a node which need evicting, skipping DaemonSet and mirror pods.
+    Running pods not managed by a controller are only returned when force is set, like kubectl drain
+    """
+    pods = k8s_api.list_pod_for_all_namespaces(field_selector=f'spec.nodeName={node_name}').items
+    pods_to_evict = []
+    for pod in pods:
+        owner_references = pod.metadata.owner_references or []
+        if not is_pod_drained(pod):
+            continue
+        finished = pod.status is not None and pod.status.phase in FINISHED_POD_PHASES
+        if not owner_references and not finished and not force:
+            raise Exception(f"Pod {pod.metadata.namespace}/{pod.metadata.name} on node {node_name} is not managed by a controller")
+        pods_to_evict.append(pod)
+    return pods_to_evict
+
+
+def get_drain_flag(drain_args, flag):
+    """
+    Returns the value of a boolean kubectl drain flag such as --force in a list of arguments. Like kubectl,
+    the flag may be given a value as --force=false, and the last occurrence wins
+    """
+    value = False
+    for arg in drain_args:
+        if arg == flag:
+            value = True
+        elif arg.startswith(flag + '='):
+            # the values accepted by kubectl, anything else makes kubectl drain fail
+            value = arg[len(flag) + 1:] in ('1', 't', 'T', 'true', 'TRUE', 'True')
+    return value
+
+
+def is_pod_drained(pod):
+    """
+    Returns False for the DaemonSet and mirror pods of a node, which draining leaves in place
+    """
+    annotations = pod.metadata.annotations or {}
+    owner_references = pod.metadata.owner_references or []
+    if 'kubernetes.io/config.mirror' in annotations:
+        return False
+    return not any(owner.kind == 'DaemonSet' for owner in owner_references)
+
+
+def label_selector_matches(selector, labels):
+    """
+    Returns True if a V1LabelSelector matches a set of labels. An empty selector matches everything
+    """
+    if selector is None:
+        return False
+    labels = labels or {}
+    for key, value in (selector.match_labels or {}).items():
+        if labels.get(key) != value:
+            return False
+    for expression in selector.match_expressions or []:
+        values = expression.values or []
+        if expression.operator == 'In' and labels.get(expression.key) not in values:
+            return False
+        if expression.operator == 'NotIn' and labels.get(expression.key) in values:
+            return False
+        if expression.operator == 'Exists' and expression.key not in labels:
+            return False
+        if expression.operator == 'DoesNotExist' and expression.key in labels:
+            return False
+    return True
+
+
+def get_pod_disruption_budgets():
+    """
+    Returns the PodDisruptionBudgets of all namespaces, or an empty list if they can't be listed
+    """
+    try:
+        return get_policy_api().list_pod_disruption_budget_for_all_namespaces().items
+    except rest.ApiException as e:
+        logger.info("Could not list PodDisruptionBudgets, ignoring them: {}".format(e.reason))
+        return []
+
+
+def get_node_drain_costs(node_names):
+    """
+    Returns the number of pods draining each node evicts, along with how many of them exceed the disruptions
+    their PodDisruptionBudgets allow, so would block the drain until pods are available elsewhere.
+    Computed from a single listing of the pods and PodDisruptionBudgets of the cluster
+    """
+    node_names = set(node_names)
+    pods = get_core_v1_api().list_pod_for_all_namespaces(
+        field_selector='status.phase!=Succeeded,status.phase!=Failed').items
+    pods_by_node = {node_name: [] for node_name in node_names}
+    for pod in pods:
+        if pod.spec.node_name in node_names and is_pod_drained(pod):
+            pods_by_node[pod.spec.node_name].append(pod)
+    pdbs = get_pod_disruption_budgets()
+
+    drain_costs = {}
+    for node_name, node_pods in pods_by_node.items():
+        blocked_pods = 0
+        for pdb in pdbs:
+            namespace_pods = [pod for pod in node_pods if pod.metadata.namespace == pdb.metadata.namespace]
+            covered_pods = sum(1 for pod in namespace_pods if label_selector_matches(pdb.spec.selector, pod.metadata.labels))
+            disruptions_allowed = (pdb.status.disruptions_allowed or 0) if pdb.status else 0
+            blocked_pods += max(covered_pods - disruptions_allowed, 0)
+        drain_costs[node_name] = blocked_pods, len(node_pods)
+    return drain_costs
+
+
+def evict_pod(k8s_api, pod, deadline, disable_eviction=False):
+    """
+    Evicts a pod, retrying while a PodDisruptionBudget blocks the eviction. Deletes the pod
+    instead when disable_eviction is set
+    """
+    name = pod.metadata.name
+    namespace = pod.metadata.namespace
+    dry_run = 'All' if app_config['DRY_RUN'] else None
+    while True:
+        try:
+            if disable_eviction:
+                k8s_api.delete_namespaced_pod(name, namespace, dry_run=dry_run)
+            else:
+                # the eviction model is versioned differently across kubernetes client releases
+                eviction_class = getattr(client, 'V1Eviction', None) or client.V1beta1Eviction
+                body = eviction_class(metadata=client.V1ObjectMeta(name=name, namespace=namespace))
+                k8s_api.create_namespaced_pod_eviction(name, namespace, body, dry_run=dry_run)
+            logger.info(f"Evicted pod {namespace}/{name}")
+            return
+        except rest.ApiException as e:
+            if e.status == 404:
+                return
+            if e.status != 429:
+                raise
+            if time.time() + EVICTION_RETRY_WAIT > deadline:
+                raise Exception(f"Timed out evicting pod {namespace}/{name}")
+            logger.info(f"Eviction of pod {namespace}/{name} blocked by a disruption budget, retrying...")
+            time.sleep(EVICTION_RETRY_WAIT)
+
+
+def wait_for_pods_deleted(k8s_api, node_name, pods, deadline):
+    """
+    Watches the pods of a node until all of the given pods are gone
+    """
+    field_selector = f'spec.nodeName={node_name}'
+    pending = {pod.metadata.uid for pod in pods}
+    while True:
+        # re-list so pods deleted before the watch was started are not waited on
+        pod_list = k8s_api.list_pod_for_all_namespaces(field_selector=field_selector)
+        pending &= {pod.metadata.uid for pod in pod_list.items}
+        if not pending:
+            return
+        timeout = int(deadline - time.time())
+        if timeout <= 0:
+            raise Exception(f"Timed out waiting for {len(pending)} pods to be deleted from node {node_name}")
+        pod_watch = watch.Watch()
+        for event in pod_watch.stream(k8s_api.list_pod_for_all_namespaces, field_selector=field_selector,
+                                      resource_version=pod_list.metadata.resource_version, timeout_seconds=timeout):
+            if event['type'] == 'DELETED':
+                pending.discard(event['object'].metadata.uid)
+                if not pending:
+                    pod_watch.stop()
+                    return
+
+
+def evict_node_pods(k8s_api, node_name, force=False, disable_eviction=False):
+    """
+    Evicts all pods from a node concurrently and waits for them to be deleted
+    """
+    deadline = time.time() + app_config['K8S_DRAIN_TIMEOUT']
+    pods = get_pods_to_evict(k8s_api, node_name, force)
+    logger.info(f"Evicting {len(pods)} pods from node {node_name}...")
+    if pods:
+        with ThreadPoolExecutor(max_workers=min(len(pods), MAX_CONCURRENT_EVICTIONS)) as executor:
+            futures = [submit(executor, evict_pod, k8s_api, pod, deadline, disable_eviction) for pod in pods]
+            for future in futures:
+                future.result()
+        if not app_config['DRY_RUN']:
+            wait_for_pods_deleted(k8s_api, node_name, pods, deadline)
+    logger.info(f"Node {node_name} drained")
+
+
+def drain_node_native(node_name):
+    """
+    Drains a node through the eviction api instead of kubectl. DaemonSet and mirror pods are left
+    in place and evictions blocked by a PodDisruptionBudget are retried until K8S_DRAIN_TIMEOUT
+    """
+    k8s_api = get_core_v1_api()
+    force = get_drain_flag(app_config['EXTRA_DRAIN_ARGS'], '--force')
+    logger.info(f'Draining worker node {node_name} through the eviction api...')
+    try:
+        evict_node_pods(k8s_api, node_name, force=force)
+    except Exception as e:
+        logger.info(e)
+        if app_config['ENFORCED_DRAINING'] is True:
+            logger.info('There was an error draining the worker node, proceed with enforced draining...')
+            try:
+                evict_node_pods(k8s_api, node_name, force=True, disable_eviction=True)
+            except Exception as enforced_exception:
+                logger.info(enforced_exception)
+                raise Exception("Node not drained properly with enforced draining enabled. Exiting")
+        else:
+            raise Exception("Node not drained properly. Exiting")
+
+
+def is_node_excluded(node, exclude_node_label_keys):
+    """
+    Returns True if a node carries a label with one of the excluded keys
+    """
+    labels = node.metadata.labels or {}
+    return any(key in labels for key in exclude_node_label_keys)
+
+
+def is_node_ready(node):
+    """
+    Returns False if the Ready condition of a node is False
+    """
+    for condition in node.status.conditions or []:
+        if condition.type == "Ready" and condition.status == "False":
+            return False
+    return True
+
+
+def wait_for_k8s_nodes(condition, timeout, exclude_node_label_keys=app_config["EXCLUDE_NODE_LABEL_KEYS"]):
+    """
+    Keeps a local cache of the nodes keyed by provider id using list and watch, and returns True as
+    soon as condition(nodes) holds. Returns False if the condition is not met within timeout seconds
+    """
+    k8s_api = get_core_v1_api()
+    deadline = time.time() + timeout
+    label_selector = get_exclusion_label_selector(exclude_node_label_keys)
+
+    def cache_node(nodes, node, deleted=False):
+        # nodes may register before their provider id is set
+        key = node.spec.provider_id or node.metadata.name
+        nodes.pop(node.metadata.name, None)
+        if deleted or is_node_excluded(node, exclude_node_label_keys):
+            nodes.pop(key, None)
+        else:
+            nodes[key] = node
+
+    while True:
+        node_list, resource_version = list_nodes(k8s_api, label_selector)
+        nodes = {}
+        for node in node_list:
+            cache_node(nodes, node)
+        if condition(list(nodes.values())):
+            return True
+        expired = False
+        while not expired:
+            remaining = int(deadline - time.time())
+            if remaining <= 0:
+                return False
+            node_watch = watch.Watch()
+            try:
+                for event in node_watch.stream(k8s_api.list_node, label_selector=label_selector,
+                                               resource_version=resource_version, timeout_seconds=remaining):
+                    if event['type'] == 'ERROR':
+                        expired = True
+                        break
+                    node = event['object']
+                    resource_version = node.metadata.resource_version
+                    cache_node(nodes, node, deleted=event['type'] == 'DELETED')
+                    if condition(list(nodes.values())):
+                        node_watch.stop()
+                        return True
+            except rest.ApiException as e:
+                # the resource version is too old to resume the watch from
+                if e.status != 410:
+                    raise
+                expired = True
+        logger.info('Node watch expired, listing nodes again...')
+
+
+def k8s_nodes_healthy(nodes):
+    """
+    Checks that all given nodes are Ready
+    """
+    healthy_nodes = True
+    for node in nodes:
+        conditions = node.status.conditions
+        for condition in conditions:
+            if condition.type == "Ready" and condition.status == "False":
+                logger.info("Node {} is not healthy - Ready: {}".format(
+                    node.metadata.name,
+                    condition.status)
+                )
+                healthy_nodes = False
+            elif condition.type == "Ready" and condition.status == "True":
+                # condition status is a string
+                logger.info("Node {}: Ready".format(node.metadata.name))
+    return healthy_nodes
+
+
 def k8s_nodes_ready(max_retry=app_config['GLOBAL_MAX_RETRY'], wait=app_config['GLOBAL_HEALTH_WAIT']):
     """
     Checks that all nodes in a cluster are Ready
     """
     logger.info('Checking k8s nodes health status...')
+    if app_config['K8S_NODE_WATCH']:
+        healthy_nodes = wait_for_k8s_nodes(lambda nodes: all(is_node_ready(node) for node in nodes), max_retry * wait)
+        if healthy_nodes:
+            logger.info('All k8s nodes are healthy')
+        else:
+            logger.info('Some k8s nodes are still not healthy')
+        return healthy_nodes
     retry_count = 1
     healthy_nodes = False
     while retry_count < max_retry:
-        # reset healthy nodes after every loop
-        healthy_nodes = True
         retry_count += 1
-        nodes = get_k8s_nodes()
-        for node in nodes:
-            conditions = node.status.conditions
-            for condition in conditions:
-                if condition.type == "Ready" and condition.status == "False":
-                    logger.info("Node {} is not healthy - Ready: {}".format(
-                        node.metadata.name,
-                        condition.status)
-                    )
-                    healthy_nodes = False
-                elif condition.type == "Ready" and condition.status == "True":
-                    # condition status is a string
-                    logger.info("Node {}: Ready".format(node.metadata.name))
+        healthy_nodes = k8s_nodes_healthy(get_k8s_nodes(projected=True))
         if healthy_nodes:
             logger.info('All k8s nodes are healthy')
             break
@@ -231,12 +682,19 @@ def k8s_nodes_count(desired_node_count, max_retry=app_config['GLOBAL_MAX_RETRY']
     Checks that the number of nodes in k8s cluster matches given desired_node_count
     """
     logger.info('Checking k8s expected nodes are online after asg scaled up...')
+    if app_config['K8S_NODE_WATCH']:
+        nodes_online = wait_for_k8s_nodes(lambda nodes: len(nodes) == desired_node_count, max_retry * wait)
+        if nodes_online:
+            logger.info('Reached desired k8s node count of {}'.format(desired_node_count))
+        else:
+            logger.info('K8s nodes did not reach count {}'.format(desired_node_count))
+        return nodes_online
     retry_count = 1
     nodes_online = False
     while retry_count < max_retry:
         nodes_online = True
         retry_count += 1
-        nodes = get_k8s_nodes()
+        nodes = get_k8s_nodes(projected=True)
         logger.info('Current k8s node count is {}'.format(len(nodes)))
         if len(nodes) != desired_node_count:
             nodes_online = False
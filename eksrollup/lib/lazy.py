@@ -0,0 +1,21 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stands in for a module which is only imported when one of its attributes is first used, so that commands
+    which never reach the kubernetes API, such as --help or a plan, do not pay for importing its client
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, name):
+        if self._module is None:
+            # import_module holds the import lock of the module, so concurrent first uses import it once
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, name)
+
+    def __repr__(self):
+        return '<lazy module {}>'.format(self._name)
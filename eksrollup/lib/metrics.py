@@ -0,0 +1,196 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from .logger import logger
+from eksrollup.config import app_config
+
+# rollout phases take from seconds to tens of minutes, API calls from milliseconds to seconds
+PHASE_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+API_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_registry = []
+_metrics_lock = threading.Lock()
+_metrics_file_lock = threading.Lock()
+
+
+def format_labels(label_names, label_values, extra=()):
+    labels = list(zip(label_names, label_values)) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, escape_label_value(value)) for name, value in labels) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class Histogram:
+    """
+    Prometheus histogram, observed in seconds
+    """
+
+    def __init__(self, name, documentation, label_names=(), buckets=PHASE_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, value, **labels):
+        label_values = tuple(labels.get(name, '') for name in self.label_names)
+        with _metrics_lock:
+            series = self._series.setdefault(label_values, {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0})
+            for i, bucket in enumerate(self.buckets):
+                if value <= bucket:
+                    series['buckets'][i] += 1
+            series['sum'] += value
+            series['count'] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observes the time spent in the with block, whether it raises or not
+        """
+        start_time = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start_time, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, series in sorted(self._series.items()):
+            for bucket, bucket_count in zip(self.buckets, series['buckets']):
+                le = [('le', format_value(bucket))]
+                lines.append(f'{self.name}_bucket{format_labels(self.label_names, label_values, le)} {bucket_count}')
+            lines.append(f'{self.name}_bucket{format_labels(self.label_names, label_values, [("le", "+Inf")])} {series["count"]}')
+            lines.append(f'{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(series["sum"])}')
+            lines.append(f'{self.name}_count{format_labels(self.label_names, label_values)} {series["count"]}')
+        return lines
+
+
+class Gauge:
+    """
+    Prometheus gauge
+    """
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._series = {}
+        _registry.append(self)
+
+    def set(self, value, **labels):
+        with _metrics_lock:
+            self._series[tuple(labels.get(name, '') for name in self.label_names)] = value
+
+    def inc(self, amount=1, **labels):
+        label_values = tuple(labels.get(name, '') for name in self.label_names)
+        with _metrics_lock:
+            self._series[label_values] = self._series.get(label_values, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(self._series.items()):
+            lines.append(f'{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}')
+        return lines
+
+
+NODE_CORDON_SECONDS = Histogram('eksrollup_node_cordon_duration_seconds', 'Time spent cordoning or tainting a node')
+NODE_DRAIN_SECONDS = Histogram('eksrollup_node_drain_duration_seconds', 'Time spent draining a node')
+NODE_DELETE_SECONDS = Histogram('eksrollup_node_delete_duration_seconds', 'Time spent deleting a node')
+INSTANCE_TERMINATE_SECONDS = Histogram('eksrollup_instance_terminate_duration_seconds',
+                                       'Time from the termination request of an instance until it is terminated')
+HEALTH_WAIT_SECONDS = Histogram('eksrollup_cluster_health_wait_seconds',
+                                'Time spent waiting for the cluster to be healthy after scaling an ASG', ['asg'])
+API_CALL_SECONDS = Histogram('eksrollup_api_call_duration_seconds', 'Latency of AWS and Kubernetes API calls',
+                             ['api', 'operation'], buckets=API_BUCKETS)
+OUTDATED_INSTANCES = Gauge('eksrollup_outdated_instances', 'Number of outdated instances planned for rolling', ['asg'])
+REMAINING_INSTANCES = Gauge('eksrollup_remaining_instances', 'Number of outdated instances left to roll', ['asg'])
+
+
+def render_metrics():
+    """
+    Returns all metrics in the Prometheus text exposition format
+    """
+    with _metrics_lock:
+        lines = [line for metric in _registry for line in metric.render()]
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_file(path=None):
+    """
+    Writes all metrics to METRICS_FILE, e.g. for the node exporter textfile collector or to push to a Pushgateway.
+    The file is replaced atomically so it is never scraped half written
+    """
+    path = path or app_config['METRICS_FILE']
+    if not path:
+        return
+    # a temporary file per process, so separate runs sharing METRICS_FILE never replace each other's
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    # ASGs and clusters rolled concurrently all write the same file
+    with _metrics_file_lock:
+        with open(tmp_path, 'w') as metrics_file:
+            metrics_file.write(render_metrics())
+        os.replace(tmp_path, path)
+
+
+def read_histogram_totals(path=None):
+    """
+    Reads the sum and count of each histogram from a metrics file written by a previous run, added up across
+    label values. Returns an empty dict when there is no such file
+    """
+    path = path or app_config['METRICS_FILE']
+    totals = {}
+    if not path or not os.path.exists(path):
+        return totals
+    with open(path) as metrics_file:
+        for line in metrics_file:
+            if line.startswith('#') or not line.strip():
+                continue
+            series, value = line.rsplit(' ', 1)
+            name = series.split('{', 1)[0]
+            for suffix, index in (('_sum', 0), ('_count', 1)):
+                if name.endswith(suffix):
+                    total = totals.setdefault(name[:-len(suffix)], [0.0, 0])
+                    total[index] += float(value)
+    return {name: tuple(total) for name, total in totals.items()}
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port=None):
+    """
+    Serves all metrics over HTTP on METRICS_PORT for the duration of the run. Returns the server, or None if disabled
+    """
+    port = app_config['METRICS_PORT'] if port is None else port
+    if not port:
+        return None
+    server = ThreadingHTTPServer(('', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f'Serving metrics on port {server.server_address[1]}')
+    return server
@@ -0,0 +1,58 @@
+import logging
+import contextvars
+from collections import namedtuple
+from contextlib import contextmanager
+
+# a cluster rolled in fleet mode, along with the AWS region and kube context to reach it through
+ClusterTarget = namedtuple('ClusterTarget', ['cluster_name', 'region', 'k8s_context'])
+
+_current_target = contextvars.ContextVar('eksrollup_target', default=None)
+
+
+def get_target():
+    """
+    Returns the cluster target being rolled by the current thread or task, or None outside of fleet mode
+    """
+    return _current_target.get()
+
+
+@contextmanager
+def use_target(target):
+    """
+    Points the AWS clients, kubernetes API client and journal at a cluster target for the duration of the with block
+    """
+    token = _current_target.set(target)
+    try:
+        yield target
+    finally:
+        _current_target.reset(token)
+
+
+def get_target_region():
+    target = get_target()
+    return target.region if target else None
+
+
+def get_target_k8s_context():
+    target = get_target()
+    return target.k8s_context if target else None
+
+
+def submit(executor, func, *args, **kwargs):
+    """
+    Submits a call to an executor in a copy of the current context, so it runs against the same cluster target
+    """
+    return executor.submit(contextvars.copy_context().run, func, *args, **kwargs)
+
+
+class TargetLogFilter(logging.Filter):
+    """
+    Prefixes log messages with the name of the cluster target they were logged for
+    """
+
+    def filter(self, record):
+        target = get_target()
+        if target and not getattr(record, 'cluster_name', None):
+            record.cluster_name = target.cluster_name
+            record.msg = '[{}] {}'.format(target.cluster_name, record.msg)
+        return True
@@ -0,0 +1,222 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from .config import app_config
+from .lib.logger import logger
+from .lib.aws import plan_asgs, plan_asgs_older_nodes, get_asg, put_termination_lifecycle_hook, delete_lifecycle_hook, \
+    complete_lifecycle_action, start_instance_refresh, get_instance_refreshes, get_active_instance_refresh, \
+    cancel_instance_refresh, record_lifecycle_action_heartbeat
+from .lib.k8s import get_k8s_nodes, get_k8s_node_index, drain_node, delete_node
+from .lib.journal import journal
+from .lib.budget import rollout_budget
+from .lib.target import submit
+from .lib.metrics import NODE_DRAIN_SECONDS, NODE_DELETE_SECONDS, OUTDATED_INSTANCES, REMAINING_INSTANCES
+from .lib.exceptions import RollingUpdateException
+
+LIFECYCLE_HOOK_NAME = 'eks-rolling-update-drain'
+# statuses of an instance refresh which will not replace any more instances
+FINISHED_REFRESH_STATUSES = ['Successful', 'Failed', 'Cancelled', 'RollbackSuccessful', 'RollbackFailed']
+
+
+def get_refresh_preferences(asg):
+    """
+    Returns the instance refresh preferences of an ASG. Instances already running the launch template of the ASG
+    are skipped, as the other engines do, but AWS cannot match launch configurations or node age (RUN_MODE 4),
+    so every instance is replaced then
+    """
+    preferences = {
+        'MinHealthyPercentage': app_config['INSTANCE_REFRESH_MIN_HEALTHY'],
+        'InstanceWarmup': app_config['INSTANCE_REFRESH_WARMUP'],
+    }
+    if app_config['RUN_MODE'] != 4 and (asg.get('LaunchTemplate') or asg.get('MixedInstancesPolicy')):
+        preferences['SkipMatching'] = True
+    return preferences
+
+
+def release_terminating_instance(asg_name, instance_id, k8s_node_index, planned_instance_ids):
+    """
+    Drains and deletes the node of an instance held in Terminating:Wait by the lifecycle hook, then completes the
+    lifecycle action so AWS terminates it. Returns the time spent draining
+    """
+    start_time = time.time()
+    if instance_id not in k8s_node_index:
+        # the node may have joined after the index was built
+        k8s_node_index.update(get_k8s_node_index(get_k8s_nodes(projected=True)))
+    node_name = k8s_node_index.get(instance_id)
+    if node_name is None:
+        logger.info(f'Instance {instance_id} has no k8s node, letting it terminate')
+    elif not journal.reached(instance_id, 'deleted'):
+        if not journal.reached(instance_id, 'drained'):
+            with rollout_budget.drain():
+                drain_node(node_name)
+            NODE_DRAIN_SECONDS.observe(time.time() - start_time)
+            journal.record(instance_id, 'drained')
+        with NODE_DELETE_SECONDS.time():
+            delete_node(node_name)
+        journal.record(instance_id, 'deleted')
+    drain_duration = time.time() - start_time
+    complete_lifecycle_action(asg_name, LIFECYCLE_HOOK_NAME, instance_id)
+    journal.record(instance_id, 'terminated')
+    if instance_id in planned_instance_ids:
+        REMAINING_INSTANCES.dec(asg=asg_name)
+    logger.info(f'Instance {instance_id} (node {node_name}) drained in {drain_duration:.1f}s and released for termination')
+    return drain_duration
+
+
+def record_heartbeats(asg_name, releases, heartbeats):
+    """
+    Extends the hold of the lifecycle hook on instances whose release is still queued behind other drains or still
+    draining, so INSTANCE_REFRESH_HOOK_TIMEOUT does not let AWS terminate them undrained. heartbeats holds when each
+    instance was last known to be held afresh, and is updated with the heartbeats sent
+    """
+    heartbeat_interval = app_config['INSTANCE_REFRESH_HOOK_TIMEOUT'] / 2
+    now = time.time()
+    for instance_id, release in releases.items():
+        if release.done() or now - heartbeats[instance_id] < heartbeat_interval:
+            continue
+        try:
+            record_lifecycle_action_heartbeat(asg_name, LIFECYCLE_HOOK_NAME, instance_id)
+            heartbeats[instance_id] = now
+        except Exception as heartbeat_exception:
+            # the release may have completed the lifecycle action in the meantime
+            logger.info(f'Could not record heartbeat for instance {instance_id}: {heartbeat_exception}')
+
+
+def cancel_unfinished_refresh(asg_name, refresh_id, refresh):
+    """
+    Cancels an instance refresh which was started or resumed but has not finished yet, unless it is already being
+    cancelled. Returns the refresh as last known
+    """
+    if refresh_id is None or (refresh is not None and refresh['Status'] in FINISHED_REFRESH_STATUSES + ['Cancelling']):
+        return refresh
+    cancel_instance_refresh(asg_name)
+    return dict(refresh or {'InstanceRefreshId': refresh_id}, Status='Cancelling')
+
+
+def refresh_asg(asg_name, asg, outdated_instances, k8s_node_index, stopped=None):
+    """
+    Replaces the instances of an ASG through an instance refresh, resuming the one a previous run started if any.
+    A termination lifecycle hook holds each instance the refresh replaces until its node is drained, with up to
+    DRAIN_CONCURRENCY nodes drained at once, and heartbeats keep the others held. A failed drain, any other error or setting the stopped event cancels
+    the refresh before the hook is removed, so AWS does not go on replacing instances without draining them
+    """
+    planned_instance_ids = {outdated['InstanceId'] for outdated in outdated_instances}
+    drain_concurrency = max(app_config['DRAIN_CONCURRENCY'], 1)
+    stopped = stopped or threading.Event()
+    refresh_id = None
+    refresh = None
+    put_termination_lifecycle_hook(asg_name, LIFECYCLE_HOOK_NAME, app_config['INSTANCE_REFRESH_HOOK_TIMEOUT'])
+    try:
+        refresh = get_active_instance_refresh(asg_name)
+        if refresh:
+            refresh_id = refresh['InstanceRefreshId']
+            logger.info(f'Resuming instance refresh {refresh_id} of asg {asg_name}')
+            resumed = True
+        else:
+            refresh_id = start_instance_refresh(asg_name, get_refresh_preferences(asg))
+            resumed = False
+
+        releases = {}
+        heartbeats = {}
+        # instances already held when a refresh is resumed may have been held for a while
+        first_poll = resumed
+        failed_release = threading.Event()
+
+        def release(instance_id):
+            # stop picking up new instances once one of them has failed
+            if failed_release.is_set():
+                return None
+            try:
+                return release_terminating_instance(asg_name, instance_id, k8s_node_index, planned_instance_ids)
+            except Exception:
+                failed_release.set()
+                raise
+
+        executor = ThreadPoolExecutor(max_workers=drain_concurrency)
+        try:
+            while True:
+                # read the status first, as a refresh only finishes once all its instances were released
+                refresh = get_instance_refreshes(asg_name, [refresh_id])[0]
+                held_since = 0 if first_poll else time.time()
+                first_poll = False
+                for instance in get_asg(asg_name)['Instances']:
+                    instance_id = instance['InstanceId']
+                    if instance['LifecycleState'] == 'Terminating:Wait' and instance_id not in releases:
+                        releases[instance_id] = submit(executor, release, instance_id)
+                        heartbeats[instance_id] = held_since
+                failed = [instance_id for instance_id, release in releases.items() if release.done() and release.exception()]
+                if failed:
+                    for instance_id in failed:
+                        logger.info(f'Releasing instance {instance_id} failed: {releases[instance_id].exception()}')
+                    raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+                record_heartbeats(asg_name, releases, heartbeats)
+                if refresh['Status'] in FINISHED_REFRESH_STATUSES and all(release.done() for release in releases.values()):
+                    break
+                logger.info(f'Instance refresh of asg {asg_name} is {refresh["Status"]}, '
+                            f'{refresh.get("PercentageComplete", 0)}% complete...')
+                if stopped.wait(app_config['INSTANCE_REFRESH_POLL_WAIT']):
+                    raise RollingUpdateException("Rolling update on ASG interrupted", asg_name)
+        except BaseException:
+            # stop AWS from holding more instances before waiting for the drains already running
+            refresh = cancel_unfinished_refresh(asg_name, refresh_id, refresh)
+            raise
+        finally:
+            # drains which have not started are dropped, those already running are waited for
+            for release in releases.values():
+                release.cancel()
+            executor.shutdown(wait=True)
+        if refresh['Status'] != 'Successful':
+            logger.info(f'Instance refresh of asg {asg_name} ended as {refresh["Status"]}: {refresh.get("StatusReason")}')
+            raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+    finally:
+        try:
+            cancel_unfinished_refresh(asg_name, refresh_id, refresh)
+        finally:
+            delete_lifecycle_hook(asg_name, LIFECYCLE_HOOK_NAME)
+    logger.info(f'Instance refresh of asg {asg_name} released {len(releases)} instances')
+
+
+def refresh_asgs(asgs, cluster_name):
+    """
+    Rolls the ASGs with outdated instances through instance refreshes, up to ASG_CONCURRENCY at once. AWS launches
+    and terminates the instances while this process only drains the nodes being replaced.
+    Returns the number of outdated instances
+    """
+    if app_config['RUN_MODE'] == 4:
+        asg_outdated_instance_dict = plan_asgs_older_nodes(asgs)
+    else:
+        asg_outdated_instance_dict = plan_asgs(asgs)
+
+    journal.start(cluster_name)
+    for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items():
+        journal.plan(asg_name, [outdated['InstanceId'] for outdated in outdated_instances])
+        OUTDATED_INSTANCES.set(len(outdated_instances), asg=asg_name)
+        REMAINING_INSTANCES.set(len(outdated_instances), asg=asg_name)
+    planned_instance_count = sum(len(outdated_instances) for outdated_instances, _ in asg_outdated_instance_dict.values())
+
+    k8s_node_index = get_k8s_node_index(get_k8s_nodes(projected=True))
+    asg_concurrency = max(app_config['ASG_CONCURRENCY'], 1)
+    failed_asgs = []
+    # only the main thread is interrupted by Ctrl-C, the refreshes polling in the executor are told to stop
+    stopped = threading.Event()
+    with ThreadPoolExecutor(max_workers=asg_concurrency) as executor:
+        futures = {
+            submit(executor, refresh_asg, asg_name, asg, outdated_instances, k8s_node_index, stopped): asg_name
+            for asg_name, (outdated_instances, asg) in asg_outdated_instance_dict.items() if outdated_instances
+        }
+        try:
+            for future in as_completed(futures):
+                asg_name = futures[future]
+                try:
+                    future.result()
+                except (Exception, SystemExit) as asg_exception:
+                    logger.error(f'Instance refresh of asg {asg_name} failed: {asg_exception}')
+                    failed_asgs.append(asg_name)
+        except BaseException:
+            stopped.set()
+            raise
+    if failed_asgs:
+        raise RollingUpdateException("Rolling update on ASGs failed", ', '.join(sorted(failed_asgs)))
+    journal.finish()
+    logger.info('All asgs processed')
+    return planned_instance_count
@@ -2,8 +2,14 @@ import os
 import unittest
 import boto3
 import json
+import datetime
+import threading
+import time
 from moto import mock_autoscaling, mock_ec2
-from eksrollup.lib.aws import get_asg_tag, instance_outdated_launchconfiguration, count_all_cluster_instances, is_asg_healthy, is_asg_scaled, modify_aws_autoscaling, save_asg_tags, delete_asg_tags, instance_terminated
+from eksrollup.lib.aws import get_asg_tag, instance_outdated_launchconfiguration, count_all_cluster_instances, is_asg_healthy, is_asg_scaled, modify_aws_autoscaling, save_asg_tags, delete_asg_tags, instance_terminated, \
+    get_instance_launch_times, plan_asgs_older_nodes, InstanceTerminationTracker, save_asg_tags_batch, \
+    DesiredCapacityTagWriter, get_asgs, put_termination_lifecycle_hook, \
+    delete_lifecycle_hook, complete_lifecycle_action, start_instance_refresh, cancel_instance_refresh
 from unittest.mock import patch
 
 
@@ -149,3 +155,164 @@ class TestAWS(unittest.TestCase):
 
     def test_instance_terminated_fail(self):
         self.assertFalse(instance_terminated(self.instance_id, 2, 1))
+
+
+@mock_ec2
+class TestAWSInstances(unittest.TestCase):
+
+    def setUp(self):
+        ec2 = boto3.client('ec2')
+        response = ec2.run_instances(ImageId='ami-12c6146b', MinCount=3, MaxCount=3)
+        self.instance_ids = [instance['InstanceId'] for instance in response['Instances']]
+
+    def test_get_instance_launch_times(self):
+        with patch('eksrollup.lib.aws.DESCRIBE_INSTANCES_BATCH_SIZE', 2):
+            launch_times = get_instance_launch_times(self.instance_ids)
+        self.assertEqual(sorted(launch_times), sorted(self.instance_ids))
+
+    @patch.dict('eksrollup.lib.aws.app_config', {'MAX_ALLOWABLE_NODE_AGE': 6})
+    def test_plan_asgs_older_nodes(self):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        launch_times = {
+            'i-old': now - datetime.timedelta(days=7),
+            'i-new': now - datetime.timedelta(days=1),
+        }
+        asgs = [
+            {'AutoScalingGroupName': 'asg-a', 'Instances': [{'InstanceId': 'i-old'}]},
+            {'AutoScalingGroupName': 'asg-b', 'Instances': [{'InstanceId': 'i-new'}]},
+        ]
+        with patch('eksrollup.lib.aws.get_instance_launch_times', return_value=launch_times) as launch_times_mock, \
+                patch('eksrollup.lib.aws.ec2_client.describe_instances') as describe_instances_mock:
+            plan = plan_asgs_older_nodes(asgs)
+            launch_times_mock.assert_called_once_with(['i-old', 'i-new'])
+            describe_instances_mock.assert_not_called()
+        self.assertEqual(plan['asg-a'][0], [{'InstanceId': 'i-old'}])
+        self.assertEqual(plan['asg-b'][0], [])
+
+    @patch.dict('eksrollup.lib.aws.app_config', {'MAX_ALLOWABLE_NODE_AGE': 6})
+    def test_plan_asgs_older_nodes_generator(self):
+        launch_times = {'i-old': datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc)}
+        # get_asgs may return a single-use generator of asgs
+        asgs = (asg for asg in [{'AutoScalingGroupName': 'asg-a', 'Instances': [{'InstanceId': 'i-old'}]}])
+        with patch('eksrollup.lib.aws.get_instance_launch_times', return_value=launch_times):
+            plan = plan_asgs_older_nodes(asgs)
+        self.assertEqual(plan['asg-a'][0], [{'InstanceId': 'i-old'}])
+
+
+class TestInstanceTerminationTracker(unittest.TestCase):
+
+    def describe(self, states):
+        return [{'InstanceId': instance_id, 'State': {'Name': state}} for instance_id, state in states.items()]
+
+    def test_wait_for_batched(self):
+        responses = [
+            self.describe({'i-1': 'running', 'i-2': 'shutting-down'}),
+            self.describe({'i-1': 'shutting-down', 'i-2': 'terminated'}),
+            self.describe({'i-1': 'terminated'}),
+        ]
+        stopped = []
+        tracker = InstanceTerminationTracker(max_retry=100, wait=0.04, wait_for_stopping=False)
+        with patch('eksrollup.lib.aws.describe_instances', side_effect=responses + [[]] * 10) as describe_instances_mock:
+            events = [tracker.track(instance_id, lambda instance_id, state: stopped.append(instance_id)) for instance_id in ['i-1', 'i-2']]
+            for event in events:
+                self.assertTrue(event.wait(5))
+            polled_ids = [sorted(call[0][0]) for call in describe_instances_mock.call_args_list]
+        self.assertIn(['i-1', 'i-2'], polled_ids)
+        self.assertEqual(sorted(stopped), ['i-1', 'i-2'])
+
+    def test_wait_for_stopping(self):
+        tracker = InstanceTerminationTracker(max_retry=100, wait=0.04, wait_for_stopping=True)
+        with patch('eksrollup.lib.aws.describe_instances', return_value=self.describe({'i-1': 'shutting-down'})):
+            self.assertTrue(tracker.wait_for('i-1'))
+
+    def test_wait_for_timeout(self):
+        tracker = InstanceTerminationTracker(max_retry=2, wait=0.04, wait_for_stopping=False)
+        with patch('eksrollup.lib.aws.describe_instances', return_value=self.describe({'i-1': 'running'})):
+            self.assertFalse(tracker.wait_for('i-1'))
+
+
+    def test_wait_for_duplicate_and_failing_callback(self):
+        tracker = InstanceTerminationTracker(max_retry=100, wait=0.04, wait_for_stopping=False)
+        stopped = []
+
+        def failing_callback(instance_id, state):
+            raise Exception('callback failed')
+
+        tracked = threading.Event()
+
+        def describe_instances(instance_ids):
+            tracked.wait(5)
+            return self.describe({instance_id: 'terminated' for instance_id in instance_ids})
+
+        with patch('eksrollup.lib.aws.describe_instances', side_effect=describe_instances):
+            first = tracker.track('i-1', failing_callback)
+            second = tracker.track('i-1', lambda instance_id, state: stopped.append(instance_id))
+            tracked.set()
+            self.assertIs(first, second)
+            self.assertTrue(first.wait(5))
+            # the poller outlived the failing callback
+            self.assertTrue(tracker.wait_for('i-2'))
+        self.assertEqual(stopped, ['i-1'])
+
+    def test_wait_for_dead_poller(self):
+        tracker = InstanceTerminationTracker(max_retry=2, wait=0.04, wait_for_stopping=False)
+        with patch.object(tracker, '_poll'):
+            self.assertFalse(tracker.wait_for('i-1'))
+
+@mock_autoscaling
+class TestAWSTags(unittest.TestCase):
+
+    def setUp(self):
+        client = boto3.client('autoscaling')
+        client.create_launch_configuration(LaunchConfigurationName='mock-lc-01', ImageId='ami-12c6146b', InstanceType='t2.micro')
+        client.create_auto_scaling_group(AutoScalingGroupName='mock-asg', LaunchConfigurationName='mock-lc-01',
+                                         MinSize=0, MaxSize=1, DesiredCapacity=0, AvailabilityZones=['us-east-1a'])
+        client.create_auto_scaling_group(AutoScalingGroupName='mock-asg-owned', LaunchConfigurationName='mock-lc-01',
+                                         MinSize=0, MaxSize=1, DesiredCapacity=0, AvailabilityZones=['us-east-1a'],
+                                         Tags=[{'Key': 'kubernetes.io/cluster/mock-cluster', 'Value': 'owned'}])
+
+    def test_get_asgs_by_name(self):
+        asgs = get_asgs('mock-cluster', ['mock-asg-owned', 'mock-asg', 'mock-asg-missing'])
+        # only named asgs owned by the cluster are returned
+        self.assertEqual([asg['AutoScalingGroupName'] for asg in asgs], ['mock-asg-owned'])
+        self.assertEqual(get_asgs('mock-cluster', ['mock-asg']), [])
+
+    def test_save_asg_tags_batch(self):
+        with patch('eksrollup.lib.aws.client.create_or_update_tags', wraps=boto3.client('autoscaling').create_or_update_tags) as create_or_update_tags_mock:
+            save_asg_tags_batch('mock-asg', {'foo': 1, 'bar': 2, 'baz': 3})
+            self.assertEqual(create_or_update_tags_mock.call_count, 1)
+        response = boto3.client('autoscaling').describe_auto_scaling_groups(AutoScalingGroupNames=['mock-asg'])
+        tags = {tag['Key']: tag['Value'] for tag in response['AutoScalingGroups'][0]['Tags']}
+        self.assertEqual(tags, {'foo': '1', 'bar': '2', 'baz': '3'})
+
+    def test_instance_refresh_dry_run(self):
+        with patch.dict('eksrollup.lib.aws.app_config', {'DRY_RUN': True}), \
+                patch('eksrollup.lib.aws.client') as client_mock:
+            put_termination_lifecycle_hook('mock-asg', 'mock-hook', 60)
+            self.assertIsNone(start_instance_refresh('mock-asg', {}))
+            complete_lifecycle_action('mock-asg', 'mock-hook', 'i-0')
+            cancel_instance_refresh('mock-asg')
+            delete_lifecycle_hook('mock-asg', 'mock-hook')
+        self.assertEqual(client_mock.mock_calls, [])
+
+    def test_desired_capacity_tag_writer_coalesces(self):
+        saved = []
+
+        def save_asg_tags(asg_name, key, value):
+            time.sleep(0.05)
+            saved.append(value)
+
+        writer = DesiredCapacityTagWriter('mock-asg', 10)
+        results = []
+        with patch('eksrollup.lib.aws.save_asg_tags', side_effect=save_asg_tags):
+            threads = [threading.Thread(target=lambda: results.append((writer.decrement(), list(saved)))) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertLess(len(saved), 5)
+        self.assertEqual(saved[-1], 5)
+        self.assertEqual(saved, sorted(saved, reverse=True))
+        # every decrement returned only once its value or a lower one was saved
+        for target, saved_before_return in results:
+            self.assertLessEqual(min(saved_before_return), target)
@@ -0,0 +1,39 @@
+import time
+import unittest
+from moto import mock_autoscaling
+from unittest.mock import patch
+from eksrollup.lib.aws_api import TokenBucket, get_api_family, create_client, api_stats, _count_throttle
+
+
+class TestAWSApi(unittest.TestCase):
+
+    def test_get_api_family(self):
+        self.assertEqual(get_api_family('autoscaling', 'DescribeAutoScalingGroups'), 'autoscaling.describe')
+        self.assertEqual(get_api_family('autoscaling', 'UpdateAutoScalingGroup'), 'autoscaling.mutate')
+        self.assertEqual(get_api_family('ec2', 'DescribeInstances'), 'ec2.describe')
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=50, capacity=2)
+        start = time.monotonic()
+        for _ in range(7):
+            bucket.acquire()
+        # 2 tokens available upfront, the remaining 5 are refilled at 50 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+    @mock_autoscaling
+    @patch.dict('eksrollup.lib.aws_api.app_config', {'AWS_API_RATE_LIMIT': 0})
+    def test_create_client_records_calls(self):
+        autoscaling = create_client('autoscaling', region_name='us-east-1')
+        calls = api_stats['autoscaling.DescribeAutoScalingGroups']['calls']
+        autoscaling.describe_auto_scaling_groups()
+        autoscaling.get_paginator('describe_auto_scaling_groups').paginate().build_full_result()
+        self.assertEqual(api_stats['autoscaling.DescribeAutoScalingGroups']['calls'], calls + 2)
+
+    def test_count_throttles(self):
+        autoscaling = create_client('autoscaling', region_name='us-east-1')
+        operation = autoscaling.meta.service_model.operation_model('DescribeAutoScalingGroups')
+        throttles = api_stats['autoscaling.DescribeAutoScalingGroups']['throttles']
+        _count_throttle(response=(None, {'Error': {'Code': 'Throttling'}}), operation=operation)
+        _count_throttle(response=(None, {'Error': {'Code': 'ValidationError'}}), operation=operation)
+        _count_throttle(response=None, operation=operation)
+        self.assertEqual(api_stats['autoscaling.DescribeAutoScalingGroups']['throttles'], throttles + 1)
@@ -2,7 +2,7 @@ import os
 import unittest
 import json
 from moto import mock_autoscaling, mock_ec2
-from eksrollup.lib.aws import instance_outdated_launchtemplate
+from eksrollup.lib.aws import instance_outdated_launchtemplate, get_launchtemplate_outdated_reason, plan_asgs
 from unittest.mock import patch
 
 
@@ -45,6 +45,11 @@ class TestAWS(unittest.TestCase):
             instances = asg['Instances']
             self.assertTrue(instance_outdated_launchtemplate(instances[2], 'mock-lt-01', '2'))
 
+    def test_launchtemplate_outdated_reason(self):
+        instances = self.aws_response_mock['AutoScalingGroups'][0]['Instances']
+        self.assertIsNone(get_launchtemplate_outdated_reason(instances[0], 'mock-lt-01', '2'))
+        self.assertIn('version', get_launchtemplate_outdated_reason(instances[2], 'mock-lt-01', '2'))
+
     def test_is_instance_outdated_fail_version_default(self):
         response = self.aws_response_mock_default
         asgs = response['AutoScalingGroups']
@@ -90,3 +95,42 @@ class TestAWS(unittest.TestCase):
                 get_launch_template_mock.return_value = self.mock_get_launch_template
                 self.assertTrue(instance_outdated_launchtemplate(instances[0], 'mock-lt-01', '$Latest'))
 
+    def test_plan_asgs_describes_launch_template_once(self):
+        asgs = self.aws_response_mock_latest['AutoScalingGroups']
+        with patch('eksrollup.lib.aws.get_launch_templates') as get_launch_templates_mock, \
+                patch('eksrollup.lib.aws.get_launch_template') as get_launch_template_mock:
+            get_launch_templates_mock.return_value = {'mock-lt-01': self.mock_get_launch_template}
+            plan = plan_asgs(asgs)
+            get_launch_templates_mock.assert_called_once_with(['mock-lt-01'])
+            get_launch_template_mock.assert_not_called()
+        outdated_instances, asg = plan['mock-asg']
+        self.assertEqual(len(outdated_instances), 2)
+
+    def test_plan_asgs_generator(self):
+        # get_asgs may return a single-use generator of asgs
+        asgs = (asg for asg in self.aws_response_mock_latest['AutoScalingGroups'])
+        with patch('eksrollup.lib.aws.get_launch_templates') as get_launch_templates_mock:
+            get_launch_templates_mock.return_value = {'mock-lt-01': self.mock_get_launch_template}
+            plan = plan_asgs(asgs)
+        get_launch_templates_mock.assert_called_once_with(['mock-lt-01'])
+        outdated_instances, asg = plan['mock-asg']
+        self.assertEqual(len(outdated_instances), 2)
+
+    def test_plan_asgs_mixed_instances_policy_overrides(self):
+        asg = dict(self.aws_response_mock_latest['AutoScalingGroups'][0])
+        del asg['LaunchTemplate']
+        asg['MixedInstancesPolicy'] = {
+            'LaunchTemplate': {
+                'LaunchTemplateSpecification': {'LaunchTemplateName': 'mock-lt-01', 'Version': '$Default'},
+                'Overrides': [
+                    {'InstanceType': 'm5.large'},
+                    {'InstanceType': 'm6g.large',
+                     'LaunchTemplateSpecification': {'LaunchTemplateName': 'mock-lt-00', 'Version': '2'}},
+                ]
+            }
+        }
+        with patch('eksrollup.lib.aws.get_launch_templates') as get_launch_templates_mock:
+            get_launch_templates_mock.return_value = {'mock-lt-01': self.mock_get_launch_template}
+            plan = plan_asgs([asg])
+        outdated_instances, asg = plan['mock-asg']
+        self.assertNotIn('mock-lt-00', [instance['LaunchTemplate']['LaunchTemplateName'] for instance in outdated_instances])
@@ -0,0 +1,357 @@
+import os
+import sys
+import asyncio
+import threading
+import subprocess
+import time
+import unittest
+from unittest.mock import patch, call
+from box import Box
+from eksrollup.cli import update_asgs, drain_outdated_instances, order_by_availability_zone, cluster_snapshot_healthy, \
+    surge_outdated_instances, build_plan, prioritize_outdated_instances, prepare_warm_pool
+from eksrollup.aio import update_asgs_async, drain_outdated_instances_async, run_steps_async
+from eksrollup.lib.exceptions import RollingUpdateException
+
+
+def mock_asg(asg_name):
+    return {
+        'AutoScalingGroupName': asg_name,
+        'Instances': [{'InstanceId': f'i-{asg_name}', 'AvailabilityZone': 'us-east-1a'}]
+    }
+
+
+def mock_node(instance_id, ready='True'):
+    return Box({
+        'metadata': {'name': f'node-{instance_id}', 'labels': {}},
+        'spec': {'provider_id': f'aws:///us-east-1a/{instance_id}'},
+        'status': {'conditions': [{'type': 'Ready', 'status': ready}]}
+    })
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.asgs = [mock_asg('asg-a'), mock_asg('asg-b'), mock_asg('asg-c')]
+        self.plan = {asg['AutoScalingGroupName']: (asg['Instances'], asg) for asg in self.asgs}
+
+    @patch.dict('eksrollup.cli.app_config', {'RUN_MODE': 1, 'ASG_CONCURRENCY': 1})
+    def test_update_asgs_sequential(self):
+        with patch('eksrollup.cli.plan_asgs') as plan_asgs_mock, \
+                patch('eksrollup.cli.get_k8s_nodes'), \
+                patch('eksrollup.cli.update_asg') as update_asg_mock:
+            plan_asgs_mock.return_value = self.plan
+            update_asgs(self.asgs, 'mock-cluster')
+            rolled = [call[0][0] for call in update_asg_mock.call_args_list]
+            self.assertEqual(rolled, ['asg-a', 'asg-b', 'asg-c'])
+
+    @patch.dict('eksrollup.cli.app_config', {'RUN_MODE': 1, 'ASG_CONCURRENCY': 3})
+    def test_update_asgs_concurrent(self):
+        with patch('eksrollup.cli.plan_asgs') as plan_asgs_mock, \
+                patch('eksrollup.cli.get_k8s_nodes'), \
+                patch('eksrollup.cli.update_asg') as update_asg_mock:
+            plan_asgs_mock.return_value = self.plan
+            update_asgs(self.asgs, 'mock-cluster')
+            rolled = sorted(call[0][0] for call in update_asg_mock.call_args_list)
+            self.assertEqual(rolled, ['asg-a', 'asg-b', 'asg-c'])
+
+    @patch.dict('eksrollup.cli.app_config', {'RUN_MODE': 1, 'ASG_CONCURRENCY': 2})
+    def test_update_asgs_concurrent_failure_isolated(self):
+        def update_asg(asg_name, *args):
+            if asg_name == 'asg-b':
+                raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+
+        with patch('eksrollup.cli.plan_asgs') as plan_asgs_mock, \
+                patch('eksrollup.cli.get_k8s_nodes'), \
+                patch('eksrollup.cli.update_asg', side_effect=update_asg) as update_asg_mock:
+            plan_asgs_mock.return_value = self.plan
+            with self.assertRaises(RollingUpdateException) as context:
+                update_asgs(self.asgs, 'mock-cluster')
+            self.assertEqual(context.exception.asg_name, 'asg-b')
+            self.assertEqual(update_asg_mock.call_count, 3)
+
+    def test_order_by_availability_zone(self):
+        instances = [
+            {'InstanceId': 'i-1', 'AvailabilityZone': 'us-east-1a'},
+            {'InstanceId': 'i-2', 'AvailabilityZone': 'us-east-1a'},
+            {'InstanceId': 'i-3', 'AvailabilityZone': 'us-east-1b'},
+            {'InstanceId': 'i-4', 'AvailabilityZone': 'us-east-1b'},
+            {'InstanceId': 'i-5', 'AvailabilityZone': 'us-east-1c'},
+        ]
+        ordered = [instance['InstanceId'] for instance in order_by_availability_zone(instances)]
+        self.assertEqual(ordered, ['i-1', 'i-3', 'i-5', 'i-2', 'i-4'])
+
+    @patch.dict('eksrollup.cli.app_config', {'DRAIN_CONCURRENCY': 4, 'DRAIN_CONCURRENCY_PER_AZ': 1})
+    def test_drain_outdated_instances_per_az_limit(self):
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': f'us-east-1{"ab"[i % 2]}'} for i in range(6)]
+        lock = threading.Lock()
+        in_flight = {'us-east-1a': 0, 'us-east-1b': 0}
+        peak = {'us-east-1a': 0, 'us-east-1b': 0}
+
+        def roll(outdated, *args):
+            az = outdated['AvailabilityZone']
+            with lock:
+                in_flight[az] += 1
+                peak[az] = max(peak[az], in_flight[az])
+            time.sleep(0.01)
+            with lock:
+                in_flight[az] -= 1
+            return 1.0, 2.0
+
+        with patch('eksrollup.cli.roll_outdated_instance', side_effect=roll):
+            timings = drain_outdated_instances('mock-asg', instances, [], lambda: None)
+        self.assertEqual(len(timings), 6)
+        self.assertEqual(peak, {'us-east-1a': 1, 'us-east-1b': 1})
+
+    @patch.dict('eksrollup.cli.app_config', {'DRAIN_CONCURRENCY': 2, 'DRAIN_CONCURRENCY_PER_AZ': 0})
+    def test_drain_outdated_instances_failure(self):
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': 'us-east-1a'} for i in range(6)]
+
+        def roll(outdated, *args):
+            time.sleep(0.01)
+            raise Exception('Node not drained properly. Exiting')
+
+        with patch('eksrollup.cli.roll_outdated_instance', side_effect=roll) as roll_mock:
+            with self.assertRaises(RollingUpdateException):
+                drain_outdated_instances('mock-asg', instances, [], lambda: None)
+        self.assertLess(roll_mock.call_count, 6)
+
+    def snapshot(self, instance_count, node_count, ready='True'):
+        instances = [{'InstanceId': f'i-{i}', 'HealthStatus': 'Healthy'} for i in range(instance_count)]
+        asg = {'AutoScalingGroupName': 'mock-asg', 'DesiredCapacity': instance_count, 'Instances': instances}
+        return [asg], [mock_node(f'i-{i}', ready) for i in range(node_count)]
+
+    @patch.dict('eksrollup.cli.app_config', {'GLOBAL_MAX_RETRY': 3, 'GLOBAL_HEALTH_WAIT': 0, 'K8S_NODE_WATCH': False})
+    def test_cluster_snapshot_healthy(self):
+        with patch('eksrollup.cli.get_cluster_snapshot', return_value=self.snapshot(3, 3)) as snapshot_mock:
+            self.assertTrue(cluster_snapshot_healthy('mock-asg', 3, 'mock-cluster', False))
+            self.assertEqual(snapshot_mock.call_count, 1)
+
+    @patch.dict('eksrollup.cli.app_config', {'GLOBAL_MAX_RETRY': 3, 'GLOBAL_HEALTH_WAIT': 0, 'K8S_NODE_WATCH': False})
+    def test_cluster_snapshot_healthy_not_scaled(self):
+        with patch('eksrollup.cli.get_cluster_snapshot', return_value=self.snapshot(2, 2)) as snapshot_mock:
+            self.assertFalse(cluster_snapshot_healthy('mock-asg', 3, 'mock-cluster', False))
+            self.assertEqual(snapshot_mock.call_count, 1)
+
+    @patch.dict('eksrollup.cli.app_config', {'GLOBAL_MAX_RETRY': 3, 'GLOBAL_HEALTH_WAIT': 0, 'K8S_NODE_WATCH': False})
+    def test_cluster_snapshot_healthy_retries_node_readiness(self):
+        snapshots = [self.snapshot(3, 3, 'False'), self.snapshot(3, 3)]
+        with patch('eksrollup.cli.get_cluster_snapshot', side_effect=snapshots) as snapshot_mock:
+            self.assertTrue(cluster_snapshot_healthy('mock-asg', 3, 'mock-cluster', True))
+            self.assertEqual(snapshot_mock.call_count, 2)
+
+    @patch.dict('eksrollup.cli.app_config', {'GLOBAL_MAX_RETRY': 3, 'GLOBAL_HEALTH_WAIT': 0, 'K8S_NODE_WATCH': False})
+    def test_cluster_snapshot_healthy_node_count_fail(self):
+        with patch('eksrollup.cli.get_cluster_snapshot', return_value=self.snapshot(3, 2, 'True')):
+            self.assertFalse(cluster_snapshot_healthy('mock-asg', 3, 'mock-cluster', True))
+
+    @patch.dict('eksrollup.cli.app_config', {'GLOBAL_MAX_RETRY': 3, 'GLOBAL_HEALTH_WAIT': 5, 'K8S_NODE_WATCH': True})
+    def test_cluster_snapshot_healthy_node_watch(self):
+        with patch('eksrollup.cli.get_cluster_snapshot', return_value=self.snapshot(3, 2)), \
+                patch('eksrollup.cli.k8s_nodes_count', return_value=False) as nodes_count_mock, \
+                patch('eksrollup.cli.time.sleep'):
+            self.assertFalse(cluster_snapshot_healthy('mock-asg', 3, 'mock-cluster', False))
+        # each attempt of the retries only watches the nodes for one GLOBAL_HEALTH_WAIT
+        self.assertEqual(nodes_count_mock.call_count, 2)
+        self.assertEqual(nodes_count_mock.call_args_list[0], call(2, 1, 5))
+
+    @patch.dict('eksrollup.cli.app_config', {'RUN_MODE': 1, 'MAX_SURGE': 2, 'ASG_USE_TERMINATION_POLICY': False})
+    def test_surge_outdated_instances(self):
+        asg = {'AutoScalingGroupName': 'mock-asg', 'DesiredCapacity': 5, 'MaxSize': 6, 'Tags': []}
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': 'us-east-1a'} for i in range(5)]
+        drained = []
+        with patch('eksrollup.cli.modify_aws_autoscaling'), \
+                patch('eksrollup.cli.save_asg_tags_batch'), \
+                patch('eksrollup.cli.save_asg_tags'), \
+                patch('eksrollup.cli.scale_asg') as scale_asg_mock, \
+                patch('eksrollup.cli.validate_cluster_health') as validate_mock, \
+                patch('eksrollup.cli.cordon_outdated_nodes'), \
+                patch('eksrollup.cli.drain_outdated_instances',
+                      side_effect=lambda outdated_instances, **kwargs: drained.append([i['InstanceId'] for i in outdated_instances])):
+            asg_state = surge_outdated_instances('mock-cluster', asg, instances, {})
+        self.assertEqual(drained, [['i-0', 'i-1'], ['i-2', 'i-3'], ['i-4']])
+        # the asg never goes above its original capacity plus MAX_SURGE
+        self.assertEqual([c[0][1:] for c in scale_asg_mock.call_args_list], [(5, 7, 7), (5, 7, 7), (5, 6, 6)])
+        self.assertEqual([c[1]['new_desired_asg_capacity'] for c in validate_mock.call_args_list], [7, 7, 6])
+        self.assertEqual(asg_state, (5, 5, 6))
+
+    @patch.dict('eksrollup.cli.app_config', {
+        'RUN_MODE': 1, 'MAX_SURGE': 0, 'BATCH_SIZE': 0, 'ASG_CONCURRENCY': 2, 'DRAIN_CONCURRENCY': 1,
+        'CLUSTER_HEALTH_WAIT': 90, 'GLOBAL_HEALTH_WAIT': 20, 'BETWEEN_NODES_WAIT': 0, 'METRICS_FILE': ''})
+    def test_build_plan(self):
+        def plan_asgs(asgs, reasons):
+            reasons.update({asg['Instances'][0]['InstanceId']: 'outdated' for asg in asgs})
+            return {asg['AutoScalingGroupName']: (asg['Instances'], asg) for asg in asgs}
+
+        asgs = [dict(mock_asg(asg_name), DesiredCapacity=1, MaxSize=2) for asg_name in ['asg-a', 'asg-b', 'asg-c']]
+        asgs[0]['Instances'].append({'InstanceId': 'i-asg-a-2', 'AvailabilityZone': 'us-east-1b'})
+        with patch('eksrollup.cli.plan_asgs', side_effect=plan_asgs):
+            plan = build_plan(asgs, 'mock-cluster')
+        self.assertEqual(plan['asgs'][0]['outdated_instances'], [
+            {'instance_id': 'i-asg-a', 'availability_zone': 'us-east-1a', 'reason': 'outdated'},
+            {'instance_id': 'i-asg-a-2', 'availability_zone': 'us-east-1b', 'reason': None},
+        ])
+        self.assertEqual([asg_plan['surge_capacity'] for asg_plan in plan['asgs']], [2, 1, 1])
+        # one health wait plus a drain and termination per instance
+        self.assertEqual([asg_plan['estimated_duration_seconds'] for asg_plan in plan['asgs']], [250, 170, 170])
+        # asg-b and asg-c are rolled one after the other while asg-a is rolled
+        self.assertEqual(plan['estimated_duration_seconds'], 340)
+        self.assertEqual(plan['peak_surge_capacity'], 3)
+        self.assertEqual(plan['outdated_instance_count'], 4)
+
+
+    @patch.dict('eksrollup.cli.app_config', {'RUN_MODE': 1, 'ASG_CONCURRENCY': 1, 'PRIORITY_DRAIN': True})
+    def test_update_asgs_priority_drain(self):
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': az} for i, az in enumerate(['a', 'a', 'b', 'b'])]
+        plan = {'asg-a': (instances, mock_asg('asg-a'))}
+        drain_costs = {'node-i-0': (2, 5), 'node-i-1': (0, 10), 'node-i-2': (0, 3), 'node-i-3': (0, 1)}
+        with patch('eksrollup.cli.plan_asgs', return_value=plan), \
+                patch('eksrollup.cli.get_k8s_nodes', return_value=[mock_node(f'i-{i}') for i in range(4)]), \
+                patch('eksrollup.cli.get_node_drain_costs', return_value=drain_costs), \
+                patch('eksrollup.cli.cordon_outdated_nodes') as cordon_mock, \
+                patch('eksrollup.cli.update_asg') as update_asg_mock:
+            update_asgs([mock_asg('asg-a')], 'mock-cluster')
+        # all outdated nodes are cordoned before any ASG is rolled
+        cordon_mock.assert_called_once()
+        rolled = [outdated['InstanceId'] for outdated in update_asg_mock.call_args[0][1][0]]
+        # nodes held by PodDisruptionBudgets go last, lighter nodes first, alternating availability zones
+        self.assertEqual(rolled, ['i-3', 'i-1', 'i-2', 'i-0'])
+
+    def test_prioritize_outdated_instances_unknown_nodes(self):
+        instances = [{'InstanceId': 'i-0', 'AvailabilityZone': 'a'}, {'InstanceId': 'i-1', 'AvailabilityZone': 'a'}]
+        with patch('eksrollup.cli.get_node_drain_costs', return_value={'node-i-1': (0, 1)}) as drain_costs_mock:
+            prioritized = prioritize_outdated_instances({'asg-a': (instances, {})}, {'i-1': 'node-i-1'})
+        drain_costs_mock.assert_called_once_with(['node-i-1'])
+        self.assertEqual([outdated['InstanceId'] for outdated in prioritized['asg-a'][0]], ['i-0', 'i-1'])
+
+    def test_prepare_warm_pool(self):
+        asg = {'AutoScalingGroupName': 'mock-asg', 'DesiredCapacity': 5, 'Tags': [],
+               'WarmPoolConfiguration': {'MinSize': 1, 'MaxGroupPreparedCapacity': 6, 'PoolState': 'Running'}}
+        with patch('eksrollup.cli.save_asg_tags') as save_tags_mock, \
+                patch('eksrollup.cli.delete_warm_pool') as delete_warm_pool_mock, \
+                patch('eksrollup.cli.is_warm_pool_deleted', return_value=True), \
+                patch('eksrollup.cli.put_warm_pool') as put_warm_pool_mock:
+            prepare_warm_pool(asg, 3)
+            prepare_warm_pool(dict(asg, MixedInstancesPolicy={'InstancesDistribution': {}}), 3)
+            prepare_warm_pool(dict(asg, Tags=[{'Key': 'eks-rolling-update:original_warm_pool', 'Value': 'null'}]), 3)
+        save_tags_mock.assert_called_once_with(
+            'mock-asg', 'eks-rolling-update:original_warm_pool',
+            '{"MaxGroupPreparedCapacity": 6, "MinSize": 1, "PoolState": "Running"}')
+        # the instances of the existing pool may predate the rolling update
+        delete_warm_pool_mock.assert_called_once_with('mock-asg')
+        # the cap on prepared instances leaves room for the surge
+        put_warm_pool_mock.assert_called_once_with(
+            'mock-asg', {'MinSize': 3, 'MaxGroupPreparedCapacity': 8, 'PoolState': 'Running'})
+
+    def test_prepare_warm_pool_resumed(self):
+        tags = [{'Key': 'eks-rolling-update:original_warm_pool', 'Value': '{"MinSize": 1, "PoolState": "Running"}'}]
+        asg = {'AutoScalingGroupName': 'mock-asg', 'DesiredCapacity': 5, 'Tags': tags}
+        with patch('eksrollup.cli.save_asg_tags') as save_tags_mock, \
+                patch('eksrollup.cli.delete_warm_pool') as delete_warm_pool_mock, \
+                patch('eksrollup.cli.is_warm_pool_deleted', return_value=True), \
+                patch('eksrollup.cli.put_warm_pool') as put_warm_pool_mock:
+            # the previous run was stopped once the original pool was deleted, or while it was being deleted
+            prepare_warm_pool(asg, 3)
+            prepare_warm_pool(dict(asg, WarmPoolConfiguration={'MinSize': 1, 'Status': 'PendingDelete'}), 3)
+        # the original settings saved by the previous run are kept
+        save_tags_mock.assert_not_called()
+        delete_warm_pool_mock.assert_not_called()
+        self.assertEqual(put_warm_pool_mock.call_args_list, [call('mock-asg', {'MinSize': 3, 'PoolState': 'Running'})] * 2)
+
+    def test_prepare_warm_pool_not_deleted(self):
+        asg = {'AutoScalingGroupName': 'mock-asg', 'DesiredCapacity': 5, 'Tags': [],
+               'WarmPoolConfiguration': {'MinSize': 5, 'PoolState': 'Stopped'}}
+        with patch('eksrollup.cli.save_asg_tags'), patch('eksrollup.cli.delete_warm_pool'), \
+                patch('eksrollup.cli.is_warm_pool_deleted', return_value=False), \
+                patch('eksrollup.cli.put_warm_pool') as put_warm_pool_mock:
+            with self.assertRaises(RollingUpdateException):
+                prepare_warm_pool(asg, 3)
+        put_warm_pool_mock.assert_not_called()
+
+
+class TestAsyncEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.asgs = [mock_asg('asg-a'), mock_asg('asg-b'), mock_asg('asg-c')]
+        self.plan = {asg['AutoScalingGroupName']: (asg['Instances'], asg) for asg in self.asgs}
+
+    @patch.dict('eksrollup.aio.app_config', {'RUN_MODE': 1, 'ASG_CONCURRENCY': 2, 'DRAIN_CONCURRENCY': 1})
+    def test_update_asgs_async_failure_isolated(self):
+        rolled = []
+
+        async def update_asg(asg_name, *args):
+            rolled.append(asg_name)
+            if asg_name == 'asg-b':
+                raise RollingUpdateException("Rolling update on ASG failed", asg_name)
+
+        with patch('eksrollup.cli.plan_asgs', return_value=self.plan), \
+                patch('eksrollup.cli.get_k8s_nodes', return_value=[]), \
+                patch('eksrollup.aio.update_asg_async', side_effect=update_asg):
+            with self.assertRaises(RollingUpdateException) as context:
+                asyncio.run(update_asgs_async(self.asgs, 'mock-cluster'))
+            self.assertEqual(context.exception.asg_name, 'asg-b')
+            self.assertEqual(sorted(rolled), ['asg-a', 'asg-b', 'asg-c'])
+
+    @patch.dict('eksrollup.aio.app_config', {'DRAIN_CONCURRENCY': 3, 'DRAIN_CONCURRENCY_PER_AZ': 0,
+                                             'ASG_USE_TERMINATION_POLICY': True, 'BETWEEN_NODES_WAIT': 0})
+    def test_drain_outdated_instances_async_concurrent(self):
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': 'us-east-1a'} for i in range(6)]
+        lock = threading.Lock()
+        active = []
+        peak = []
+
+        def drain_node(node_name):
+            with lock:
+                active.append(node_name)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with lock:
+                active.remove(node_name)
+
+        with patch('eksrollup.cli.get_node_by_instance_id', side_effect=lambda index, instance_id: instance_id), \
+                patch('eksrollup.cli.drain_node', side_effect=drain_node), \
+                patch('eksrollup.cli.delete_node'):
+            timings = asyncio.run(drain_outdated_instances_async('mock-asg', instances, {}, lambda: None))
+        self.assertEqual(len(timings), 6)
+        self.assertEqual(max(peak), 3)
+
+    @patch.dict('eksrollup.aio.app_config', {'DRAIN_CONCURRENCY': 2, 'DRAIN_CONCURRENCY_PER_AZ': 0,
+                                             'ASG_USE_TERMINATION_POLICY': True})
+    def test_drain_outdated_instances_async_failure(self):
+        instances = [{'InstanceId': f'i-{i}', 'AvailabilityZone': 'us-east-1a'} for i in range(4)]
+
+        def drain_node(node_name):
+            if node_name == 'i-0':
+                raise Exception('drain failed')
+
+        with patch('eksrollup.cli.get_node_by_instance_id', side_effect=lambda index, instance_id: instance_id), \
+                patch('eksrollup.cli.drain_node', side_effect=drain_node), \
+                patch('eksrollup.cli.delete_node'):
+            with self.assertRaises(RollingUpdateException):
+                asyncio.run(drain_outdated_instances_async('mock-asg', instances, {}, lambda: None))
+
+    def test_run_steps_async_validates_each_step(self):
+        def scale_up_asg_steps():
+            yield 'validate', dict(asg_name='mock-asg', new_desired_asg_capacity=2, cluster_name='mock-cluster', predictive=False)
+            yield 'sleep', 0
+            yield 'validate', dict(asg_name='mock-asg', new_desired_asg_capacity=3, cluster_name='mock-cluster', predictive=False)
+            return 3, 1, 3
+
+        validated = []
+
+        def validate_cluster_health_steps(**validation):
+            validated.append(validation['new_desired_asg_capacity'])
+            yield 'sleep', 0
+
+        with patch('eksrollup.aio.validate_cluster_health_steps', side_effect=validate_cluster_health_steps):
+            asg_state = asyncio.run(run_steps_async(scale_up_asg_steps()))
+        self.assertEqual(validated, [2, 3])
+        self.assertEqual(asg_state, (3, 1, 3))
+
+    def test_startup_is_lazy(self):
+        # neither boto3 nor the kubernetes client are imported, nor a region needed, until the tool reaches a cluster
+        env = {key: value for key, value in os.environ.items() if key not in ['AWS_DEFAULT_REGION', 'AWS_REGION']}
+        output = subprocess.run(
+            [sys.executable, '-c', 'import sys, eksrollup.cli; print(sorted(name for name in sys.modules '
+                                   'if name.split(".")[0] in ["boto3", "botocore", "kubernetes"]))'],
+            env=env, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+        self.assertEqual(output.strip(), '[]')
@@ -0,0 +1,109 @@
+import os
+import json
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import patch
+from eksrollup.fleet import load_fleet_targets, run_fleet
+from eksrollup.lib import aws
+from eksrollup.lib.aws_api import get_client
+from eksrollup.lib.budget import RolloutBudget, rollout_budget
+from eksrollup.lib.journal import journal
+from eksrollup.lib.target import ClusterTarget, get_target, use_target
+
+
+class TestFleet(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+        rollout_budget.configure(0, 0)
+
+    def test_load_fleet_targets(self):
+        path = os.path.join(self.tmp_dir, 'fleet.json')
+        with open(path, 'w') as fleet_file:
+            json.dump([
+                {'cluster_name': 'cluster-a', 'region': 'eu-west-1', 'k8s_context': 'context-a'},
+                {'cluster_name': 'cluster-b'},
+            ], fleet_file)
+        self.assertEqual(load_fleet_targets(path), [
+            ClusterTarget('cluster-a', 'eu-west-1', 'context-a'),
+            ClusterTarget('cluster-b', None, None),
+        ])
+
+    def test_regional_clients(self):
+        with use_target(ClusterTarget('cluster-a', 'eu-west-1', None)):
+            self.assertEqual(aws.client.meta.region_name, 'eu-west-1')
+            self.assertIs(aws.client.meta, get_client('autoscaling', 'eu-west-1').meta)
+        self.assertEqual(aws.client.meta.region_name, os.environ.get('AWS_DEFAULT_REGION', 'us-east-1'))
+        self.assertIsNot(get_client('ec2', 'eu-west-1'), get_client('ec2', 'eu-central-1'))
+
+    def test_target_journals(self):
+        with patch.dict('eksrollup.lib.journal.app_config', {'JOURNAL_PATH': os.path.join(self.tmp_dir, 'journal.json')}):
+            for cluster_name in ['cluster-a', 'cluster-b']:
+                with use_target(ClusterTarget(cluster_name, None, None)):
+                    journal.start(cluster_name)
+                    journal.record(f'i-{cluster_name}', 'drained')
+            with use_target(ClusterTarget('cluster-a', None, None)):
+                self.assertTrue(journal.reached('i-cluster-a', 'drained'))
+                self.assertFalse(journal.reached('i-cluster-b', 'drained'))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, 'journal.json.cluster-a')))
+        self.assertTrue(os.path.exists(os.path.join(self.tmp_dir, 'journal.json.cluster-b')))
+
+    def test_budget_caps_drains(self):
+        budget = RolloutBudget(max_drains=2)
+        in_flight = []
+        lock = threading.Lock()
+
+        def drain():
+            with budget.drain():
+                with lock:
+                    in_flight.append(budget.drains)
+                time.sleep(0.02)
+
+        threads = [threading.Thread(target=drain) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(max(in_flight), 2)
+        self.assertEqual(budget.drains, 0)
+
+    def test_budget_caps_surge(self):
+        budget = RolloutBudget(max_surge=3)
+        budget.acquire_surge(2)
+        acquired = threading.Event()
+        thread = threading.Thread(target=lambda: (budget.acquire_surge(2), acquired.set()))
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        budget.release_surge(2)
+        self.assertTrue(acquired.wait(1))
+        thread.join()
+        # a surge larger than the whole budget goes ahead once nothing else is in flight
+        budget.release_surge(2)
+        budget.acquire_surge(5)
+        self.assertEqual(budget.surge_instances, 5)
+
+    @patch.dict('eksrollup.fleet.app_config', {'FLEET_CONCURRENCY': 2, 'FLEET_MAX_DRAINS': 4, 'FLEET_MAX_SURGE': 10,
+                                               'METRICS_FILE': '', 'METRICS_PORT': 0})
+    def test_run_fleet_failure_isolated(self):
+        def run_update(asgs, cluster_name):
+            self.assertEqual(get_target().cluster_name, cluster_name)
+            if cluster_name == 'cluster-b':
+                raise Exception('ASG healthcheck failed')
+            return 3
+
+        targets = [ClusterTarget(f'cluster-{name}', 'us-east-1', None) for name in 'abc']
+        with patch('eksrollup.fleet.get_asgs', return_value=[]), \
+                patch('eksrollup.fleet.run_update', side_effect=run_update), \
+                patch('eksrollup.fleet.log_fleet_report') as report_mock:
+            self.assertFalse(run_fleet(targets))
+        results = report_mock.call_args[0][0]
+        self.assertEqual([result['status'] for result in results], ['succeeded', 'failed', 'succeeded'])
+        self.assertEqual([result['outdated_instances'] for result in results], [3, None, 3])
+        self.assertEqual(results[1]['error'], 'ASG healthcheck failed')
+        self.assertEqual((rollout_budget.max_drains, rollout_budget.max_surge), (4, 10))
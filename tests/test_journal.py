@@ -0,0 +1,109 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import patch, MagicMock
+from eksrollup.lib.journal import RolloutJournal, FileJournalStore
+from eksrollup.cli import roll_outdated_instance, cordon_outdated_nodes
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'journal.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_journal_resume(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.plan('asg-a', ['i-1', 'i-2'])
+        journal.record('i-1', 'drained')
+        journal.record_asg('asg-a', 'scaled')
+
+        resumed = RolloutJournal(FileJournalStore(self.path))
+        resumed.start('mock-cluster')
+        self.assertTrue(resumed.reached('i-1', 'cordoned'))
+        self.assertTrue(resumed.reached('i-1', 'drained'))
+        self.assertFalse(resumed.reached('i-1', 'deleted'))
+        self.assertFalse(resumed.reached('i-2', 'cordoned'))
+        self.assertEqual(resumed.asg_state('asg-a'), 'scaled')
+
+    def test_journal_other_cluster_ignored(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.record('i-1', 'deleted')
+
+        other = RolloutJournal(FileJournalStore(self.path))
+        other.start('other-cluster')
+        self.assertFalse(other.reached('i-1', 'planned'))
+
+    def test_journal_finish(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.plan('asg-a', ['i-1'])
+        journal.plan('asg-b', ['i-2'])
+        journal.finish_asg('asg-a')
+        self.assertFalse(journal.reached('i-1', 'planned'))
+        self.assertTrue(journal.reached('i-2', 'planned'))
+        journal.finish()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_journal_disabled(self):
+        journal = RolloutJournal()
+        journal.start('mock-cluster')
+        journal.record('i-1', 'deleted')
+        self.assertFalse(journal.reached('i-1', 'planned'))
+
+    @patch.dict('eksrollup.cli.app_config', {'ASG_USE_TERMINATION_POLICY': False, 'BETWEEN_NODES_WAIT': 0})
+    def test_roll_outdated_instance_skips_finished_steps(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.record('i-1', 'deleted')
+        decrement_desired_capacity = MagicMock()
+        with patch('eksrollup.cli.journal', journal), \
+                patch('eksrollup.cli.get_node_by_instance_id') as get_node_mock, \
+                patch('eksrollup.cli.drain_node') as drain_node_mock, \
+                patch('eksrollup.cli.delete_node') as delete_node_mock, \
+                patch('eksrollup.cli.terminate_instance_in_asg') as terminate_mock, \
+                patch('eksrollup.cli.termination_tracker') as tracker_mock:
+            tracker_mock.wait_for.return_value = True
+            roll_outdated_instance({'InstanceId': 'i-1'}, {}, decrement_desired_capacity)
+            get_node_mock.assert_not_called()
+            drain_node_mock.assert_not_called()
+            delete_node_mock.assert_not_called()
+            decrement_desired_capacity.assert_not_called()
+            terminate_mock.assert_called_once_with('i-1')
+        self.assertTrue(journal.reached('i-1', 'terminated'))
+
+    @patch.dict('eksrollup.cli.app_config', {'ASG_USE_TERMINATION_POLICY': False, 'BETWEEN_NODES_WAIT': 0})
+    def test_roll_outdated_instance_decrements_once(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.record('i-1', 'drained')
+        decrement_desired_capacity = MagicMock(side_effect=[Exception('interrupted'), None])
+        with patch('eksrollup.cli.journal', journal), \
+                patch('eksrollup.cli.get_node_by_instance_id', return_value='node-1'), \
+                patch('eksrollup.cli.delete_node'), \
+                patch('eksrollup.cli.terminate_instance_in_asg'), \
+                patch('eksrollup.cli.termination_tracker') as tracker_mock:
+            tracker_mock.wait_for.return_value = True
+            with self.assertRaises(Exception):
+                roll_outdated_instance({'InstanceId': 'i-1'}, {}, decrement_desired_capacity)
+            # the resumed run carries on with the termination
+            roll_outdated_instance({'InstanceId': 'i-1'}, {}, decrement_desired_capacity)
+        self.assertEqual(decrement_desired_capacity.call_count, 1)
+        self.assertTrue(journal.reached('i-1', 'terminated'))
+
+    @patch.dict('eksrollup.cli.app_config', {'TAINT_NODES': False})
+    def test_cordon_outdated_nodes_skips_cordoned(self):
+        journal = RolloutJournal(FileJournalStore(self.path))
+        journal.start('mock-cluster')
+        journal.record('i-1', 'cordoned')
+        with patch('eksrollup.cli.journal', journal), \
+                patch('eksrollup.cli.cordon_node') as cordon_node_mock:
+            cordon_outdated_nodes([{'InstanceId': 'i-1'}, {'InstanceId': 'i-2'}], {'i-1': 'node-1', 'i-2': 'node-2'})
+            cordon_node_mock.assert_called_once_with('node-2')
+        self.assertTrue(journal.reached('i-2', 'cordoned'))
@@ -1,10 +1,14 @@
 import os
+import time
 import unittest
 import json
-from eksrollup.lib.k8s import k8s_nodes_count, k8s_nodes_ready, get_node_by_instance_id, ensure_config_loaded
-from unittest.mock import patch
+from eksrollup.lib.k8s import k8s_nodes_count, k8s_nodes_ready, get_node_by_instance_id, ensure_config_loaded, \
+    get_pods_to_evict, get_drain_flag, evict_pod, get_k8s_api_client, wait_for_k8s_nodes, get_k8s_node_index, label_selector_matches, \
+    get_node_drain_costs, get_k8s_nodes
+from unittest.mock import patch, MagicMock
 from box import Box
-from kubernetes.client import ApiClient
+from kubernetes.client import ApiClient, V1LabelSelector, V1LabelSelectorRequirement
+from kubernetes.client.rest import ApiException
 from kubernetes.config import kube_config
 
 class TestK8S(unittest.TestCase):
@@ -42,6 +46,21 @@ class TestK8S(unittest.TestCase):
             self.assertNotEqual('http://localhost:6789', ApiClient().configuration.proxy)
 
 
+    @patch('eksrollup.lib.k8s._api_client', None)
+    @patch.dict("eksrollup.lib.k8s.app_config", {'K8S_CONNECTION_POOL_MAXSIZE': 7})
+    def test_get_k8s_api_client_cached(self):
+        with patch('eksrollup.lib.k8s.ensure_config_loaded', wraps=ensure_config_loaded) as ensure_config_loaded_mock:
+            api_client = get_k8s_api_client()
+            self.assertIs(api_client, get_k8s_api_client())
+            self.assertEqual(ensure_config_loaded_mock.call_count, 1)
+            self.assertEqual(api_client.configuration.connection_pool_maxsize, 7)
+
+    @patch('eksrollup.lib.k8s._api_client', None)
+    @patch.dict("eksrollup.lib.k8s.app_config", {'K8S_CLIENT_REFRESH_INTERVAL': -1})
+    def test_get_k8s_api_client_refresh(self):
+        api_client = get_k8s_api_client()
+        self.assertIsNot(api_client, get_k8s_api_client())
+
     def test_k8s_node_count(self):
         with patch('eksrollup.lib.k8s.get_k8s_nodes') as get_k8s_nodes_mock:
             get_k8s_nodes_mock.return_value = self.k8s_response_mock['items']
@@ -58,6 +77,14 @@ class TestK8S(unittest.TestCase):
             with self.assertRaises(Exception):
                 get_node_by_instance_id(get_k8s_nodes_mock, 'i-0a000b00000000cdee')
 
+    def test_get_node_by_instance_id(self):
+        nodes = [self.mock_node('0a000b00000000cde'), self.mock_node('0a000b00000000cdef')]
+        node_index = get_k8s_node_index(nodes)
+        self.assertEqual(get_node_by_instance_id(node_index, 'i-0a000b00000000cde'), '0a000b00000000cde')
+        self.assertEqual(get_node_by_instance_id(nodes, 'i-0a000b00000000cdef'), '0a000b00000000cdef')
+        with self.assertRaises(Exception):
+            get_node_by_instance_id(node_index, 'i-0a000b00000000cd')
+
     def test_k8s_nodes_ready(self):
         with patch('eksrollup.lib.k8s.get_k8s_nodes') as get_k8s_nodes_mock:
             box = Box(self.k8s_response_mock, ordered_box=True)
@@ -70,3 +97,164 @@ class TestK8S(unittest.TestCase):
             get_k8s_nodes_mock.return_value = box['items']
             self.assertFalse(k8s_nodes_ready(2, 1), False)
 
+    def mock_pod(self, name, owner_kind=None, annotations=None, phase='Running'):
+        owner_references = [{'kind': owner_kind}] if owner_kind else None
+        return Box({'metadata': {'name': name, 'namespace': 'default', 'uid': name,
+                                 'annotations': annotations, 'owner_references': owner_references},
+                    'status': {'phase': phase}})
+
+    def test_get_pods_to_evict(self):
+        k8s_api = MagicMock()
+        k8s_api.list_pod_for_all_namespaces.return_value.items = [
+            self.mock_pod('app', 'ReplicaSet'),
+            self.mock_pod('daemon', 'DaemonSet'),
+            self.mock_pod('mirror', 'Node', {'kubernetes.io/config.mirror': 'abc'}),
+        ]
+        pods = get_pods_to_evict(k8s_api, 'node-1')
+        self.assertEqual([pod.metadata.name for pod in pods], ['app'])
+        k8s_api.list_pod_for_all_namespaces.assert_called_with(field_selector='spec.nodeName=node-1')
+
+    def test_get_pods_to_evict_unmanaged(self):
+        k8s_api = MagicMock()
+        k8s_api.list_pod_for_all_namespaces.return_value.items = [self.mock_pod('bare')]
+        with self.assertRaises(Exception):
+            get_pods_to_evict(k8s_api, 'node-1')
+        self.assertEqual(len(get_pods_to_evict(k8s_api, 'node-1', force=True)), 1)
+
+    def test_get_pods_to_evict_finished(self):
+        k8s_api = MagicMock()
+        k8s_api.list_pod_for_all_namespaces.return_value.items = [
+            self.mock_pod('job', phase='Succeeded'),
+            self.mock_pod('crashed', phase='Failed'),
+        ]
+        pods = get_pods_to_evict(k8s_api, 'node-1')
+        self.assertEqual([pod.metadata.name for pod in pods], ['job', 'crashed'])
+
+    def test_get_drain_flag(self):
+        self.assertTrue(get_drain_flag(['--ignore-daemonsets', '--force'], '--force'))
+        self.assertTrue(get_drain_flag(['--force=True'], '--force'))
+        self.assertFalse(get_drain_flag(['--force=false'], '--force'))
+        self.assertFalse(get_drain_flag(['--force', '--force=0'], '--force'))
+        self.assertFalse(get_drain_flag(['--force-deletion'], '--force'))
+        self.assertFalse(get_drain_flag([], '--force'))
+
+    def test_label_selector_matches(self):
+        selector = V1LabelSelector(match_labels={'app': 'web'}, match_expressions=[
+            V1LabelSelectorRequirement(key='tier', operator='In', values=['frontend', 'edge']),
+            V1LabelSelectorRequirement(key='canary', operator='DoesNotExist'),
+        ])
+        self.assertTrue(label_selector_matches(selector, {'app': 'web', 'tier': 'edge'}))
+        self.assertFalse(label_selector_matches(selector, {'app': 'web', 'tier': 'backend'}))
+        self.assertFalse(label_selector_matches(selector, {'app': 'web', 'tier': 'edge', 'canary': 'true'}))
+        self.assertTrue(label_selector_matches(V1LabelSelector(), {'app': 'web'}))
+        self.assertFalse(label_selector_matches(None, {'app': 'web'}))
+
+    def test_get_node_drain_costs(self):
+        def pod(name, node_name, labels, owner_kind='ReplicaSet'):
+            return Box({'metadata': {'name': name, 'namespace': 'default', 'labels': labels, 'annotations': None,
+                                     'owner_references': [{'kind': owner_kind}]},
+                        'spec': {'node_name': node_name}})
+
+        core_api = MagicMock()
+        core_api.list_pod_for_all_namespaces.return_value.items = [
+            pod('web-1', 'node-1', {'app': 'web'}),
+            pod('web-2', 'node-1', {'app': 'web'}),
+            pod('api-1', 'node-2', {'app': 'api'}),
+            pod('agent-1', 'node-2', {'app': 'agent'}, 'DaemonSet'),
+            pod('web-3', 'node-3', {'app': 'web'}),
+        ]
+        policy_api = MagicMock()
+        policy_api.list_pod_disruption_budget_for_all_namespaces.return_value.items = [Box({
+            'metadata': {'namespace': 'default'},
+            'spec': {'selector': V1LabelSelector(match_labels={'app': 'web'})},
+            'status': {'disruptions_allowed': 1},
+        })]
+        with patch('eksrollup.lib.k8s.get_core_v1_api', return_value=core_api), \
+                patch('eksrollup.lib.k8s.get_policy_api', return_value=policy_api):
+            drain_costs = get_node_drain_costs(['node-1', 'node-2'])
+        # only one of the two web pods of node-1 can be disrupted at once, and DaemonSet pods aren't evicted
+        self.assertEqual(drain_costs, {'node-1': (1, 2), 'node-2': (0, 1)})
+        core_api.list_pod_for_all_namespaces.assert_called_once()
+
+    @patch('eksrollup.lib.k8s.EVICTION_RETRY_WAIT', 0)
+    def test_evict_pod_retries_disruption_budget(self):
+        k8s_api = MagicMock()
+        k8s_api.create_namespaced_pod_eviction.side_effect = [ApiException(status=429), None]
+        evict_pod(k8s_api, self.mock_pod('app', 'ReplicaSet'), time.time() + 60)
+        self.assertEqual(k8s_api.create_namespaced_pod_eviction.call_count, 2)
+
+    def test_evict_pod_timeout(self):
+        k8s_api = MagicMock()
+        k8s_api.create_namespaced_pod_eviction.side_effect = ApiException(status=429)
+        with self.assertRaises(Exception):
+            evict_pod(k8s_api, self.mock_pod('app', 'ReplicaSet'), time.time())
+
+    def mock_node(self, name, labels=None):
+        return Box({'metadata': {'name': name, 'labels': labels or {}, 'resource_version': '2'},
+                    'spec': {'provider_id': f'aws:///us-east-1a/i-{name}'}})
+
+    def test_wait_for_k8s_nodes_watch(self):
+        k8s_api = MagicMock()
+        k8s_api.list_node.return_value.items = [self.mock_node('a'), self.mock_node('b')]
+        k8s_api.list_node.return_value.metadata._continue = None
+        events = [
+            {'type': 'ADDED', 'object': self.mock_node('c', {'spotinst.io/node-lifecycle': 'spot'})},
+            {'type': 'ADDED', 'object': self.mock_node('d')},
+        ]
+        with patch('eksrollup.lib.k8s.get_core_v1_api', return_value=k8s_api), \
+                patch('eksrollup.lib.k8s.watch.Watch') as watch_mock:
+            watch_mock.return_value.stream.return_value = iter(events)
+            self.assertTrue(wait_for_k8s_nodes(lambda nodes: len(nodes) == 3, 60, ['spotinst.io/node-lifecycle']))
+            watch_mock.return_value.stop.assert_called_once()
+            self.assertEqual(watch_mock.return_value.stream.call_args[1]['label_selector'], '!spotinst.io/node-lifecycle')
+        self.assertEqual(k8s_api.list_node.call_count, 1)
+
+    def test_wait_for_k8s_nodes_timeout(self):
+        k8s_api = MagicMock()
+        k8s_api.list_node.return_value.items = [self.mock_node('a')]
+        k8s_api.list_node.return_value.metadata._continue = None
+        with patch('eksrollup.lib.k8s.get_core_v1_api', return_value=k8s_api), \
+                patch('eksrollup.lib.k8s.watch.Watch') as watch_mock:
+            watch_mock.return_value.stream.return_value = iter([])
+            self.assertFalse(wait_for_k8s_nodes(lambda nodes: len(nodes) == 3, 0, []))
+
+    @patch.dict("eksrollup.lib.k8s.app_config", {'K8S_LIST_PAGE_SIZE': 2})
+    def test_get_k8s_nodes_paginated(self):
+        k8s_api = MagicMock()
+        k8s_api.list_node.side_effect = [
+            MagicMock(items=[self.mock_node('a'), self.mock_node('b')], metadata=MagicMock(resource_version='5', _continue='token')),
+            MagicMock(items=[self.mock_node('c')], metadata=MagicMock(resource_version='5', _continue=None)),
+        ]
+        with patch('eksrollup.lib.k8s.get_core_v1_api', return_value=k8s_api):
+            nodes = get_k8s_nodes(['spotinst.io/node-lifecycle', 'example.com/skip'])
+        self.assertEqual([node.metadata.name for node in nodes], ['a', 'b', 'c'])
+        first_page, next_page = [call[1] for call in k8s_api.list_node.call_args_list]
+        self.assertEqual(first_page, {'label_selector': '!spotinst.io/node-lifecycle,!example.com/skip',
+                                      'resource_version': '0', 'limit': 2})
+        self.assertEqual(next_page, {'label_selector': '!spotinst.io/node-lifecycle,!example.com/skip',
+                                     'limit': 2, '_continue': 'token'})
+
+    def test_get_k8s_nodes_projected(self):
+        k8s_api = MagicMock()
+        k8s_api.list_node.return_value.data = json.dumps(self.k8s_response_mock_raw())
+        with patch('eksrollup.lib.k8s.get_core_v1_api', return_value=k8s_api):
+            nodes = get_k8s_nodes([], projected=True)
+        self.assertFalse(k8s_api.list_node.call_args[1]['_preload_content'])
+        self.assertEqual(len(nodes), 1)
+        self.assertEqual(nodes[0].metadata.name, 'node-a')
+        self.assertEqual(nodes[0].spec.provider_id, 'aws:///us-east-1a/i-0a')
+        self.assertEqual([(condition.type, condition.status) for condition in nodes[0].status.conditions], [('Ready', 'True')])
+        self.assertEqual(get_k8s_node_index(nodes), {'i-0a': 'node-a'})
+
+    def k8s_response_mock_raw(self):
+        return {
+            'metadata': {'resourceVersion': '5'},
+            'items': [{
+                'metadata': {'name': 'node-a', 'labels': {'kubernetes.io/os': 'linux'}},
+                'spec': {'providerID': 'aws:///us-east-1a/i-0a'},
+                'status': {
+                    'conditions': [{'type': 'MemoryPressure', 'status': 'False'}, {'type': 'Ready', 'status': 'True'}],
+                    'images': [{'names': ['example/image:latest'], 'sizeBytes': 1024}],
+                },
+            }],
+        }
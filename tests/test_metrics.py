@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import urlopen
+from unittest.mock import MagicMock
+from eksrollup.lib.metrics import Histogram, Gauge, render_metrics, write_metrics_file, start_metrics_server, \
+    read_histogram_totals
+from eksrollup.lib.k8s import InstrumentedApi
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram('test_histogram_seconds', 'Test histogram', ['asg'], buckets=(1, 10))
+        histogram.observe(0.5, asg='asg-a')
+        histogram.observe(5, asg='asg-a')
+        histogram.observe(50, asg='asg-a')
+        self.assertEqual(histogram.render(), [
+            '# HELP test_histogram_seconds Test histogram',
+            '# TYPE test_histogram_seconds histogram',
+            'test_histogram_seconds_bucket{asg="asg-a",le="1"} 1',
+            'test_histogram_seconds_bucket{asg="asg-a",le="10"} 2',
+            'test_histogram_seconds_bucket{asg="asg-a",le="+Inf"} 3',
+            'test_histogram_seconds_sum{asg="asg-a"} 55.5',
+            'test_histogram_seconds_count{asg="asg-a"} 3',
+        ])
+
+    def test_histogram_time_on_error(self):
+        histogram = Histogram('test_timed_seconds', 'Test timed histogram')
+        with self.assertRaises(ValueError):
+            with histogram.time():
+                raise ValueError()
+        self.assertIn('test_timed_seconds_count 1', histogram.render())
+
+    def test_gauge(self):
+        gauge = Gauge('test_gauge', 'Test gauge', ['asg'])
+        gauge.set(3, asg='asg-a')
+        gauge.dec(asg='asg-a')
+        gauge.set(1, asg='asg-"b"')
+        self.assertEqual(gauge.render()[2:], ['test_gauge{asg="asg-\\"b\\""} 1', 'test_gauge{asg="asg-a"} 2'])
+
+    def test_write_metrics_file(self):
+        Gauge('test_file_gauge', 'Test file gauge').set(1)
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'eksrollup.prom')
+            write_metrics_file(path)
+            with open(path) as metrics_file:
+                self.assertIn('test_file_gauge 1\n', metrics_file.read())
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_write_metrics_file_concurrently(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'eksrollup.prom')
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                # raises if one writer replaced the temporary file of another
+                list(executor.map(write_metrics_file, [path] * 50))
+            self.assertEqual(os.listdir(tmp_dir), ['eksrollup.prom'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_histogram_totals(self):
+        histogram = Histogram('test_read_seconds', 'Test read histogram', ['asg'])
+        histogram.observe(10, asg='asg-a')
+        histogram.observe(20, asg='asg-b')
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'eksrollup.prom')
+            write_metrics_file(path)
+            self.assertEqual(read_histogram_totals(path)['test_read_seconds'], (30.0, 2))
+            self.assertEqual(read_histogram_totals(os.path.join(tmp_dir, 'missing.prom')), {})
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_metrics_server(self):
+        Gauge('test_server_gauge', 'Test server gauge').set(2)
+        server = start_metrics_server(port=18911)
+        try:
+            body = urlopen('http://127.0.0.1:18911/metrics').read().decode('utf-8')
+            self.assertIn('test_server_gauge 2\n', body)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_instrumented_k8s_api(self):
+        k8s_api = MagicMock()
+        k8s_api.patch_node.return_value = 'patched'
+        instrumented = InstrumentedApi(k8s_api)
+        self.assertEqual(instrumented.patch_node('node-1', {}), 'patched')
+        k8s_api.patch_node.assert_called_once_with('node-1', {})
+        self.assertIn('eksrollup_api_call_duration_seconds_count{api="k8s",operation="MagicMock.patch_node"} 1',
+                      render_metrics())
@@ -0,0 +1,119 @@
+import unittest
+import threading
+from unittest.mock import patch
+from eksrollup.lib import aws
+from eksrollup.lib.aws import get_asgs
+from eksrollup.lib.exceptions import RollingUpdateException
+from eksrollup.refresh import refresh_asgs, refresh_asg, get_refresh_preferences
+from benchmarks.simulator import SimulatedCluster, SimulationProfile
+
+# simulated seconds
+REFRESH_CONFIG = {'INSTANCE_REFRESH': True, 'INSTANCE_REFRESH_WARMUP': 10, 'INSTANCE_REFRESH_POLL_WAIT': 5,
+                  'DRAIN_CONCURRENCY': 2, 'ASG_CONCURRENCY': 2}
+
+
+class TestRefresh(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = SimulationProfile(boot_seconds=20, join_seconds=10, drain_seconds=10, terminate_seconds=10)
+
+    def test_refresh_asgs(self):
+        cluster = SimulatedCluster('mock-cluster', [2, 3], self.profile, time_scale=0.001)
+        with cluster.patch(**REFRESH_CONFIG):
+            self.assertEqual(refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster'), 5)
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        self.assertEqual(cluster.api_calls['autoscaling.StartInstanceRefresh'], 2)
+        self.assertEqual(cluster.api_calls['autoscaling.CompleteLifecycleAction'], 5)
+        self.assertEqual(cluster.api_calls['k8s.delete_node'], 5)
+        # AWS did the replacement, the tool never terminated or scaled anything itself
+        self.assertEqual(cluster.api_calls['autoscaling.TerminateInstanceInAutoScalingGroup'], 0)
+        self.assertEqual(cluster.api_calls['autoscaling.UpdateAutoScalingGroup'], 0)
+        self.assertEqual([asg['DesiredCapacity'] for asg in cluster.asgs.values()], [2, 3])
+        self.assertEqual([asg['LifecycleHooks'] for asg in cluster.asgs.values()], [{}, {}])
+
+    def test_refresh_asgs_resumes_refresh(self):
+        cluster = SimulatedCluster('mock-cluster', [3], self.profile, time_scale=0.001)
+        with cluster.patch(**REFRESH_CONFIG):
+            # a refresh left in progress by a previous run
+            aws.client.start_instance_refresh(AutoScalingGroupName='mock-cluster-asg-0', Strategy='Rolling',
+                                              Preferences={'MinHealthyPercentage': 90, 'InstanceWarmup': 10})
+            refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        self.assertEqual(cluster.api_calls['autoscaling.StartInstanceRefresh'], 1)
+
+    def test_refresh_asgs_heartbeat(self):
+        profile = SimulationProfile(boot_seconds=20, join_seconds=10, drain_seconds=40, terminate_seconds=10)
+        cluster = SimulatedCluster('mock-cluster', [4], profile, time_scale=0.01)
+        # the refresh holds all 4 instances at once while they are drained one by one, for longer than the
+        # hook timeout of 1 wall clock second
+        with cluster.patch(**dict(REFRESH_CONFIG, DRAIN_CONCURRENCY=1, INSTANCE_REFRESH_MIN_HEALTHY=0,
+                                  INSTANCE_REFRESH_HOOK_TIMEOUT=1)):
+            refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        self.assertEqual(cluster.hook_timeouts, 0)
+        self.assertGreater(cluster.api_calls['autoscaling.RecordLifecycleActionHeartbeat'], 0)
+
+    def test_refresh_asgs_drain_failure(self):
+        cluster = SimulatedCluster('mock-cluster', [3], self.profile, time_scale=0.001)
+        with cluster.patch(**REFRESH_CONFIG), \
+                patch('eksrollup.refresh.drain_node', side_effect=Exception('Node not drained properly. Exiting')):
+            with self.assertRaises(RollingUpdateException):
+                refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        asg = cluster.asgs['mock-cluster-asg-0']
+        self.assertEqual(asg['InstanceRefreshes'][0]['Status'], 'Cancelled')
+        self.assertEqual(asg['LifecycleHooks'], {})
+        self.assertEqual(cluster.api_calls['autoscaling.CompleteLifecycleAction'], 0)
+
+    def test_refresh_asgs_drain_failure_queued(self):
+        cluster = SimulatedCluster('mock-cluster', [4], self.profile, time_scale=0.001)
+        drained = []
+
+        def drain_node(node_name):
+            drained.append(node_name)
+            cluster.drain_node(node_name)
+            raise Exception('Node not drained properly. Exiting')
+
+        # all 4 instances are held at once while only one is drained at a time
+        with cluster.patch(**dict(REFRESH_CONFIG, DRAIN_CONCURRENCY=1, INSTANCE_REFRESH_MIN_HEALTHY=0)), \
+                patch('eksrollup.refresh.drain_node', side_effect=drain_node):
+            with self.assertRaises(RollingUpdateException):
+                refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        asg = cluster.asgs['mock-cluster-asg-0']
+        self.assertEqual(asg['InstanceRefreshes'][0]['Status'], 'Cancelled')
+        self.assertEqual(asg['LifecycleHooks'], {})
+        # the drains still queued behind the failed one were dropped rather than waited for
+        self.assertEqual(len(drained), 1)
+        self.assertEqual(cluster.api_calls['autoscaling.CancelInstanceRefresh'], 1)
+
+    def test_refresh_asgs_api_failure(self):
+        cluster = SimulatedCluster('mock-cluster', [3], self.profile, time_scale=0.001)
+        with cluster.patch(**REFRESH_CONFIG), \
+                patch('eksrollup.refresh.get_asg', side_effect=Exception('Throttling')):
+            with self.assertRaises(RollingUpdateException):
+                refresh_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        asg = cluster.asgs['mock-cluster-asg-0']
+        # the refresh does not go on replacing instances once the hook holding them is gone
+        self.assertEqual(asg['InstanceRefreshes'][0]['Status'], 'Cancelled')
+        self.assertEqual(asg['LifecycleHooks'], {})
+
+    def test_refresh_asg_stopped(self):
+        cluster = SimulatedCluster('mock-cluster', [3], self.profile, time_scale=0.001)
+        stopped = threading.Event()
+        stopped.set()
+        with cluster.patch(**REFRESH_CONFIG):
+            asg = get_asgs('mock-cluster', [])[0]
+            with self.assertRaises(RollingUpdateException):
+                refresh_asg('mock-cluster-asg-0', asg, [], {}, stopped)
+        asg = cluster.asgs['mock-cluster-asg-0']
+        self.assertEqual(asg['InstanceRefreshes'][0]['Status'], 'Cancelled')
+        self.assertEqual(asg['LifecycleHooks'], {})
+
+    def test_get_refresh_preferences(self):
+        asg = {'LaunchTemplate': {'LaunchTemplateName': 'mock-lt', 'Version': '$Latest'}}
+        with patch.dict('eksrollup.refresh.app_config', {'RUN_MODE': 1, 'INSTANCE_REFRESH_MIN_HEALTHY': 75,
+                                                         'INSTANCE_REFRESH_WARMUP': 120}):
+            self.assertEqual(get_refresh_preferences(asg),
+                             {'MinHealthyPercentage': 75, 'InstanceWarmup': 120, 'SkipMatching': True})
+            self.assertNotIn('SkipMatching', get_refresh_preferences({'LaunchConfigurationName': 'mock-lc'}))
+        with patch.dict('eksrollup.refresh.app_config', {'RUN_MODE': 4}):
+            self.assertNotIn('SkipMatching', get_refresh_preferences(asg))
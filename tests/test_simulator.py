@@ -0,0 +1,81 @@
+import unittest
+from eksrollup.cli import update_asgs
+from eksrollup.lib.aws import get_asgs
+from benchmarks.simulator import SimulatedCluster, SimulationProfile, simulate, CURRENT_LAUNCH_CONFIGURATION
+from benchmarks.benchmark import get_asg_sizes, find_regressions
+from benchmarks import startup
+
+
+class TestSimulator(unittest.TestCase):
+
+    def setUp(self):
+        self.profile = SimulationProfile(boot_seconds=20, join_seconds=10, drain_seconds=10, terminate_seconds=10)
+
+    def test_rolling_update(self):
+        cluster = SimulatedCluster('mock-cluster', [2, 3], self.profile, time_scale=0.001)
+        with cluster.patch(CLUSTER_HEALTH_WAIT=10, GLOBAL_HEALTH_WAIT=5):
+            update_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        self.assertEqual([asg['DesiredCapacity'] for asg in cluster.asgs.values()], [2, 3])
+        self.assertEqual([asg['MaxSize'] for asg in cluster.asgs.values()], [2, 3])
+        # only the cluster tag is left once the rolling update is done
+        self.assertEqual([len(asg['Tags']) for asg in cluster.asgs.values()], [1, 1])
+        self.assertEqual(cluster.peak_instances, 8)
+
+    def test_rolling_update_warm_pool(self):
+        cluster = SimulatedCluster('mock-cluster', [2, 3], self.profile, time_scale=0.001)
+        # an existing warm pool of instances launched before the rolling update
+        cluster.add_warm_pool('mock-cluster-asg-1', {'MinSize': 1, 'PoolState': 'Running'})
+        with cluster.patch(CLUSTER_HEALTH_WAIT=10, GLOBAL_HEALTH_WAIT=5, WARM_POOL=True):
+            update_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        # the existing pool was replaced before the surge, so none of its outdated instances were taken into service
+        self.assertFalse(any(instance['launch_configuration'] != CURRENT_LAUNCH_CONFIGURATION and instance['warm']
+                             and instance['terminating_at'] is None for instance in cluster.instances.values()))
+        self.assertEqual(cluster.api_calls['autoscaling.PutWarmPool'], 3)
+        # the pool created for the rolling update is deleted and the existing one gets its settings back
+        self.assertEqual(cluster.asgs['mock-cluster-asg-0']['WarmPool'], None)
+        self.assertEqual(cluster.asgs['mock-cluster-asg-1']['WarmPool'], {'MinSize': 1, 'PoolState': 'Running'})
+        self.assertEqual([len(asg['Tags']) for asg in cluster.asgs.values()], [1, 1])
+        # the surge only took instances of the warm pools
+        self.assertTrue(all(instance['launched_warm'] for instance in cluster.instances.values()
+                            if instance['launch_configuration'] == CURRENT_LAUNCH_CONFIGURATION))
+        self.assertEqual(cluster.peak_instances, 8)
+
+    def test_rolling_update_warm_pool_resumed_without_warm_pool(self):
+        cluster = SimulatedCluster('mock-cluster', [2], self.profile, time_scale=0.001)
+        # a run with WARM_POOL set was interrupted once it had replaced the pool
+        cluster.asgs['mock-cluster-asg-0']['WarmPool'] = {'MinSize': 2, 'PoolState': 'Stopped'}
+        cluster.asgs['mock-cluster-asg-0']['Tags']['eks-rolling-update:original_warm_pool'] = 'null'
+        with cluster.patch(CLUSTER_HEALTH_WAIT=10, GLOBAL_HEALTH_WAIT=5, WARM_POOL=False):
+            update_asgs(get_asgs('mock-cluster', []), 'mock-cluster')
+        self.assertEqual(cluster.outdated_instance_count(), 0)
+        # the pool the tool created is deleted along with its tag
+        self.assertEqual(cluster.asgs['mock-cluster-asg-0']['WarmPool']['Status'], 'PendingDelete')
+        self.assertEqual(len(cluster.asgs['mock-cluster-asg-0']['Tags']), 1)
+
+    def test_simulate_max_surge(self):
+        result = simulate([4], self.profile, time_scale=0.001, MAX_SURGE=1, CLUSTER_HEALTH_WAIT=10, GLOBAL_HEALTH_WAIT=5)
+        self.assertEqual(result.outdated_instances, 0)
+        self.assertEqual(result.peak_instances, 5)
+        self.assertEqual(result.api_calls['autoscaling.TerminateInstanceInAutoScalingGroup'], 4)
+
+    def test_simulate_api_throttling(self):
+        profile = SimulationProfile(boot_seconds=20, join_seconds=10, drain_seconds=10, terminate_seconds=10, api_rate_limit=0.5)
+        result = simulate([2], profile, time_scale=0.001, CLUSTER_HEALTH_WAIT=10, GLOBAL_HEALTH_WAIT=5)
+        self.assertEqual(result.outdated_instances, 0)
+        self.assertGreater(sum(result.throttled_calls.values()), 0)
+
+    def test_get_asg_sizes(self):
+        self.assertEqual(get_asg_sizes(10, 3), [4, 3, 3])
+
+    def test_find_regressions(self):
+        baseline = [{'nodes': 10, 'scenario': 'run-mode-1', 'simulated_seconds': 100, 'aws_api_calls': 50, 'k8s_api_calls': 100}]
+        results = [{'nodes': 10, 'scenario': 'run-mode-1', 'simulated_seconds': 130, 'aws_api_calls': 50, 'k8s_api_calls': 100}]
+        self.assertEqual(len(find_regressions(results, baseline, 0.2)), 1)
+        self.assertEqual(find_regressions(results, baseline, 0.5), [])
+
+    def test_find_startup_regressions(self):
+        baseline = [{'command': 'help', 'median_seconds': 0.2}, {'command': 'plan', 'median_seconds': 1.0}]
+        results = [{'command': 'help', 'median_seconds': 0.3}, {'command': 'plan', 'median_seconds': 1.1}]
+        self.assertEqual(startup.find_regressions(results, baseline, 0.2), ['help: median_seconds went from 0.2 to 0.3'])